@@ -645,6 +645,12 @@ def deploy(branch="stable"):
 
     with cd(env.proj_path):
         manage("migrate")
+        # Sets the denormalized fields of the publications that do not have them, nothing to do once they are set
+        manage("denormalize_publications")
+        # Builds the rollups, sketches and hashtag index of the cities that have none, after the migrations that
+        # create them
+        manage("rebuild_rollups --missing")
+        manage("rebuild_hashtag_index --missing")
         if env.compress_offline:
             manage("compress")
 
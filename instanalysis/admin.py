@@ -27,6 +27,11 @@ class HashtagsAdmin(admin.ModelAdmin):
     fields = ('label', 'publications', 'categories')
     readonly_fields = ('publications',)
 
+    def save_related(self, request, form, formsets, change):
+        super(HashtagsAdmin, self).save_related(request, form, formsets, change)
+        # Publications store the categories of their hashtags
+        models.refresh_publication_categories([form.instance.id])
+
 
 class SpotInline(admin.StackedInline):
     model = models.Spot
@@ -46,7 +51,7 @@ class CityManager(admin.ModelAdmin):
 
     def last_downloaded_date(self, instance):
 
-        d = models.Publication.objects.filter(location__spot__city=instance).order_by('-publication_date').first().created
+        d = models.Publication.objects.of_city(instance.name).order_by('-publication_date').first().created
         return naturaltime(d)
 
 
@@ -1,27 +1,38 @@
 import logging
+import random
+import threading
 import requests
 import json
+import math
 import time
 from datetime import datetime
+from Queue import Full, Queue
 
+from requests.adapters import HTTPAdapter
 from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 
+from .quota import QuotaLimiter, QuotaExceeded
+
 logger = logging.getLogger(__name__)
 
+# Responses that are worth retrying, the API is temporarily unavailable
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+
 class APIGramException(Exception):
     pass
 
+
 def get_access_token():
     """ Retrieves an OAUTH access token for Instagram
     """
+    from instanalysis import api
     from instanalysis.models import Setting
-    from instanalysis.tasks import calculate_api_quotas
 
     logger.info("Asking for a OAuth token to instagram")
     code = Setting.objects.get_value('instagram_code')
-    api = InstagramAPI()
-    calculate_api_quotas.delay()
     payload = {
         'client_secret': settings.INSTAGRAM_SECRET_ID,
         'grant_type': 'authorization_code',
@@ -30,7 +41,7 @@ def get_access_token():
         'code': code,
         'client_id': settings.INSTAGRAM_CLIENT_ID
     }
-    data = api._post_to_api("https://api.instagram.com/oauth/access_token", payload)
+    data = api._post_to_api("%s/oauth/access_token" % api.base_url, payload)
     username = data.get("user").get("username")
     access_token = data.get('access_token')
     logger.info("Access token obtained for user %s" % username)
@@ -40,23 +51,76 @@ def get_access_token():
 
 
 class InstagramAPI(object):
+    """ Client for the Instagram API. Every client owns a pool of keep-alive connections, so it should be reused
+    between calls: use the client created in instanalysis.api. Failed requests are retried with jittered exponential backoff.
+
+    :param base_url: URL of the API, useful to point the client to a local server
+    :param pool_size: Maximum number of connections kept open
+    :param timeout: Seconds to wait for the connection and for the response, as accepted by requests
+    :param max_retries: Number of retries before giving up on a request
+    :param quota: QuotaLimiter every request is acquired from. By default the quota shared through redis is used,
+                  False disables it
+    """
+
+    def __init__(self, base_url=None, pool_size=None, timeout=None, max_retries=None, quota=None):
+        self.base_url = (base_url or getattr(settings, 'INSTAGRAM_API_URL', 'https://api.instagram.com')).rstrip('/')
+        self.pool_size = pool_size or getattr(settings, 'INSTAGRAM_API_POOL_SIZE', 10)
+        self.timeout = timeout or getattr(settings, 'INSTAGRAM_API_TIMEOUT', (5, 30))
+        self.max_retries = max_retries if max_retries is not None else \
+            getattr(settings, 'INSTAGRAM_API_MAX_RETRIES', 4)
+        self.backoff_base = getattr(settings, 'INSTAGRAM_API_BACKOFF_BASE', 1)
+        self.backoff_max = getattr(settings, 'INSTAGRAM_API_BACKOFF_MAX', 60)
+        self.quota = QuotaLimiter() if quota is None else quota
+        self.quota_timeout = getattr(settings, 'INSTAGRAM_QUOTA_TIMEOUT', None)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _backoff_delay(self, attempt):
+        """ Seconds to wait before the retry number attempt (starting at 0). Exponential backoff with full jitter,
+        so workers that failed at the same time do not retry at the same time
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _request(self, method, url, **kwargs):
+        """ Performs the request, retrying on connection errors, timeouts and 5xx responses until the retry budget
+        is exhausted. Returns the response
+        """
+        attempt = 0
+        while True:
+            if self.quota:
+                try:
+                    self.quota.acquire(timeout=self.quota_timeout)
+                except QuotaExceeded as e:
+                    raise APIGramException(e)
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    return response
+                error = "Status code `%s`: %s" % (response.status_code, response.content)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if attempt >= self.max_retries:
+                # Could not retrieve after many attempts
+                raise APIGramException(error)
+            delay = self._backoff_delay(attempt)
+            logger.warning("Request to Instagram API failed (%s). Retrying in %.1f seconds" % (error, delay))
+            time.sleep(delay)
+            attempt += 1
 
-    def _get_from_api(self, url, retry=0):
+    def _get_from_api(self, url):
         """ Queries to the API url provided by parameter and returns a JSON object with the result
         """
-        from instanalysis.models import InstagramRequest, Setting
-        access_token = Setting.objects.get_value('access_token')
-        url = "%s&access_token=%s" % (url, access_token)
+        from instanalysis.models import Setting
+        if 'access_token=' not in url:
+            # Pagination urls already include the access token
+            access_token = Setting.objects.get_value('access_token')
+            url = "%s&access_token=%s" % (url, access_token)
 
         logger.info("Querying API. URL is `%s`" % url)
-        response = requests.get(url)
-        if (response.status_code == 503 and retry < 3):
-            time.sleep(10)
-            data = self._get_from_api(url, retry=retry+1)
-        elif (response.status_code == 503 and retry >= 3):
-            # Could not retrieve after many attempts
-            raise APIGramException(response.content)
-        elif (response.status_code != 200):
+        response = self._request('get', url)
+        if (response.status_code != 200):
             logger.error("Unexpected response from Instagram API. Status code is `%s`" % response.status_code)
             logger.error("Message is: %s" % response.content)
             raise APIGramException(response.content)
@@ -64,15 +128,13 @@ class InstagramAPI(object):
             response_data = json.loads(response.content)
         except ValueError:
             raise APIGramException("Data could not be parsed to json: %s" % response.content)
-        InstagramRequest().save()
         return response_data
 
     def _post_to_api(self, url, data):
         """ Posts data to the instagram API
         """
         logger.debug("Querying API. URL is `%s`, data is `%s`" % (url, data))
-        r = requests.post(url, data=data)
-        InstagramRequest().save()
+        r = self._request('post', url, data=data)
         if r.status_code != 200:
             logger.error("Access token not given. Response is: %s" % r.content)
             raise Exception("Access token could not be given: %s" % r.content)
@@ -85,19 +147,47 @@ class InstagramAPI(object):
         """
         logger.debug("Obtaining publications by location %s, %s" % (lat, lng))
 
-        url = "https://api.instagram.com/v1/media/search?lat=%s"\
-              "&lng=%s&distance=%s" % (lat, lng, radius)
+        url = "%s/v1/media/search?lat=%s"\
+              "&lng=%s&distance=%s" % (self.base_url, lat, lng, radius)
         return self._get_from_api(url)
 
-    def getLocations(self, lat, lng, radius=750):
+    def getLocations(self, lat, lng, radius=750, cached=True, refresh=False):
         """ Obtains a list of locations around the point passed by parameter.
+        Results are kept in the shared cache for LOCATION_CACHE_TTL seconds, keyed by the geohash cell of the point
+        and the radius. So every point of the cell can share the search, it is done from the center of the cell
+        and grown by the distance from the center to the corners of the cell (~100 meters with the default
+        precision), then the locations farther than radius from the point are discarded. Callers covering an area
+        with circles get exactly the locations of their circles. With refresh, the API is queried and the cache
+        updated.
         Example:
         >>> api.getLocations(42.2, 2.12)
         [...]
         """
+        from instanalysis.geo import distance_meters, geohash_encode, geohash_center, geohash_radius
+
+        if not cached:
+            return self._search_locations(lat, lng, radius)
+        cell = geohash_encode(lat, lng, settings.LOCATION_CACHE_GEOHASH_PRECISION)
+        key = "instagram:nearby:%s:%s" % (cell, radius)
+        data = cache.get(key) if not refresh else None
+        if data is not None:
+            logger.debug("Locations nearby %s, %s obtained from the cache" % (lat, lng))
+        else:
+            center_lat, center_lng = geohash_center(cell)
+            data = self._search_locations(center_lat, center_lng, int(math.ceil(radius + geohash_radius(cell))))
+            if data.get('data') is not None:
+                cache.set(key, data, settings.LOCATION_CACHE_TTL)
+        if data.get('data') is None:
+            return data
+        data = dict(data)
+        data['data'] = [location for location in data['data']
+                        if distance_meters(lat, lng, location['latitude'], location['longitude']) <= radius]
+        return data
+
+    def _search_locations(self, lat, lng, radius):
         logger.debug("Obtaining locations nearby %s, %s" % (lat, lng))
-        url = "https://api.instagram.com/v1/locations/search?lat=%s"\
-              "&lng=%s&distance=%s" % (lat, lng, radius)
+        url = "%s/v1/locations/search?lat=%s"\
+              "&lng=%s&distance=%s" % (self.base_url, lat, lng, radius)
         return self._get_from_api(url)
 
     def getLatestPostsInfo(self, location_id, min_id=None, is_adhoc=False, start_date=None):
@@ -105,7 +195,74 @@ class InstagramAPI(object):
         When min_id is provided, the function returns ALL publications created after the publication's id defined
         by min_id. When this parameter is not provided, only the latest results are provided. However, if the
         result is adhoc, we obtain all results and stop when we get posts after start_date
+        All pages are kept in memory, use iterLatestPostsPages to process them as they arrive.
+        """
+        media = []
+        for page in self.iterLatestPostsPages(location_id, min_id=min_id, is_adhoc=is_adhoc, start_date=start_date):
+            media += page
+
+        new_min_id = media[0]['id'] if len(media) > 0 else None
+
+        return (media, new_min_id)
+
+    def iterLatestPostsPages(self, location_id, min_id=None, is_adhoc=False, start_date=None, prefetch=False):
+        """ Same as getLatestPostsInfo, but yields the pages of media (lists of posts) as they arrive, newest first.
+        The new min_id is the id of the first post of the first page. Raises APIGramException if a page can not be
+        obtained, after yielding the previous ones.
+        When prefetch is True, the next page is downloaded in a background thread while the caller processes the
+        current one.
+        """
+        pages = self._iter_pages(location_id, min_id, is_adhoc, start_date)
+        if not prefetch:
+            return pages
+        return self._prefetch(pages)
+
+    def _prefetch(self, pages):
+        """ Consumes the generator passed by parameter in a background thread, one item ahead of the caller. If the
+        caller stops early (an error, or the generator is closed) the thread stops at its next page
         """
+        from django.db import close_old_connections
+
+        finished = object()
+        queue = Queue(maxsize=1)
+        stop = threading.Event()
+
+        def put(item):
+            # Waits for the caller in short steps, so the thread does not block forever once it is gone
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for page in pages:
+                    if not put((page, None)):
+                        return
+            except Exception as e:
+                put((None, e))
+            finally:
+                put((finished, None))
+                close_old_connections()
+
+        thread = threading.Thread(target=produce)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                page, error = queue.get()
+                if error is not None:
+                    raise error
+                if page is finished:
+                    break
+                yield page
+        finally:
+            stop.set()
+
+    def _iter_pages(self, location_id, min_id, is_adhoc, start_date):
         from instanalysis.utils import created_from_timestamp_instagram
 
         logger.debug("Obtaining media from Instagram's location `%s`, min_id is `%s`" % (location_id, min_id))
@@ -113,30 +270,26 @@ class InstagramAPI(object):
         # We check if this is the first retirval of data for this location
         # Id that is the case, we do not do more queries as instagram API returns the 
         # URL for the next page. We would be asking for all past media for this event
-        is_first_query = min_id is None or min_id == ''
         min_id_parameter = "min_id=%s" % min_id if min_id is not None else "min_id="
-        url = "https://api.instagram.com/v1/locations/%s/media/recent?count=200&%s" % (location_id, min_id_parameter)
-        media = []
+        url = "%s/v1/locations/%s/media/recent?count=200&%s" % (self.base_url, location_id, min_id_parameter)
         condition = True
         pages = 10
         while condition:
-            try:
-                data = self._get_from_api(url)
-            except APIGramException:
-                break
+            # Errors are raised, not swallowed: the caller must not take a partial download as complete, or the
+            # new min_id would skip the pages not downloaded
+            data = self._get_from_api(url)
             # We only use pagination on subsequent calls on certain situation.
-            try:
-                data['data']
-            except KeyError:
-                break
+            if 'data' not in data or data['data'] is None:
+                raise APIGramException("No data retrieved from instagram for location `%s`. Returned message is %s" %
+                                       (location_id, data.get('meta', {}).get('error_message')))
             if len(data['data']) > 0:
                 date_first_post = created_from_timestamp_instagram(data['data'][0]['created_time'])
                 date_first_post = datetime(date_first_post.year, date_first_post.month, date_first_post.day)
             else:
                 date_first_post = datetime(2000, 1, 1)
             is_city_search_and_is_page_under_ten = (pages > 0)
-            there_is_pagination = 'pagination' in data and bool(data['pagination'])
-            is_within_range = data['data'] is not None and start_date is not None and date_first_post >= start_date_d
+            there_is_pagination = bool((data.get('pagination') or {}).get('next_url'))
+            is_within_range = start_date is not None and date_first_post >= start_date_d
             logger.info("First date of posting is `%s`. Start date is: `%s`" % (date_first_post, start_date))
             logger.info("Page number is aboce 0 %s" % is_city_search_and_is_page_under_ten)
             logger.info("Pagination? %s" % there_is_pagination)
@@ -148,13 +301,5 @@ class InstagramAPI(object):
             logger.debug("Condition is `%s`" % condition)
             if condition:
                 url = data['pagination']['next_url']
-            if 'data' not in data:
-                logger.warning("No data retrieved from instagram. Returned message is %s" %
-                               data['meta']['error_message'])
-            else:
-                media += data['data']
+            yield data['data']
             pages = pages - 1
-
-        new_min_id = media[0]['id'] if len(media) > 0 else None
-
-        return (media, new_min_id)
@@ -0,0 +1,211 @@
+""" Local stand-in for the Instagram API, used to exercise and benchmark the ingestion without the real API.
+It serves /v1/locations/search and /v1/locations/<id>/media/recent, with pagination, from synthetic data or from
+JSON fixtures with the format:
+
+    {"locations": [<locations as returned by /v1/locations/search>],
+     "media": {"<location id>": [<media as returned by /v1/locations/<id>/media/recent>]}}
+
+Example:
+    >>> server = FakeInstagramServer(FakeData.synthetic(locations=10, posts=500), latency=0.05, error_rate=0.01)
+    >>> server.start()
+    >>> api = InstagramAPI(base_url=server.url, quota=False)
+    >>> server.stop()
+"""
+import json
+import logging
+import math
+import random
+import threading
+import time
+import urllib
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+
+logger = logging.getLogger(__name__)
+
+HASHTAGS = ['barcelona', 'madrid', 'travel', 'food', 'love', 'instagood', 'photooftheday', 'beach', 'summer',
+            'friends', 'fashion', 'art', 'sunset', 'football', 'architecture', 'spain', 'nofilter', 'music',
+            'party', 'coffee']
+
+
+def distance_meters(lat1, lng1, lat2, lng2):
+    """ Haversine distance between two points in meters
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 6371000 * 2 * math.asin(math.sqrt(a))
+
+
+def media_key(media_id):
+    """ Instagram media ids look like `<number>_<user id>`, newer media have bigger numbers
+    """
+    return int(str(media_id).split('_')[0])
+
+
+class FakeData(object):
+    """ Locations and media served by the fake server. Media of every location is sorted newest first
+    """
+
+    def __init__(self, locations, media):
+        self.locations = locations
+        self.media = dict((str(location_id), sorted(posts, key=lambda m: media_key(m['id']), reverse=True))
+                          for location_id, posts in media.items())
+
+    @classmethod
+    def from_fixture(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data['locations'], data['media'])
+
+    @classmethod
+    def synthetic(cls, locations=10, posts=200, users=500, lat=41.3879, lng=2.16992, spread=0.02, seed=None):
+        """ Generates locations around a point, each one with posts spread over the last 30 days. Hashtags and
+        authors follow a skewed distribution, as in the real data
+        """
+        rnd = random.Random(seed)
+        now = int(time.time())
+        location_list = []
+        media = dict()
+        media_number = 1000000
+        for i in range(locations):
+            location_id = str(100000 + i)
+            location_list.append({"id": location_id, "name": "Fake location %s" % i,
+                                  "latitude": lat + rnd.uniform(-spread, spread),
+                                  "longitude": lng + rnd.uniform(-spread, spread)})
+            posts_location = []
+            for j in range(posts):
+                media_number += 1
+                user_id = str(int(rnd.paretovariate(1.2)) % users + 1)
+                tags = list(set(rnd.choice(HASHTAGS) if rnd.random() < 0.7 else "tag%s" % int(rnd.expovariate(0.01))
+                                for k in range(rnd.randint(0, 8))))
+                posts_location.append({
+                    "id": "%s_%s" % (media_number, user_id),
+                    "created_time": str(now - rnd.randint(0, 30 * 24 * 3600)),
+                    "type": "image" if rnd.random() < 0.9 else "video",
+                    "link": "https://www.instagram.com/p/fake%s/" % media_number,
+                    "caption": {"text": " ".join("#%s" % t for t in tags)} if rnd.random() < 0.8 else None,
+                    "likes": {"count": int(rnd.expovariate(0.05))},
+                    "user": {"id": user_id, "username": "user%s" % user_id},
+                    "tags": tags,
+                    "location": location_list[-1]
+                })
+            # Media ids grow with time
+            posts_location.sort(key=lambda m: int(m['created_time']))
+            for post, number in zip(posts_location, sorted(media_key(p['id']) for p in posts_location)):
+                post['id'] = "%s_%s" % (number, post['user']['id'])
+                post['link'] = "https://www.instagram.com/p/fake%s/" % number
+            media[location_id] = posts_location
+        return cls(location_list, media)
+
+    def dump(self, path):
+        """ Stores the data as a fixture
+        """
+        with open(path, 'w') as f:
+            json.dump({"locations": self.locations, "media": self.media}, f, indent=1, separators=(',', ': '),
+                      sort_keys=True)
+
+    def search_locations(self, lat, lng, distance):
+        return [l for l in self.locations if distance_meters(lat, lng, l['latitude'], l['longitude']) <= distance]
+
+    def recent_media(self, location_id, min_id=None, max_id=None, count=20):
+        """ Returns a page of media newer than min_id and older than max_id, and the max_id of the next page
+        """
+        posts = self.media.get(str(location_id), [])
+        if min_id:
+            posts = [p for p in posts if media_key(p['id']) > media_key(min_id)]
+        if max_id:
+            posts = [p for p in posts if media_key(p['id']) < media_key(max_id)]
+        page = posts[:count]
+        next_max_id = page[-1]['id'] if len(posts) > count else None
+        return page, next_max_id
+
+
+class FakeInstagramServer(ThreadingMixIn, HTTPServer):
+    """ HTTP server that behaves as the Instagram API.
+
+    :param data: FakeData served
+    :param latency: Seconds added to every response
+    :param error_rate: Ratio of requests answered with a 503
+    :param rate_limit: Maximum number of requests per hour, answered with a 429 when exceeded
+    """
+    daemon_threads = True
+
+    def __init__(self, data, latency=0, error_rate=0.0, rate_limit=None, host='127.0.0.1', port=0):
+        HTTPServer.__init__(self, (host, port), FakeInstagramHandler)
+        self.data = data
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.requests = []  # Timestamps of the requests received
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://%s:%s" % self.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def register_request(self):
+        """ Stores the request and returns False if the rate limit is exceeded
+        """
+        now = time.time()
+        with self.lock:
+            self.requests.append(now)
+            if self.rate_limit is None:
+                return True
+            return len([t for t in self.requests if t > now - 3600]) <= self.rate_limit
+
+
+class FakeInstagramHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_json(self, status, content):
+        body = json.dumps(content)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, error_type, message):
+        self.send_json(status, {"meta": {"code": status, "error_type": error_type, "error_message": message}})
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        if not server.register_request():
+            return self.send_error_json(429, "OAuthRateLimitException", "The maximum number of requests per hour "
+                                                                        "has been exceeded.")
+        if server.error_rate and random.random() < server.error_rate:
+            return self.send_error_json(503, "ServiceUnavailable", "Fake server error")
+
+        url = urlparse(self.path)
+        params = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+        parts = url.path.strip('/').split('/')
+        if parts == ['v1', 'locations', 'search']:
+            locations = server.data.search_locations(float(params['lat']), float(params['lng']),
+                                                     float(params.get('distance', 500)))
+            return self.send_json(200, {"meta": {"code": 200}, "data": locations})
+        if len(parts) == 5 and parts[:2] == ['v1', 'locations'] and parts[3:] == ['media', 'recent']:
+            page, next_max_id = server.data.recent_media(parts[2], min_id=params.get('min_id'),
+                                                         max_id=params.get('max_id'),
+                                                         count=int(params.get('count', 20)))
+            pagination = dict()
+            if next_max_id is not None:
+                params['max_id'] = next_max_id
+                pagination = {"next_max_id": next_max_id,
+                              "next_url": "%s%s?%s" % (server.url, url.path, urllib.urlencode(params))}
+            return self.send_json(200, {"meta": {"code": 200}, "data": page, "pagination": pagination})
+        self.send_error_json(404, "APINotFoundError", "this endpoint does not exist")
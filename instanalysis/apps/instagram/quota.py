@@ -0,0 +1,152 @@
+import logging
+import time
+import uuid
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Atomically checks the sliding window of the last hour and the token bucket. When both allow it, a token is taken
+# and the request is added to the window. Returns the seconds to wait before trying again, 0 when acquired.
+# KEYS: bucket, window. ARGV: hourly limit, burst, now, window seconds, request member
+ACQUIRE_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local window = tonumber(ARGV[4])
+local rate = limit / window
+
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now - window)
+if redis.call('ZCARD', KEYS[2]) >= limit then
+    local oldest = redis.call('ZRANGE', KEYS[2], 0, 0, 'WITHSCORES')
+    return tostring(math.max(tonumber(oldest[2]) + window - now, 0.1))
+end
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local tokens = tonumber(bucket[1])
+local timestamp = tonumber(bucket[2])
+if tokens == nil then
+    tokens = burst
+    timestamp = now
+end
+tokens = math.min(burst, tokens + math.max(0, now - timestamp) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    redis.call('ZADD', KEYS[2], now, ARGV[5])
+    redis.call('EXPIRE', KEYS[2], window)
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'timestamp', now)
+redis.call('EXPIRE', KEYS[1], window)
+return tostring(wait)
+"""
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class QuotaLimiter(object):
+    """ Instagram API quota shared by every process that calls the API. Requests are stored in a sorted set in
+    redis (sliding window of one hour), and a token bucket refilled at hourly_limit / 3600 tokens per second spreads
+    them along the hour, allowing bursts of `burst` requests. A request can only be done after acquiring it.
+
+    :param hourly_limit: Maximum number of requests in any window of one hour
+    :param burst: Maximum number of requests that can be done at once
+    """
+    window = 60 * 60
+    bucket_key = "instagram:quota:bucket"
+    window_key = "instagram:quota:requests"
+
+    def __init__(self, redis_url=None, hourly_limit=None, burst=None):
+        self.redis = redis.StrictRedis.from_url(redis_url or settings.INSTAGRAM_QUOTA_REDIS_URL)
+        self.hourly_limit = hourly_limit or settings.INSTAGRAM_HOURLY_LIMIT
+        self.burst = burst or settings.INSTAGRAM_QUOTA_BURST
+        self._acquire = self.redis.register_script(ACQUIRE_SCRIPT)
+
+    def try_acquire(self):
+        """ Tries to acquire a request. Returns the seconds to wait before trying again, 0 when acquired
+        """
+        member = "%.6f:%s" % (time.time(), uuid.uuid4().hex[:8])
+        wait = self._acquire(keys=[self.bucket_key, self.window_key],
+                             args=[self.hourly_limit, self.burst, time.time(), self.window, member])
+        return float(wait)
+
+    def acquire(self, timeout=None):
+        """ Blocks until a request can be done. Raises QuotaExceeded if it is not possible within timeout seconds.
+        When redis is not available the request is allowed, the API will reject it if we are over the limit
+        """
+        started = time.time()
+        while True:
+            try:
+                wait = self.try_acquire()
+            except redis.RedisError as e:
+                logger.error("Instagram quota could not be checked: %s" % e)
+                return
+            if wait <= 0:
+                return
+            if timeout is not None and time.time() + wait - started > timeout:
+                raise QuotaExceeded("Instagram API quota exhausted, next request in %.1f seconds" % wait)
+            logger.debug("Instagram API quota exhausted, waiting %.1f seconds" % wait)
+            time.sleep(min(wait, 5))
+
+    def requests_last_hour(self):
+        """ Returns the number of requests done in the last hour
+        """
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(self.window_key, '-inf', time.time() - self.window)
+        pipe.zcard(self.window_key)
+        return pipe.execute()[1]
+
+
+# Takes a slot of the semaphore when there are less than `limit` holders. Holders that did not release their slot
+# before its expiration (e.g. a killed worker) are discarded. Returns 1 when the slot is taken.
+# KEYS: holders. ARGV: limit, now, expiration, holder
+SLOT_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[4])
+redis.call('EXPIRE', KEYS[1], math.ceil(ARGV[3] - ARGV[2]))
+return 1
+"""
+
+
+class ConcurrencyLimiter(object):
+    """ Semaphore shared through redis by all the workers, limiting how many tasks of a kind call the Instagram API
+    at the same time. It lives next to the quota, so a burst of tasks can not starve the other consumers of it.
+
+    :param name: Name of the semaphore
+    :param limit: Maximum number of holders
+    :param expiration: Seconds after which a slot that was not released is freed
+    """
+
+    def __init__(self, name, limit, expiration=3600, redis_url=None):
+        self.redis = redis.StrictRedis.from_url(redis_url or settings.INSTAGRAM_QUOTA_REDIS_URL)
+        self.key = "instagram:slots:%s" % name
+        self.limit = limit
+        self.expiration = expiration
+        self._take = self.redis.register_script(SLOT_SCRIPT)
+
+    def acquire(self):
+        """ Returns the holder id if a slot was taken, None when all of them are in use. When redis is not available
+        the slot is granted, requests are still limited by the API client
+        """
+        holder = uuid.uuid4().hex
+        now = time.time()
+        try:
+            taken = self._take(keys=[self.key], args=[self.limit, now, now + self.expiration, holder])
+        except redis.RedisError as e:
+            logger.error("Instagram concurrency slot could not be checked: %s" % e)
+            return holder
+        return holder if taken else None
+
+    def release(self, holder):
+        try:
+            self.redis.zrem(self.key, holder)
+        except redis.RedisError as e:
+            logger.error("Instagram concurrency slot could not be released: %s" % e)
@@ -1,14 +1,17 @@
 import logging
+import redis
 
-from datetime import datetime, timedelta
-from django.db.models import Count, Sum
+from datetime import datetime
+from django.utils import timezone
+from django.db.models import Count
 from django.shortcuts import get_object_or_404
 from django.views.generic import View
 from django.db import connection
+from django.db.models.sql.datastructures import EmptyResultSet
 
-from instanalysis import api
-from instanalysis.models import City, Publication, Hashtag, InstagramUser
-from instanalysis.models import Setting, InstagramLocation, Category, PublicationADHOC
+from instanalysis import api, rollups
+from instanalysis.models import City, Publication, Hashtag, HashtagPosting, InstagramUser
+from instanalysis.models import Category, PublicationADHOC, ADHOCSearch
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +22,109 @@ class MapView(View):
     """ A class generic view to be used on the map view.
     """
 
+    def getQueriesAPI(self):
+        """ Returns the number of requests done to the Instagram API in the last hour, None if the quota can not be
+        read from redis
+        """
+        if api.quota:
+            try:
+                return api.quota.requests_last_hour()
+            except redis.RedisError:
+                logger.warning("Instagram quota could not be read from redis")
+        return None
+
+    def getStatistics(self, base_publications, publications, total_publications):
+        """ Computes the statistics of the map in a single statement. The filtered publications are materialized
+        once (CTE) and reused by every aggregate. Returns a dictionary with:
+        - num_publications, likes, num_authors and num_hashtags (distinct) of the filtered publications
+        - hashtags: top 100 hashtags of the filtered publications, as dictionaries with id, hashtag__label and count
+        - locations: positions of the locations of base_publications, and oldest_location, their oldest update
+        - total_posts: number of total_publications
+        """
+        filtered_sql, filtered_params = self.getSubquery(publications, 'id', 'likes', 'author')
+        base_sql, base_params = self.getSubquery(base_publications, 'location')
+        total_sql, total_params = self.getSubquery(total_publications, 'id')
+        sql = """
+            WITH filtered AS (SELECT DISTINCT id, likes, author_id FROM (%s) f),
+                 base_locations AS (SELECT l.position, l.updated_at FROM instanalysis_instagramlocation l
+                                    WHERE l.id IN (SELECT b.location_id FROM (%s) b)),
+                 publication_hashtags AS (SELECT hp.hashtag_id FROM instanalysis_hashtag_publications hp
+                                          JOIN filtered ON filtered.id = hp.publication_id)
+            SELECT (SELECT COUNT(*) FROM filtered),
+                   (SELECT COALESCE(SUM(likes), 0) FROM filtered),
+                   (SELECT COUNT(DISTINCT author_id) FROM filtered),
+                   (SELECT COUNT(DISTINCT hashtag_id) FROM publication_hashtags),
+                   (SELECT json_agg(t) FROM (SELECT h.id, h.label AS hashtag__label, COUNT(*) AS count
+                                             FROM publication_hashtags ph
+                                             JOIN instanalysis_hashtag h ON h.id = ph.hashtag_id
+                                             GROUP BY h.id, h.label ORDER BY count DESC LIMIT 100) t),
+                   (SELECT json_agg(json_build_object('lat', ST_Y(position), 'lng', ST_X(position)))
+                    FROM base_locations),
+                   (SELECT MIN(updated_at) FROM base_locations),
+                   (SELECT COUNT(*) FROM (%s) t)
+        """ % (filtered_sql, base_sql, total_sql)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, filtered_params + base_params + total_params)
+            row = cursor.fetchone()
+        return {"num_publications": row[0], "likes": row[1], "num_authors": row[2], "num_hashtags": row[3],
+                "hashtags": row[4] or [], "locations": row[5] or [], "oldest_location": row[6],
+                "total_posts": row[7]}
+
+    def getRollupStatistics(self, city, publications, start_date, end_date, month, weekday, hours, hashtags,
+                            exact=False):
+        """ Same statistics as getStatistics for a city, read from the rollups (see instanalysis.rollups). The
+        distinct counts, and the hashtags when the rollups do not have them, are computed from the filtered
+        publications. With exact, the top hashtags and the distinct counts are never estimated from sketches.
+        Returns None when a hashtag filtered does not exist
+        """
+        hashtag_id = None
+        if hashtags:
+            hashtag_id = Hashtag.objects.filter(label=hashtags[0]).values_list('id', flat=True).first()
+            if hashtag_id is None:
+                return None
+        statistics = rollups.city_statistics(city.id, start_date=start_date and start_date.date(),
+                                             end_date=end_date and end_date.date(), month=month, weekday=weekday,
+                                             hours=hours, hashtag_id=hashtag_id, exact=exact)
+        if statistics['num_authors'] is None:
+            statistics['num_authors'] = publications.aggregate(count=Count('author', distinct=True))['count']
+        if statistics['hashtags'] is None:
+            statistics['num_hashtags'], statistics['hashtags'] = self.getHashtagStatistics(publications)
+        elif statistics['num_hashtags'] is None:
+            statistics['num_hashtags'] = self.getHashtagStatistics(publications, top=False)[0]
+        return statistics
+
+    def getHashtagStatistics(self, publications, top=True):
+        """ Returns the number of distinct hashtags of the publications and the top 100, as in getStatistics (None
+        without top)
+        """
+        filtered_sql, filtered_params = self.getSubquery(publications, 'id')
+        top_sql = "NULL"
+        if top:
+            top_sql = """(SELECT json_agg(t) FROM (SELECT h.id, h.label AS hashtag__label, COUNT(*) AS count
+                                                   FROM publication_hashtags ph
+                                                   JOIN instanalysis_hashtag h ON h.id = ph.hashtag_id
+                                                   GROUP BY h.id, h.label ORDER BY count DESC LIMIT 100) t)"""
+        sql = """
+            WITH publication_hashtags AS (SELECT hp.hashtag_id FROM instanalysis_hashtag_publications hp
+                                          WHERE hp.publication_id IN (SELECT f.id FROM (%s) f))
+            SELECT (SELECT COUNT(DISTINCT hashtag_id) FROM publication_hashtags), %s
+        """ % (filtered_sql, top_sql)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, filtered_params)
+            row = cursor.fetchone()
+        return row[0], (row[1] or []) if top else None
+
+    def getSubquery(self, queryset, *fields):
+        """ Returns the SQL and params selecting the fields of the queryset. Empty querysets (.none()) have no SQL,
+        a query without rows is returned instead
+        """
+        try:
+            return queryset.values(*fields).query.sql_with_params()
+        except EmptyResultSet:
+            columns = ", ".join("NULL::integer AS %s" % queryset.model._meta.get_field(field).column
+                                for field in fields)
+            return "SELECT %s WHERE false" % columns, ()
+
     def getMapInfo(self, request, adhoc_search=None):
         """ Returns the map information to be used in the view. When no queries are performed, we just
         return the information in order to center the map on Spain, without markers and any sourrinding stuff.
@@ -49,7 +155,10 @@ class MapView(View):
         except ValueError:
             slot = None
         is_adhoc = request.GET.get('latitude', '') != ''
+        # Exports, or `exact`, count the statistics of the publications instead of estimating them from sketches
+        exact = request.GET.get('exact') == '1' or request.GET.get('export') == '1'
         radius_pivots = 750
+        city = None
         if is_adhoc and request.GET.get('adhoc_id', '') != '':
             # Getting results of an adhoc_search
             adhoc_id = request.GET.get('adhoc_id')  # here!!! result
@@ -58,15 +167,13 @@ class MapView(View):
             pivots = [map_center]
             showpivots = True
             radius_pivots = int(750 if request.GET.get('radius', '') == '' else request.GET.get('radius'))
-            publications = Publication.objects.filter(adhocsearch__id=int(adhoc_id))
-            locations_q = InstagramLocation.objects.filter(id__in=publications.values('location_id'))
+            publications = get_object_or_404(ADHOCSearch, id=int(adhoc_id)).publications()
         elif location is None:
             # Default query, initial view
             map_center = {"lat": 40.421363, "lng": -3.727398}
             zoom = 6
             pivots = []
             publications = Publication.objects.none()
-            locations_q = InstagramLocation.objects.none()
         else:
             # Searching by a city
             city = get_object_or_404(City, name=location)
@@ -78,82 +185,83 @@ class MapView(View):
                            } for l in city.spot_set.all()]
             else:
                 pivots = []
-            publications = Publication.objects.filter(location__spot__city__name=location)
-            locations_q = InstagramLocation.objects.filter(id__in=publications.values('location_id'))
-        # Before filtering, we get the oldest location without updating
-        last_location_to_update = publications.order_by('location__updated_at').first()
-        if last_location_to_update is not None and last_location_to_update.location is not None:
-            oldest_location = last_location_to_update.location.updated_at.strftime("%d/%m/%Y %H:%M")
-        else:
-            oldest_location = None
+            publications = Publication.objects.of_city(location)
+        # Locations and the oldest location without updating are taken before filtering
+        base_publications = publications
 
         # Filters
+        start_date = end_date = hours = None
         if request.GET.get('start_date', '') != '':
             logger.debug("Filtering by start_date `%s`" % request.GET.get('start_date', ''))
             start_date = datetime.strptime(request.GET.get('start_date'), "%d/%m/%Y")
-            publications = publications.filter(publication_date__gte=start_date)
+            publications = publications.filter(local_date__gte=start_date.date())
 
         if request.GET.get('end_date', '') != '':
             logger.debug("Filtering by end_date `%s`" % request.GET.get('end_date', ''))
             end_date = datetime.strptime(request.GET.get('end_date'), "%d/%m/%Y")
-            next_day = end_date + timedelta(hours=24)
-            # adding 24 hours 
-            publications = publications.filter(publication_date__lte=next_day)
-        if request.GET.getlist('hashtag', '') != '':
-            logger.debug("Filtering by hashtag `%s`" % request.GET.get('hashtag', ''))
+            publications = publications.filter(local_date__lte=end_date.date())
+        # Publications with all the `hashtag`, any of the `hashtag_any` and none of the `hashtag_not`
+        hashtags_any, hashtags_not = request.GET.getlist('hashtag_any'), request.GET.getlist('hashtag_not')
+        if request.GET.getlist('hashtag') or hashtags_any or hashtags_not:
+            logger.debug("Filtering by hashtags `%s`, any of `%s`, none of `%s`" %
+                         (request.GET.getlist('hashtag'), hashtags_any, hashtags_not))
             using_filters = True
-            for el in request.GET.getlist('hashtag', ''):
-                publications = publications.filter(hashtag__label=el)
+            publications = HashtagPosting.objects.filter_publications(publications, city.id if city else None,
+                                                                      request.GET.getlist('hashtag'),
+                                                                      hashtags_any, hashtags_not)
         if request.GET.get('category', '') != '':
             logger.debug("Filtering by category `%s`" % request.GET.get('category', ''))
             using_filters = True
-            logger.debug("Publications before filtering: %s" % publications.count())
-            publications = publications.filter(hashtag__categories__label__in=request.GET.getlist('category'))
-            logger.debug("Publications after filtering: %s" % publications.count())
+            category_ids = list(Category.objects.filter(label__in=request.GET.getlist('category'))
+                                                .values_list('id', flat=True))
+            publications = publications.filter(category_ids__overlap=category_ids)
         if month is not None:
             logger.debug("Filtering by month `%s`" % month)
             using_filters = True
             logger.debug("Filtering publications by date range: %s" % month)
-            publications = publications.filter(publication_date__month__gte= month,
-                                               publication_date__month__lte= month)
+            publications = publications.filter(local_month=month)
         if day is not None:
             logger.debug("Filtering by day `%s`" % day)
             using_filters = True
             logger.debug("Filtering publications by day range: %s" % day)
-            publications = publications.filter(publication_date__week_day= day)
+            publications = publications.filter(local_weekday=day)
         if slot is not None:
             logger.debug("Filtering by slot `%s`" % slot)
             using_filters = True
-            hours_range = ",".join([str(l + ((slot - 1) * 6)) for l in range(0, 6)])
+            hours = [l + ((slot - 1) * 6) for l in range(0, 6)]
+            hours_range = ",".join([str(hour) for hour in hours])
             logger.debug("Filtering publications by slot range: %s" % hours_range)
-            publications = publications.extra(where=['extract(hour from publication_date) in (%s)' % hours_range])
+            publications = publications.filter(local_hour__in=hours)
         using_filters = False
-        likes = publications.aggregate(total_likes=Sum('likes')).get('total_likes', 0)
-        if likes is None:
-            likes = 0
-        elif likes > 1000 * 1000:
+        statistics = None
+        if city is not None and not hashtags_any and not hashtags_not and \
+                rollups.can_answer(request.GET.getlist('hashtag'), request.GET.getlist('category'), hours):
+            statistics = self.getRollupStatistics(city, publications, start_date, end_date, month, day, hours,
+                                                  request.GET.getlist('hashtag'), exact=exact)
+        if statistics is None:
+            statistics = self.getStatistics(base_publications, publications, Publication.objects.of_city(location))
+        likes = statistics['likes']
+        if likes > 1000 * 1000:
             likes = "%sk" % (likes/1000)
-
-        # This query requires a lot of operations: GROUP BY and COUNT.
-        # This 
-        # cursor.execute("set work_mem = '250MB';")
-        # cursor.execute('SHOW work_mem')
-        hashtags = publications.values('hashtag__label').annotate(count=Count('hashtag')).order_by('-count')[0:100]
+        if statistics['oldest_location'] is not None:
+            oldest_location = timezone.localtime(statistics['oldest_location']).strftime("%d/%m/%Y %H:%M")
+        else:
+            oldest_location = None
+        hashtags = statistics['hashtags']
         data = ({
             "last_location_update": oldest_location,
             "zoom": zoom,
             "center": map_center,
-            "locations": [{'lat': l['position'].y, 'lng': l['position'].x} for l in locations_q.values('position')],
+            "locations": statistics['locations'],
             "pivots": pivots,
             "showpivots": showpivots,
             "showlocations": showlocations,
-            "num_publications": publications.count(),
-            "num_authors": publications.values('author').annotate(count=Count('author')).count(),
-            # HERE!!!! Change the author to display the number of authors in this query!!!!
-            "queries_api": Setting.objects.get_value('instagram_hourly'),
-            "total_posts": Publication.objects.filter(location__spot__city__name=location).count(),
-            "num_hashtags": Hashtag.objects.filter(publications__id__in=publications.values('id')).count(),
-            "likes": 0 if likes is None else likes,
+            "num_publications": statistics['num_publications'],
+            "num_authors": statistics['num_authors'],
+            "queries_api": self.getQueriesAPI(),
+            "total_posts": statistics['total_posts'],
+            "num_hashtags": statistics['num_hashtags'],
+            "likes": likes,
             "all_categories": list(Category.objects.all().values('label')),
             "using_filters": using_filters,  # Determining if filters are used,
             "radius_pivots": radius_pivots,
@@ -0,0 +1,249 @@
+""" Compressed bitmaps of non negative integers (publication ids), laid out as Roaring bitmaps: values are split by
+their high bits in containers of 65536 values. Containers with up to ARRAY_MAX values are sorted arrays of the low 16
+bits, denser containers are bitsets (a Python long of 65536 bits, whose bitwise operations run in C).
+Operations work container by container, and only on the containers both bitmaps have.
+
+Example:
+    >>> a, b = RoaringBitmap([1, 5, 70000]), RoaringBitmap([5, 70000, 70001])
+    >>> list(a & b), list(a | b), list(a - b)
+    ([5, 70000], [1, 5, 70000, 70001], [1])
+    >>> RoaringBitmap.from_bytes((a | b).to_bytes()) == a | b
+    True
+"""
+import binascii
+import bisect
+import struct
+
+CONTAINER_SIZE = 1 << 16
+ARRAY_MAX = 4096  # Above this, a bitset (8 kB) is smaller than an array of 16 bit values
+BITSET_BYTES = CONTAINER_SIZE / 8
+
+_ARRAY, _BITSET = 0, 1
+
+# Positions of the bits set in every byte
+_BYTE_BITS = [[bit for bit in range(8) if byte >> bit & 1] for byte in range(256)]
+
+
+def _bitset_to_bytes(bits):
+    """ Little endian bytes of the bitset, byte i holds values 8 * i to 8 * i + 7
+    """
+    return binascii.unhexlify('%0*x' % (BITSET_BYTES * 2, bits))[::-1]
+
+
+def _bitset_from_bytes(data):
+    return long(binascii.hexlify(data[::-1]), 16)
+
+
+def _bitset_from_array(values):
+    data = bytearray(BITSET_BYTES)
+    for value in values:
+        data[value >> 3] |= 1 << (value & 7)
+    return _bitset_from_bytes(str(data))
+
+
+def _bitset_values(bits):
+    values = []
+    for index, byte in enumerate(bytearray(_bitset_to_bytes(bits))):
+        if byte:
+            base = index << 3
+            values.extend(base + bit for bit in _BYTE_BITS[byte])
+    return values
+
+
+def _cardinality(container):
+    if isinstance(container, list):
+        return len(container)
+    return bin(container).count('1')
+
+
+def _normalize(container):
+    """ Returns the container in its smallest form, None when it is empty
+    """
+    if isinstance(container, list):
+        if len(container) > ARRAY_MAX:
+            return _bitset_from_array(container)
+        return container or None
+    if not container:
+        return None
+    if _cardinality(container) <= ARRAY_MAX:
+        return _bitset_values(container)
+    return container
+
+
+def _contains(container, low):
+    if isinstance(container, list):
+        index = bisect.bisect_left(container, low)
+        return index < len(container) and container[index] == low
+    return bool(container >> low & 1)
+
+
+def _and(a, b):
+    if isinstance(a, list) and isinstance(b, list):
+        return sorted(set(a).intersection(b))
+    if isinstance(a, list) or isinstance(b, list):
+        values, bits = (a, b) if isinstance(a, list) else (b, a)
+        data = bytearray(_bitset_to_bytes(bits))
+        return [v for v in values if data[v >> 3] >> (v & 7) & 1]
+    return a & b
+
+
+def _or(a, b):
+    if isinstance(a, list) and isinstance(b, list):
+        return sorted(set(a).union(b))
+    return (_bitset_from_array(a) if isinstance(a, list) else a) | (_bitset_from_array(b) if isinstance(b, list) else b)
+
+
+def _andnot(a, b):
+    if isinstance(a, list):
+        if isinstance(b, list):
+            return sorted(set(a).difference(b))
+        data = bytearray(_bitset_to_bytes(b))
+        return [v for v in a if not data[v >> 3] >> (v & 7) & 1]
+    return a & ~(_bitset_from_array(b) if isinstance(b, list) else b)
+
+
+def serialize_container(container):
+    """ Bytes of a container: a type byte, then the values (unsigned 16 bit little endian) or the bitset
+    """
+    if isinstance(container, list):
+        return struct.pack('<B%dH' % len(container), _ARRAY, *container)
+    return struct.pack('<B', _BITSET) + _bitset_to_bytes(container)
+
+
+def deserialize_container(data):
+    data = str(data)
+    if struct.unpack_from('<B', data)[0] == _ARRAY:
+        return list(struct.unpack_from('<%dH' % ((len(data) - 1) / 2), data, 1))
+    return _bitset_from_bytes(data[1:])
+
+
+class RoaringBitmap(object):
+    """ Set of non negative integers. Supports &, |, - (and not), len, in and iteration in ascending order.
+
+    :param values: Initial values
+    """
+
+    def __init__(self, values=()):
+        self.containers = dict()  # High bits -> container
+        self.update(values)
+
+    @classmethod
+    def from_containers(cls, containers):
+        """ Bitmap with the containers passed by parameter, a dictionary high bits -> container
+        """
+        bitmap = cls()
+        for key, container in containers.items():
+            container = _normalize(container)
+            if container is not None:
+                bitmap.containers[key] = container
+        return bitmap
+
+    def update(self, values):
+        """ Adds the values passed by parameter
+        """
+        grouped = dict()
+        for value in values:
+            grouped.setdefault(value >> 16, []).append(value & 0xFFFF)
+        for key, lows in grouped.items():
+            lows = sorted(set(lows))
+            current = self.containers.get(key)
+            self.containers[key] = _normalize(lows if current is None else _or(current, lows))
+
+    def _combine(self, other, operation, keys):
+        containers = dict()
+        for key in keys:
+            container = _normalize(operation(self.containers[key], other.containers[key]))
+            if container is not None:
+                containers[key] = container
+        bitmap = RoaringBitmap()
+        bitmap.containers = containers
+        return bitmap
+
+    def __and__(self, other):
+        return self._combine(other, _and, set(self.containers).intersection(other.containers))
+
+    def __or__(self, other):
+        result = self._combine(other, _or, set(self.containers).intersection(other.containers))
+        for source in (self, other):
+            for key, container in source.containers.items():
+                result.containers.setdefault(key, container)
+        return result
+
+    def __sub__(self, other):
+        result = self._combine(other, _andnot, set(self.containers).intersection(other.containers))
+        for key, container in self.containers.items():
+            if key not in other.containers:
+                result.containers[key] = container
+        return result
+
+    @classmethod
+    def intersection(cls, bitmaps):
+        """ Intersection of the bitmaps passed by parameter, the smallest ones are intersected first
+        """
+        bitmaps = sorted(bitmaps, key=len)
+        if not bitmaps:
+            return cls()
+        result = bitmaps[0]
+        for bitmap in bitmaps[1:]:
+            if not result:
+                break
+            result = result & bitmap
+        return result
+
+    @classmethod
+    def union(cls, bitmaps):
+        result = cls()
+        for bitmap in bitmaps:
+            result = result | bitmap
+        return result
+
+    def __len__(self):
+        return sum(_cardinality(container) for container in self.containers.values())
+
+    def __nonzero__(self):
+        return bool(self.containers)
+
+    def __contains__(self, value):
+        container = self.containers.get(value >> 16)
+        return container is not None and _contains(container, value & 0xFFFF)
+
+    def __iter__(self):
+        for key in sorted(self.containers):
+            container = self.containers[key]
+            base = key << 16
+            for low in (container if isinstance(container, list) else _bitset_values(container)):
+                yield base + low
+
+    def __eq__(self, other):
+        return isinstance(other, RoaringBitmap) and self.containers == other.containers
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<RoaringBitmap: %s values in %s containers>" % (len(self), len(self.containers))
+
+    def to_bytes(self):
+        """ Bytes of the bitmap: for every container, its high bits and its length (unsigned 32 bit little endian)
+        followed by the container (see serialize_container)
+        """
+        parts = []
+        for key in sorted(self.containers):
+            data = serialize_container(self.containers[key])
+            parts.append(struct.pack('<II', key, len(data)))
+            parts.append(data)
+        return "".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = str(data)
+        containers = dict()
+        offset = 0
+        while offset < len(data):
+            key, length = struct.unpack_from('<II', data, offset)
+            offset += 8
+            containers[key] = deserialize_container(data[offset:offset + length])
+            offset += length
+        bitmap = cls()
+        bitmap.containers = containers
+        return bitmap
@@ -0,0 +1,97 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """ Bounded dictionary that evicts the least recently used keys when it is full. It is safe to share it
+    between threads and it counts hits and misses, so we can check how useful it is.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """ Returns the value stored for key, or default when it is not cached
+        """
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        """ Returns a dictionary with the keys that are cached and their values
+        """
+        found = dict()
+        with self._lock:
+            for key in keys:
+                try:
+                    value = self._data.pop(key)
+                except KeyError:
+                    self.misses += 1
+                    continue
+                # Moving the key to the end, it is the most recently used now
+                self._data[key] = value
+                found[key] = value
+                self.hits += 1
+        return found
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, mapping):
+        """ Stores all the key -> value pairs of the dictionary, evicting the least recently used keys if needed
+        """
+        with self._lock:
+            for key, value in mapping.items():
+                self._data.pop(key, None)
+                self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """ Returns the usage counters of the cache
+        """
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": float(self.hits) / lookups if lookups > 0 else 0.0
+        }
+
+
+# Process-local caches used when ingesting media. New ids are only stored once their rows are committed.
+# label -> Hashtag id
+hashtag_ids_cache = LRUCache(getattr(settings, 'HASHTAG_ID_CACHE_SIZE', 50000))
+# instagramID -> InstagramUser id
+instagram_user_ids_cache = LRUCache(getattr(settings, 'INSTAGRAM_USER_ID_CACHE_SIZE', 50000))
+
+
+def identity_cache_stats():
+    """ Returns the counters of the identity caches
+    """
+    return {
+        "hashtags": hashtag_ids_cache.stats(),
+        "users": instagram_user_ids_cache.stats()
+    }
@@ -0,0 +1,124 @@
+import logging
+
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of rows inserted by a single statement
+INSERT_BATCH_SIZE = 500
+
+# Rows fetched per round trip by stream
+STREAM_BATCH_SIZE = 10000
+
+
+def insert_ignore_conflicts(model, objs, fields, returning=None):
+    """ Inserts the model instances passed by parameter with INSERT ... ON CONFLICT DO NOTHING, so rows that would
+    violate a unique index are skipped instead of aborting the transaction. Only the fields passed by parameter are
+    inserted (fields that set their value when saving, as `created`, are supported).
+    When returning is a list of field names, returns a list of tuples with their values for the inserted rows.
+    """
+    objs = list(objs)
+    opts = model._meta
+    model_fields = [opts.get_field(name) for name in fields]
+    columns = ", ".join(connection.ops.quote_name(f.column) for f in model_fields)
+    returning_sql = ""
+    if returning:
+        returning_sql = " RETURNING %s" % ", ".join(connection.ops.quote_name(opts.get_field(name).column)
+                                                    for name in returning)
+    placeholders = "(%s)" % ", ".join(["%s"] * len(model_fields))
+    result = []
+    with connection.cursor() as cursor:
+        for start in range(0, len(objs), INSERT_BATCH_SIZE):
+            batch = objs[start:start + INSERT_BATCH_SIZE]
+            params = []
+            for obj in batch:
+                params.extend(f.get_db_prep_save(f.pre_save(obj, True), connection) for f in model_fields)
+            sql = "INSERT INTO %s (%s) VALUES %s ON CONFLICT DO NOTHING%s" % (
+                connection.ops.quote_name(opts.db_table), columns, ", ".join([placeholders] * len(batch)),
+                returning_sql)
+            cursor.execute(sql, params)
+            if returning:
+                result.extend(cursor.fetchall())
+    return result
+
+
+def upsert(model, objs, fields, conflict, update_fields, conflict_where=None, compare=None):
+    """ Inserts the model instances passed by parameter with INSERT ... ON CONFLICT DO UPDATE. Rows that already exist
+    (same values of the conflict fields, with the index predicate conflict_where) get the update_fields updated, only
+    when any of them changed. compare is a dictionary field name -> SQL template comparing two values of the field,
+    as "%s = %s", used instead of IS NOT DISTINCT FROM (needed for geometries, whose = compares bounding boxes).
+    Returns a list of tuples (pk, inserted) of the rows inserted or changed, rows without changes are not returned.
+    objs must not repeat values of the conflict fields.
+    """
+    objs = list(objs)
+    opts = model._meta
+    qn = connection.ops.quote_name
+    model_fields = [opts.get_field(name) for name in fields]
+    columns = ", ".join(qn(f.column) for f in model_fields)
+    conflict_sql = "(%s)" % ", ".join(qn(opts.get_field(name).column) for name in conflict)
+    if conflict_where:
+        conflict_sql += " WHERE %s" % conflict_where
+    table = qn(opts.db_table)
+    assignments = []
+    changes = []
+    for name in update_fields:
+        column = qn(opts.get_field(name).column)
+        current, excluded = "%s.%s" % (table, column), "EXCLUDED.%s" % column
+        assignments.append("%s = %s" % (column, excluded))
+        if compare and name in compare:
+            changes.append("NOT (%s)" % (compare[name] % (current, excluded)))
+        else:
+            changes.append("%s IS DISTINCT FROM %s" % (current, excluded))
+    # The system column xmax is 0 for the rows inserted by the statement
+    sql_template = "INSERT INTO %s (%s) VALUES %%s ON CONFLICT %s DO UPDATE SET %s WHERE %s RETURNING %s, xmax = 0" \
+        % (table, columns, conflict_sql, ", ".join(assignments), " OR ".join(changes), qn(opts.pk.column))
+    placeholders = "(%s)" % ", ".join(["%s"] * len(model_fields))
+    result = []
+    with connection.cursor() as cursor:
+        for start in range(0, len(objs), INSERT_BATCH_SIZE):
+            batch = objs[start:start + INSERT_BATCH_SIZE]
+            params = []
+            for obj in batch:
+                params.extend(f.get_db_prep_save(f.pre_save(obj, True), connection) for f in model_fields)
+            cursor.execute(sql_template % ", ".join([placeholders] * len(batch)), params)
+            result.extend(cursor.fetchall())
+    return result
+
+
+def bulk_update(model, objs, fields):
+    """ Updates the fields passed by parameter of the model instances in a single statement per batch, with
+    UPDATE ... FROM (VALUES ...)
+    """
+    objs = list(objs)
+    opts = model._meta
+    qn = connection.ops.quote_name
+    model_fields = [opts.pk] + [opts.get_field(name) for name in fields]
+    table = qn(opts.db_table)
+    columns = ", ".join(qn(f.column) for f in model_fields)
+    assignments = ", ".join("%s = v.%s" % (qn(f.column), qn(f.column)) for f in model_fields[1:])
+    placeholders = "(%s)" % ", ".join(["%s"] * len(model_fields))
+    with connection.cursor() as cursor:
+        for start in range(0, len(objs), INSERT_BATCH_SIZE):
+            batch = objs[start:start + INSERT_BATCH_SIZE]
+            params = []
+            for obj in batch:
+                params.extend(f.get_db_prep_save(getattr(obj, f.attname), connection) for f in model_fields)
+            cursor.execute("UPDATE %s SET %s FROM (VALUES %s) AS v (%s) WHERE %s.%s = v.%s" % (
+                table, assignments, ", ".join([placeholders] * len(batch)), columns, table, qn(opts.pk.column),
+                qn(opts.pk.column)), params)
+
+
+def stream(sql, params, name):
+    """ Iterates over the rows of the query passed by parameter with a server-side cursor of the given name, so they
+    are fetched in batches instead of loaded at once. Has to be used within a transaction, other statements can run
+    while iterating
+    """
+    connection.ensure_connection()
+    cursor = connection.connection.cursor(name=name)
+    cursor.itersize = STREAM_BATCH_SIZE
+    try:
+        cursor.execute(sql, params)
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
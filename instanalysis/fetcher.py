@@ -0,0 +1,130 @@
+import logging
+import threading
+import time
+from Queue import Queue
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from instanalysis.scheduler import PollScheduler
+
+logger = logging.getLogger("worker_publications")
+
+
+class ConcurrentFetcher(object):
+    """ Keeps several locations being downloaded from Instagram at the same time. Locations are taken from a
+    PollScheduler when they are due. Fetcher threads query the API and hand every page, as soon as it arrives, to a
+    bounded set of writer threads, that store them in the database. All pages of a location go to the same writer,
+    so they are stored in order. Requests are limited by the quota shared by all the processes (see
+    instanalysis.apps.instagram.quota), so adding fetchers speeds up a sweep until the quota is the bottleneck.
+
+    :param concurrency: Number of locations downloaded at the same time
+    :param writers: Number of threads storing publications in the database
+    :param interval: Minimum number of seconds between the starts of two locations downloaded by the same fetcher
+    """
+
+    def __init__(self, concurrency=1, writers=1, interval=0):
+        self.concurrency = concurrency
+        self.writers = writers
+        self.interval = interval
+        self.pending = Queue(maxsize=concurrency)
+        self.fetched = [Queue(maxsize=4) for i in range(writers)]
+        self.in_flight = set()
+        self.errors = dict()  # location id -> time of the error
+        self.lock = threading.Lock()
+        self.scheduler = PollScheduler()
+
+    def next_location(self):
+        """ Returns the location whose update is most overdue and is not being processed
+        """
+        with self.lock:
+            excluded = set(self.in_flight) | set(self.errors.keys())
+        return self.scheduler.next_location(exclude=excluded)
+
+    def release(self, location, error=False):
+        with self.lock:
+            self.in_flight.discard(location.id)
+            if error:
+                self.errors[location.id] = timezone.now()
+            else:
+                self.errors.pop(location.id, None)
+
+    def clear_errors(self):
+        """ Locations with errors are tried again
+        """
+        with self.lock:
+            self.errors = dict()
+
+    def fetch(self):
+        """ Fetcher thread: downloads the posts of the locations in the pending queue
+        """
+        while True:
+            location = self.pending.get()
+            fetched = self.fetched[location.id % self.writers]
+            started = time.time()
+            new_min_id = None
+            try:
+                for page in location.fetch_latest_pages():
+                    if new_min_id is None and page:
+                        new_min_id = page[0]['id']
+                    fetched.put((location, page, False))
+            except Exception as e:
+                logger.error("There is an error getting media for location: %s. Error is `%s`" % (location.id, e))
+                fetched.put((location, None, True))
+            else:
+                fetched.put((location, new_min_id, True))
+            finally:
+                close_old_connections()
+            time_to_process = time.time() - started
+            if time_to_process < self.interval:
+                time.sleep(self.interval - time_to_process)
+
+    def write(self, fetched):
+        """ Writer thread: stores the pages downloaded by the fetchers. The last item of every location tells the
+        new min_id, or None if the download failed. min_id is only moved forward when every page was downloaded and
+        stored, otherwise the location is released with an error and the next update starts from the previous min_id
+        """
+        publications = dict()  # location id -> publications stored
+        failed = set()  # ids of the locations with pages that could not be stored
+        while True:
+            location, data, finished = fetched.get()
+            try:
+                if not finished:
+                    created = location.add_media_page(data)
+                    publications.setdefault(location.id, []).extend(created)
+                    continue
+                created = publications.pop(location.id, [])
+                error = data is None or location.id in failed
+                failed.discard(location.id)
+                if created or not error:
+                    location.finish_update(created, None if error else data)
+                self.release(location, error=error)
+            except Exception as e:
+                logger.error("There is an error storing media for location: %s. Error is `%s`" % (location.id, e))
+                if finished:
+                    self.release(location, error=True)
+                else:
+                    failed.add(location.id)
+            finally:
+                close_old_connections()
+
+    def start(self):
+        """ Starts the fetcher and writer threads
+        """
+        threads = [threading.Thread(target=self.fetch) for i in range(self.concurrency)]
+        threads += [threading.Thread(target=self.write, args=(fetched,)) for fetched in self.fetched]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+    def dispatch(self):
+        """ Puts the next location in the pending queue, blocking while all fetchers are busy.
+        Returns False when no location has to be updated yet
+        """
+        location = self.next_location()
+        if location is None:
+            return False
+        with self.lock:
+            self.in_flight.add(location.id)
+        self.pending.put(location)
+        return True
@@ -0,0 +1,127 @@
+""" Geographic helpers used to place spots and to filter locations. Distances are in meters, points are given as
+latitude and longitude in degrees.
+"""
+import math
+
+EARTH_RADIUS = 6371000
+METERS_PER_DEGREE = 2 * math.pi * EARTH_RADIUS / 360
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def distance_meters(lat1, lng1, lat2, lng2):
+    """ Haversine distance between two points
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return EARTH_RADIUS * 2 * math.asin(math.sqrt(a))
+
+
+def offset(lat, lng, east, north):
+    """ Returns the point that is `east` and `north` meters away from the one passed by parameter
+    """
+    return (lat + north / METERS_PER_DEGREE,
+            lng + east / (METERS_PER_DEGREE * math.cos(math.radians(lat))))
+
+
+def hex_vertices(lat, lng, radius):
+    """ Returns the vertices of the hexagon inscribed in the circle passed by parameter
+    """
+    return [offset(lat, lng, radius * math.cos(math.radians(angle)), radius * math.sin(math.radians(angle)))
+            for angle in range(30, 360, 60)]
+
+
+def hex_lattice(lat, lng, east_extent, north_extent, search_radius):
+    """ Returns the centers of a hexagonal packing of circles of radius search_radius around the point passed by
+    parameter, up to east_extent and north_extent meters away from it, as a list of (east, north, (lat, lng)).
+    Every circle covers the hexagon inscribed in it, and hexagons tile the plane, so this is the layout that covers
+    a surface with the fewest circles.
+    """
+    column = math.sqrt(3) * search_radius  # Distance between centers of the same row
+    row = 1.5 * search_radius  # Distance between rows, odd rows are shifted half a column
+    rows = int(math.ceil(north_extent / row))
+    columns = int(math.ceil(east_extent / column))
+    centers = []
+    for j in range(-rows, rows + 1):
+        shift = column / 2 if j % 2 else 0
+        for i in range(-columns - 1, columns + 1):
+            east, north = i * column + shift, j * row
+            centers.append((east, north, offset(lat, lng, east, north)))
+    return centers
+
+
+def hex_grid(lat, lng, radius, search_radius):
+    """ Returns the centers of the circles of radius search_radius that cover the circle of radius `radius` around
+    the point passed by parameter, as a list of (lat, lng) sorted by distance to the center.
+    Circles are placed on a hexagonal packing (see hex_lattice). Circles whose hexagon does not reach the requested
+    circle are discarded.
+    """
+    if radius <= search_radius:
+        return [(lat, lng)]
+    centers = []
+    for east, north, center in hex_lattice(lat, lng, radius + search_radius, radius + search_radius, search_radius):
+        distance = math.hypot(east, north)
+        if distance < radius + search_radius:
+            centers.append((distance, center))
+    centers.sort()
+    return [center for _, center in centers]
+
+
+def geohash_encode(lat, lng, precision=7):
+    """ Returns the geohash of the point, a string of `precision` characters naming the cell that contains it.
+    Precision 7 is a cell of about 150 x 150 meters
+    """
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    cell = []
+    bits, value, even = 0, 0, True
+    while len(cell) < precision:
+        # Bits alternate between longitude and latitude, starting with longitude
+        coordinate, interval = (lng, lng_range) if even else (lat, lat_range)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            cell.append(GEOHASH_ALPHABET[value])
+            bits, value = 0, 0
+    return "".join(cell)
+
+
+def geohash_bounds(cell):
+    """ Returns the ranges of latitude and longitude of the geohash cell, as ([south, north], [west, east])
+    """
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in cell:
+        value = GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            interval = lng_range if even else lat_range
+            middle = (interval[0] + interval[1]) / 2
+            if value >> shift & 1:
+                interval[0] = middle
+            else:
+                interval[1] = middle
+            even = not even
+    return lat_range, lng_range
+
+
+def geohash_center(cell):
+    """ Returns the center (lat, lng) of the geohash cell
+    """
+    lat_range, lng_range = geohash_bounds(cell)
+    return (lat_range[0] + lat_range[1]) / 2, (lng_range[0] + lng_range[1]) / 2
+
+
+def geohash_radius(cell):
+    """ Returns the distance from the center of the geohash cell to its farthest corner, so the circle of this
+    radius around the center contains the cell
+    """
+    lat_range, lng_range = geohash_bounds(cell)
+    lat, lng = geohash_center(cell)
+    # The corners closest to the equator are the farthest, the cell is wider there
+    return distance_meters(lat, lng, min(lat_range, key=abs), lng_range[1])
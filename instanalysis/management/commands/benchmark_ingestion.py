@@ -0,0 +1,104 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.contrib.gis.geos import Point
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from instanalysis import api, models
+from instanalysis.apps.instagram.fakeserver import FakeData, FakeInstagramServer
+from instanalysis.cache import identity_cache_stats
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """ Measures the ingestion throughput against a local fake Instagram API. Locations are searched from a spot
+    and their media is downloaded and stored as the worker does. All changes are rolled back at the end.
+
+    :param --fixture: JSON fixture served by the fake API, synthetic data is generated when not provided
+    :param --locations: Number of synthetic locations
+    :param --posts: Number of synthetic posts per location
+    :param --latency: Seconds added by the fake API to every response
+    :param --error-rate: Ratio of requests answered with a 503
+    :param --adhoc: Downloads media as an adhoc search instead of as a city
+
+    :Examples:
+        $ python manage.py benchmark_ingestion --locations=20 --posts=1000
+        $ python manage.py benchmark_ingestion --fixture=instanalysis/apps/instagram/fixtures/sample_api.json
+    """
+    help = 'Benchmarks media ingestion against a local fake Instagram API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fixture', dest='fixture', default=None,
+                            help='JSON fixture served by the fake API')
+        parser.add_argument('--locations', dest='locations', type=int, default=10,
+                            help='Number of synthetic locations')
+        parser.add_argument('--posts', dest='posts', type=int, default=500,
+                            help='Number of synthetic posts per location')
+        parser.add_argument('--latency', dest='latency', type=float, default=0,
+                            help='Seconds added to every response')
+        parser.add_argument('--error-rate', dest='error_rate', type=float, default=0,
+                            help='Ratio of requests answered with a 503')
+        parser.add_argument('--adhoc', dest='adhoc', action='store_true', default=False,
+                            help='Download media as an adhoc search')
+
+    def handle(self, *args, **options):
+        if options['fixture']:
+            data = FakeData.from_fixture(options['fixture'])
+        else:
+            data = FakeData.synthetic(locations=options['locations'], posts=options['posts'], seed=1)
+        server = FakeInstagramServer(data, latency=options['latency'], error_rate=options['error_rate'])
+        server.start()
+        base_url, quota = api.base_url, api.quota
+        api.base_url, api.quota = server.url, False
+        try:
+            with transaction.atomic():
+                self.benchmark(data, options['adhoc'])
+                requests = len(server.requests)
+                transaction.set_rollback(True)
+        finally:
+            api.base_url, api.quota = base_url, quota
+            server.stop()
+        self.stdout.write("API requests: %s" % requests)
+        self.stdout.write("Identity caches: %s" % identity_cache_stats())
+
+    def benchmark(self, data, adhoc):
+        lat = sum(l['latitude'] for l in data.locations) / len(data.locations)
+        lng = sum(l['longitude'] for l in data.locations) / len(data.locations)
+        city = models.City.objects.create(name="Benchmark %s" % int(time.time()), center=Point(lng, lat), zoom=12)
+        spot = models.Spot.objects.create(position=city.center, city=None if adhoc else city, is_adhoc=adhoc)
+        adhoc_search = None
+        if adhoc:
+            # Dates, like the ones stored by the adhoc search form
+            today = timezone.localtime(timezone.now()).date()
+            adhoc_search = models.ADHOCSearch.objects.create(position=city.center, radius=750,
+                                                             start_date=today - timedelta(days=365),
+                                                             end_date=today, query_url='')
+
+        with CaptureQueriesContext(connection) as queries:
+            started = time.time()
+            locations = spot.update_locations(api.getLocations(lat, lng, radius=50000, cached=False))
+            elapsed_locations = time.time() - started
+            started = time.time()
+            for location in locations:
+                if adhoc:
+                    location.get_media_between_dates(adhoc_search.start_date, adhoc_search.end_date,
+                                                     adhoc_search.id)
+                else:
+                    location.get_latest_media()
+            elapsed_media = time.time() - started
+
+        if adhoc:
+            publications = models.Publication.objects.filter(adhocsearch=adhoc_search).count()
+        else:
+            publications = models.Publication.objects.of_city(city.name).count()
+        self.stdout.write("Locations stored: %s in %.2f seconds" % (len(locations), elapsed_locations))
+        self.stdout.write("Publications ingested: %s in %.2f seconds" % (publications, elapsed_media))
+        if publications:
+            self.stdout.write("Publications per second: %.1f" % (publications / elapsed_media))
+            self.stdout.write("Queries: %s, queries per publication: %.3f" %
+                              (len(queries), float(len(queries)) / publications))
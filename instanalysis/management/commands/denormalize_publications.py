@@ -0,0 +1,43 @@
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Min
+
+from instanalysis.models import Publication, denormalize_publications
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """ Sets the city and the local date, hour, weekday and month of the publications, which are set when they are
+    stored. Publications are updated in batches of ids, each one in its own transaction, so the command can be
+    interrupted and run again.
+
+    :param --all: Updates all publications, not only those without local date (after moving locations to another city)
+    :param --batch-size: Number of ids updated per transaction
+
+    :Examples:
+        $ python manage.py denormalize_publications
+        $ python manage.py denormalize_publications --all --batch-size=20000
+    """
+    help = 'Sets the denormalized city and local date fields of the publications'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', dest='all', action='store_true', default=False,
+                            help='Update all publications, not only those without local date')
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=50000,
+                            help='Number of ids updated per transaction')
+
+    def handle(self, *args, **options):
+        bounds = Publication.objects.aggregate(first=Min('id'), last=Max('id'))
+        if bounds['first'] is None:
+            self.stdout.write("No publications")
+            return
+        updated = 0
+        for first_id in range(bounds['first'], bounds['last'] + 1, options['batch_size']):
+            with transaction.atomic():
+                updated += denormalize_publications(first_id, first_id + options['batch_size'],
+                                                    missing_only=not options['all'])
+            logger.debug("Publications up to id %s denormalized" % (first_id + options['batch_size']))
+        self.stdout.write("%s publications updated" % updated)
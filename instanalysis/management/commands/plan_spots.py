@@ -0,0 +1,166 @@
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.gis.geos import GEOSGeometry, Point, Polygon
+from django.db import transaction
+
+from instanalysis.geo import distance_meters, hex_grid, hex_lattice, hex_vertices
+from instanalysis.models import City, InstagramLocation, Spot
+
+logger = logging.getLogger(__name__)
+
+
+def greedy_set_cover(sets):
+    """ Returns the keys of a small subset of the dictionary key -> set passed by parameter whose sets cover the union
+    of all of them. The set covering most uncovered elements is taken first, ties are broken by key
+    """
+    uncovered = set().union(*sets.values()) if sets else set()
+    chosen = []
+    while uncovered:
+        key = max(sorted(sets), key=lambda k: len(sets[k] & uncovered))
+        chosen.append(key)
+        uncovered -= sets[key]
+    return chosen
+
+
+class Command(BaseCommand):
+    """ Plans the spots of a city, the points whose locations are searched to find the locations of the city.
+    The area of the city is covered with a hexagonal packing of circles of CITY_SPOT_RADIUS meters (the radius of the
+    location searches), the layout with the least overlap. The area is a circle around the center of the city,
+    a bounding box or a polygon.
+    With --prune, only the spots needed to find all the locations already stored for the city are kept (greedy set
+    cover). The locations a spot finds are the stored ones within CITY_SPOT_RADIUS meters of it, the API is not
+    queried.
+    The locations of the spots that are removed are moved to the new ones, no location nor publication is deleted.
+
+    :param city: Name of the city
+    :param --radius: Meters around the center of the city to cover
+    :param --bbox: Bounding box to cover, as south,west,north,east
+    :param --polygon: Polygon to cover, in WKT
+    :param --prune: Removes the spots whose locations are found by other spots
+    :param --fake: Do not alter database
+
+    :Examples:
+        $ python manage.py plan_spots Barcelona --radius=5000
+        $ python manage.py plan_spots Madrid --bbox=40.36,-3.77,40.48,-3.62
+        $ python manage.py plan_spots Madrid --prune --fake=True
+    """
+    help = 'Plans the spots of a city'
+
+    def add_arguments(self, parser):
+        parser.add_argument('city', help='Name of the city')
+        parser.add_argument('--radius', dest='radius', type=int, default=None,
+                            help='Meters around the center of the city to cover')
+        parser.add_argument('--bbox', dest='bbox', default=None,
+                            help='Bounding box to cover, as south,west,north,east')
+        parser.add_argument('--polygon', dest='polygon', default=None,
+                            help='Polygon to cover, in WKT')
+        parser.add_argument('--prune', dest='prune', action='store_true', default=False,
+                            help='Remove the spots whose locations are found by other spots')
+        parser.add_argument('--fake',
+                            dest='fake',
+                            default=False,
+                            help='Do not perform changes in database')
+
+    def handle(self, *args, **options):
+        try:
+            city = City.objects.get(name=options['city'])
+        except City.DoesNotExist:
+            raise CommandError("City `%s` does not exist" % options['city'])
+        fake = bool(options['fake'])
+        if fake:
+            logger.info("No changes in the database will be performed.")
+        spot_radius = settings.CITY_SPOT_RADIUS
+
+        if options['prune']:
+            self.prune(city, spot_radius, fake)
+            return
+
+        if options['radius'] is not None:
+            centers = hex_grid(city.center.y, city.center.x, options['radius'], spot_radius)
+        elif options['bbox'] is not None:
+            try:
+                south, west, north, east = [float(value) for value in options['bbox'].split(',')]
+            except ValueError:
+                raise CommandError("The bounding box must be south,west,north,east")
+            centers = self.cover(Polygon.from_bbox((west, south, east, north)), spot_radius)
+        elif options['polygon'] is not None:
+            centers = self.cover(GEOSGeometry(options['polygon'], srid=4326), spot_radius)
+        else:
+            raise CommandError("Use --radius, --bbox or --polygon to set the area, or --prune")
+        self.stdout.write("City `%s`: %s spots planned, %s spots before" %
+                          (city.name, len(centers), city.spot_set.count()))
+        if not centers:
+            raise CommandError("No spots planned for the area, the spots of the city are not replaced")
+        if not fake:
+            self.replace_spots(city, [Point(lng, lat) for lat, lng in centers])
+
+    def cover(self, area, spot_radius):
+        """ Returns the centers (lat, lng) of the circles of the hexagonal packing whose hexagon intersects the area
+        """
+        center = area.centroid
+        west, south, east, north = area.extent
+        east_extent = max(distance_meters(center.y, center.x, center.y, lng) for lng in (west, east))
+        north_extent = max(distance_meters(center.y, center.x, lat, center.x) for lat in (south, north))
+        centers = []
+        for x, y, (lat, lng) in hex_lattice(center.y, center.x, east_extent + spot_radius,
+                                            north_extent + spot_radius, spot_radius):
+            vertices = [(v_lng, v_lat) for v_lat, v_lng in hex_vertices(lat, lng, spot_radius)]
+            if Polygon(vertices + vertices[:1]).intersects(area):
+                centers.append((lat, lng))
+        return centers
+
+    def move_locations(self, spots, targets, preferred=None):
+        """ Moves the locations of the spots to the nearest of the targets, which can not be empty. preferred is a
+        dictionary instagramID -> spot for the locations that have to go to a given spot
+        """
+        if not targets:
+            raise CommandError("There are no spots to move the locations to")
+        preferred = preferred or dict()
+        moves = dict()  # spot -> ids of the locations
+        for location in InstagramLocation.objects.filter(spot__in=spots).only('id', 'instagramID', 'position'):
+            target = preferred.get(location.instagramID)
+            if target is None:
+                target = min(targets, key=lambda s: distance_meters(location.position.y, location.position.x,
+                                                                     s.position.y, s.position.x))
+            moves.setdefault(target, []).append(location.id)
+        for target, location_ids in moves.items():
+            InstagramLocation.objects.filter(id__in=location_ids).update(spot=target)
+
+    @transaction.atomic
+    def replace_spots(self, city, positions):
+        if not positions:
+            raise CommandError("No spots planned for city `%s`, its spots are not replaced" % city.name)
+        old_spots = list(city.spot_set.all())
+        new_spots = []
+        for position in positions:
+            spot = Spot(position=position, city=city)
+            spot.save()
+            new_spots.append(spot)
+        self.move_locations(old_spots, new_spots)
+        Spot.objects.filter(id__in=[old_spot.id for old_spot in old_spots]).delete()
+        logger.info("City `%s`: %s spots replaced by %s" % (city.name, len(old_spots), len(new_spots)))
+
+    def prune(self, city, spot_radius, fake):
+        spots = dict((spot.id, spot) for spot in city.spot_set.all())
+        locations = InstagramLocation.objects.filter(spot__city=city).exclude(instagramID='0')
+        found = dict()  # spot id -> instagram ids of the stored locations it finds
+        for spot in spots.values():
+            found[spot.id] = set(locations.within(spot.position, spot_radius).values_list('instagramID', flat=True))
+        kept = set(greedy_set_cover(found))
+        if not kept:
+            raise CommandError("City `%s` has no locations near its spots, its spots are not pruned" % city.name)
+        removed = [spots[spot_id] for spot_id in spots if spot_id not in kept]
+        self.stdout.write("City `%s`: %s spots kept, %s removed" % (city.name, len(kept), len(removed)))
+        if fake or not removed:
+            return
+        # Locations go to a kept spot that finds them
+        targets = dict()
+        for spot_id in kept:
+            for instagram_id in found[spot_id]:
+                targets.setdefault(instagram_id, spots[spot_id])
+        with transaction.atomic():
+            self.move_locations(removed, [spots[spot_id] for spot_id in kept], preferred=targets)
+            Spot.objects.filter(id__in=[removed_spot.id for removed_spot in removed]).delete()
+
@@ -0,0 +1,30 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from instanalysis.models import HashtagPosting
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """ Recomputes the inverted index hashtag -> publications (see HashtagPostingManager) from the hashtags of the
+    publications of the cities. The index is kept up to date by the task merge_pending_publications, this is needed
+    when hashtags are linked to publications by other means or locations are moved to another city.
+
+    :param --missing: Only builds the chunks of publications that have no containers yet, as after the migration
+        that creates the index. Run by fab deploy
+
+    :Examples:
+        $ python manage.py rebuild_hashtag_index
+        $ python manage.py rebuild_hashtag_index --missing
+    """
+    help = 'Recomputes the inverted index of the hashtags'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--missing', dest='missing', action='store_true', default=False,
+                            help='Only build the chunks of publications without containers')
+
+    def handle(self, *args, **options):
+        HashtagPosting.objects.rebuild(missing=options['missing'])
+        self.stdout.write("Hashtag index rebuilt: %s containers" % HashtagPosting.objects.count())
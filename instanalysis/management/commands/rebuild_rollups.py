@@ -0,0 +1,49 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from instanalysis import rollups
+from instanalysis.models import City, DistinctSketch, HashtagSketch, LocationHourRollup
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """ Recomputes the rollups of the publications of the cities (see instanalysis.rollups) and their hashtag and
+    distinct sketches (see HashtagSketchManager and DistinctSketchManager) from the publications, a city per
+    transaction. Rollups are kept up to date by the ingestion, this is needed when publications are changed by other
+    means or when locations move to another city.
+
+    :param --city: Name of the city to rebuild, can be repeated. All cities by default
+    :param --missing: Only builds the rollups and sketches of the cities that have none yet, as after the migrations
+        that create them. Run by fab deploy
+
+    :Examples:
+        $ python manage.py rebuild_rollups
+        $ python manage.py rebuild_rollups --city=Barcelona --city=Madrid
+        $ python manage.py rebuild_rollups --missing
+    """
+    help = 'Recomputes the rollups of the publications of the cities'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--city', dest='cities', action='append', default=None,
+                            help='Name of the city to rebuild, can be repeated')
+        parser.add_argument('--missing', dest='missing', action='store_true', default=False,
+                            help='Only build the rollups and sketches of the cities that have none')
+
+    def handle(self, *args, **options):
+        cities = dict(City.objects.values_list('name', 'id'))
+        if options['cities']:
+            missing = set(options['cities']) - set(cities.keys())
+            if missing:
+                raise CommandError("Cities `%s` do not exist" % ", ".join(sorted(missing)))
+            cities = dict((name, cities[name]) for name in options['cities'])
+        rebuilds = (('rollups', LocationHourRollup, rollups.rebuild),
+                    ('hashtag sketches', HashtagSketch, HashtagSketch.objects.rebuild),
+                    ('distinct sketches', DistinctSketch, DistinctSketch.objects.rebuild))
+        for name, city_id in sorted(cities.items()):
+            for kind, model, rebuild in rebuilds:
+                if options['missing'] and model.objects.filter(city_id=city_id).exists():
+                    continue
+                rebuild([city_id])
+                self.stdout.write("%s: %s rebuilt" % (name, kind))
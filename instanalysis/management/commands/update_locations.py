@@ -1,46 +1,101 @@
 import logging
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import close_old_connections
 
-from instanalysis.models import City
-from instanalysis.apps.instagram.api import InstagramAPI
+from instanalysis.models import City, Spot
+from instanalysis import api
+from instanalysis.apps.instagram.api import APIGramException
 
 logger = logging.getLogger(__name__)
 
 
 class Command(BaseCommand):
-    """ This command updates instagram locations in the database
+    """ This command updates instagram locations in the database, for all the cities or the ones passed by parameter.
+    Spots are queried concurrently, the requests are limited by the quota shared by all the processes (see
+    instanalysis.apps.instagram.quota). The locations found by every spot are stored in a single statement, and the
+    number of new and changed locations is reported per city.
 
+    :param --city: Updates only this city, can be repeated
+    :param --concurrency: Number of spots queried at the same time
     :param --fake: Do not alter database, but the API query is performed
 
     :Examples:
-        $ python manage.py get_photos
+        $ python manage.py update_locations
 
-        $ python manage.py get_photos --fake=True
+        $ python manage.py update_locations --city=Madrid --city=Barcelona --concurrency=16
     """
-    help = 'Obtain instagram photos for all locations'
+    help = 'Obtain instagram locations for all cities'
 
     def add_arguments(self, parser):
         # Named (optional) arguments
+        parser.add_argument('--city',
+                            dest='cities',
+                            action='append',
+                            default=None,
+                            help='Name of the city to update')
+        parser.add_argument('--concurrency',
+                            dest='concurrency',
+                            type=int,
+                            default=settings.LOCATION_REFRESH_CONCURRENCY,
+                            help='Number of spots queried at the same time')
         parser.add_argument('--fake',
                             dest='fake',
                             default=False,
                             help='Do not perform changes in database')
 
     def handle(self, *args, **options):
-        if bool(options["fake"]):
+        fake = bool(options["fake"])
+        if fake:
             logger.info("No changes in the database will be performed.")
 
-        logger.info("Updating Instagram locations")
-        api = InstagramAPI()
-        for city in City.objects.filter(name="Madrid"):
-            logger.info("Updating locations for city `%s`" % city.name)
-            for spot in city.spot_set.all():
-                lat = spot.position.y
-                lng = spot.position.x
-                locations = api.getLocations(lat, lng)
-                spot.update_locations(locations)
-                time.sleep(1)
-
-        logger.info("Process finishes")
+        cities = City.objects.all()
+        if options['cities']:
+            cities = cities.filter(name__in=options['cities'])
+        spots = list(Spot.objects.filter(city__in=cities).select_related('city'))
+        logger.info("Updating Instagram locations of %s spots" % len(spots))
+
+        report = dict()  # city name -> counters
+        lock = threading.Lock()
+        started = time.time()
+
+        def update(spot):
+            counters = {'spots': 1, 'found': 0, 'new': 0, 'changed': 0, 'errors': 0}
+            try:
+                locations = api.getLocations(spot.position.y, spot.position.x, radius=settings.CITY_SPOT_RADIUS,
+                                             refresh=True)
+                if locations.get('data') is None:
+                    raise APIGramException("No data retrieved from instagram. Returned message is %s" %
+                                           locations.get('meta', {}).get('error_message'))
+                counters['found'] = len(locations['data'])
+                if not fake:
+                    counters['new'], counters['changed'] = spot.upsert_locations(locations)
+            except APIGramException as e:
+                logger.warning("Locations of spot %s could not be obtained: %s" % (spot.id, e))
+                counters['errors'] = 1
+            except Exception as e:
+                # Other spots and cities go on, the error is counted in the report
+                logger.error("Locations of spot %s could not be updated. Error is `%s`" % (spot.id, e))
+                counters['errors'] = 1
+            finally:
+                close_old_connections()
+            with lock:
+                city = report.setdefault(spot.city.name, dict.fromkeys(counters, 0))
+                for name, value in counters.items():
+                    city[name] += value
+
+        if spots:
+            pool = ThreadPool(min(options['concurrency'], len(spots)))
+            try:
+                pool.map(update, spots)
+            finally:
+                pool.close()
+
+        for name in sorted(report):
+            self.stdout.write("%(name)s: %(spots)s spots, %(found)s locations found, %(new)s new, %(changed)s "
+                              "changed, %(errors)s errors" % dict(report[name], name=name))
+        logger.info("Process finishes in %.1f seconds" % (time.time() - started))
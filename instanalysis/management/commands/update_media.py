@@ -53,8 +53,8 @@ class Command(BaseCommand):
             interval_updates = models.Setting.objects.get_value('interval_updates')
             #logger.debug("Retrieving locations that where updated more than `%s` minutes ago" % interval_updates)
             #time_ago = timezone.now() - timedelta(seconds=60 * int(interval_updates))
-            locations = models.InstagramLocation.objects.filter(spot__city__isnull=False)
-            locations = locations.order_by('updated_at')
+            locations = models.InstagramLocation.objects.monitored().filter(next_update_at__lte=timezone.now())
+            locations = locations.order_by('next_update_at')
         else:
             try:
                 locations = models.InstagramLocation.objects.filter(pk=options['location'])
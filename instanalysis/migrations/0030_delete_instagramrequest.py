@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instanalysis', '0029_adhocsearch_traceback'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='InstagramRequest',
+        ),
+    ]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+POLL_SETTINGS = (
+    ('poll_min_interval', '300', 'Minimum seconds between two updates of the media of a location'),
+    ('poll_max_interval', '86400', 'Maximum seconds between two updates of the media of a location'),
+    ('poll_target_posts', '50', 'New publications expected on each update of a location. Locations are updated '
+                                'more often as their posting rate grows'),
+)
+
+
+def create_poll_settings(apps, schema_editor):
+    Setting = apps.get_model('instanalysis', 'Setting')
+    for name, value, help in POLL_SETTINGS:
+        if not Setting.objects.filter(name=name).exists():
+            Setting.objects.create(name=name, value=value, help=help)
+
+
+def delete_poll_settings(apps, schema_editor):
+    Setting = apps.get_model('instanalysis', 'Setting')
+    Setting.objects.filter(name__in=[name for name, value, help in POLL_SETTINGS]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instanalysis', '0030_delete_instagramrequest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='instagramlocation',
+            name='next_update_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, help_text='When the media of this location has to be updated again'),
+        ),
+        migrations.AddField(
+            model_name='instagramlocation',
+            name='poll_interval',
+            field=models.PositiveIntegerField(default=0, help_text='Seconds between the last two updates'),
+        ),
+        migrations.AddField(
+            model_name='instagramlocation',
+            name='posts_per_hour',
+            field=models.FloatField(blank=True, help_text='Smoothed rate of new publications', null=True),
+        ),
+        migrations.AddField(
+            model_name='instagramlocation',
+            name='last_post_at',
+            field=models.DateTimeField(blank=True, help_text='Date of the latest publication', null=True),
+        ),
+        # Locations keep the order in which they were updated until they are polled for the first time
+        migrations.RunSQL(
+            'UPDATE instanalysis_instagramlocation SET next_update_at = updated_at WHERE updated_at IS NOT NULL',
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunPython(create_poll_settings, delete_poll_settings),
+    ]
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Duplicates are merged into the oldest row, repointing foreign keys and hashtag links before deleting them.
+# Publications are unique per instagramID among city publications (adhocsearch_id IS NULL), and per adhoc search.
+MERGE_PUBLICATIONS = """
+CREATE TEMPORARY TABLE publication_duplicates ON COMMIT DROP AS
+    SELECT p.id, k.keep_id
+    FROM instanalysis_publication p
+    JOIN (SELECT "instagramID", adhocsearch_id, MIN(id) AS keep_id
+          FROM instanalysis_publication
+          GROUP BY "instagramID", adhocsearch_id
+          HAVING COUNT(*) > 1) k
+      ON p."instagramID" = k."instagramID" AND p.adhocsearch_id IS NOT DISTINCT FROM k.adhocsearch_id
+    WHERE p.id <> k.keep_id;
+
+INSERT INTO instanalysis_hashtag_publications (hashtag_id, publication_id)
+    SELECT DISTINCT hp.hashtag_id, d.keep_id
+    FROM instanalysis_hashtag_publications hp
+    JOIN publication_duplicates d ON hp.publication_id = d.id
+    WHERE NOT EXISTS (SELECT 1 FROM instanalysis_hashtag_publications e
+                      WHERE e.hashtag_id = hp.hashtag_id AND e.publication_id = d.keep_id);
+DELETE FROM instanalysis_hashtag_publications
+    WHERE publication_id IN (SELECT id FROM publication_duplicates);
+DELETE FROM instanalysis_publicationadhoc
+    WHERE publication_ptr_id IN (SELECT id FROM publication_duplicates);
+DELETE FROM instanalysis_publication
+    WHERE id IN (SELECT id FROM publication_duplicates);
+"""
+
+MERGE_USERS = """
+CREATE TEMPORARY TABLE user_duplicates ON COMMIT DROP AS
+    SELECT u.id, k.keep_id
+    FROM instanalysis_instagramuser u
+    JOIN (SELECT "instagramID", MIN(id) AS keep_id
+          FROM instanalysis_instagramuser
+          GROUP BY "instagramID"
+          HAVING COUNT(*) > 1) k
+      ON u."instagramID" = k."instagramID"
+    WHERE u.id <> k.keep_id;
+
+UPDATE instanalysis_publication p SET author_id = d.keep_id
+    FROM user_duplicates d WHERE p.author_id = d.id;
+DELETE FROM instanalysis_instagramuser
+    WHERE id IN (SELECT id FROM user_duplicates);
+"""
+
+# Adhoc searches used to clone the locations they found, these clones are merged into the original location.
+# Custom locations all have the instagramID '0', they are not merged.
+MERGE_LOCATIONS = """
+CREATE TEMPORARY TABLE location_duplicates ON COMMIT DROP AS
+    SELECT l.id, k.keep_id
+    FROM instanalysis_instagramlocation l
+    JOIN (SELECT "instagramID", MIN(id) AS keep_id
+          FROM instanalysis_instagramlocation
+          WHERE "instagramID" <> '0'
+          GROUP BY "instagramID"
+          HAVING COUNT(*) > 1) k
+      ON l."instagramID" = k."instagramID"
+    WHERE l.id <> k.keep_id;
+
+UPDATE instanalysis_publication p SET location_id = d.keep_id
+    FROM location_duplicates d WHERE p.location_id = d.id;
+DELETE FROM instanalysis_instagramlocation
+    WHERE id IN (SELECT id FROM location_duplicates);
+"""
+
+# Tables are locked against writes until the migration commits, so no duplicate can be stored between the merge
+# and the build of the unique indexes. Ingestion waits for them while the migration runs
+LOCK_TABLES = """
+LOCK TABLE instanalysis_publication, instanalysis_instagramuser, instanalysis_instagramlocation
+    IN SHARE ROW EXCLUSIVE MODE;
+"""
+
+UNIQUE_INDEXES = """
+CREATE UNIQUE INDEX instanalysis_publication_instagramid_uniq
+    ON instanalysis_publication ("instagramID") WHERE adhocsearch_id IS NULL;
+CREATE UNIQUE INDEX instanalysis_publication_instagramid_adhoc_uniq
+    ON instanalysis_publication ("instagramID", adhocsearch_id) WHERE adhocsearch_id IS NOT NULL;
+CREATE UNIQUE INDEX instanalysis_instagramuser_instagramid_uniq
+    ON instanalysis_instagramuser ("instagramID");
+CREATE UNIQUE INDEX instanalysis_instagramlocation_instagramid_uniq
+    ON instanalysis_instagramlocation ("instagramID") WHERE "instagramID" <> '0';
+"""
+
+DROP_UNIQUE_INDEXES = """
+DROP INDEX IF EXISTS instanalysis_publication_instagramid_uniq;
+DROP INDEX IF EXISTS instanalysis_publication_instagramid_adhoc_uniq;
+DROP INDEX IF EXISTS instanalysis_instagramuser_instagramid_uniq;
+DROP INDEX IF EXISTS instanalysis_instagramlocation_instagramid_uniq;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instanalysis', '0031_location_poll_schedule'),
+    ]
+
+    operations = [
+        migrations.RunSQL(LOCK_TABLES, migrations.RunSQL.noop),
+        migrations.RunSQL(MERGE_PUBLICATIONS, migrations.RunSQL.noop),
+        migrations.RunSQL(MERGE_USERS, migrations.RunSQL.noop),
+        migrations.RunSQL(MERGE_LOCATIONS, migrations.RunSQL.noop),
+        migrations.RunSQL(UNIQUE_INDEXES, DROP_UNIQUE_INDEXES),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Distances in meters are computed on the geography type, these indexes are used by ST_DWithin(position::geography,
+# ...) (see InstagramLocationQuerySet.within)
+GEOGRAPHY_INDEXES = """
+CREATE INDEX instanalysis_instagramlocation_position_geog
+    ON instanalysis_instagramlocation USING GIST ((position::geography));
+CREATE INDEX instanalysis_spot_position_geog
+    ON instanalysis_spot USING GIST ((position::geography));
+"""
+
+DROP_GEOGRAPHY_INDEXES = """
+DROP INDEX instanalysis_instagramlocation_position_geog;
+DROP INDEX instanalysis_spot_position_geog;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instanalysis', '0032_unique_instagram_ids'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ADHOCSearchSource',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_date', models.DateField()),
+                ('end_date', models.DateField()),
+                ('adhoc_search', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sources', to='instanalysis.ADHOCSearch')),
+                ('location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='instanalysis.InstagramLocation')),
+            ],
+        ),
+        migrations.RunSQL(GEOGRAPHY_INDEXES, DROP_GEOGRAPHY_INDEXES),
+    ]
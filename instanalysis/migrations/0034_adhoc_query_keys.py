@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from instanalysis.utils import adhoc_area_key, adhoc_query_key
+
+
+def set_adhoc_keys(apps, schema_editor):
+    ADHOCSearch = apps.get_model('instanalysis', 'ADHOCSearch')
+    for search in ADHOCSearch.objects.prefetch_related('hashtags', 'categories'):
+        search.area_key = adhoc_area_key(search.position, search.radius)
+        search.query_key = adhoc_query_key(search.position, search.radius, search.start_date, search.end_date,
+                                           search.month, search.weekday, search.slotrange,
+                                           [h.label for h in search.hashtags.all()],
+                                           [c.label for c in search.categories.all()])
+        search.save(update_fields=['area_key', 'query_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instanalysis', '0033_adhoc_sources'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='adhocsearch',
+            name='area_key',
+            field=models.CharField(blank=True, db_index=True, help_text='Normalized position and radius of the search', max_length=60),
+        ),
+        migrations.AddField(
+            model_name='adhocsearch',
+            name='query_key',
+            field=models.CharField(blank=True, db_index=True, help_text='Hash of the normalized parameters of the search', max_length=40),
+        ),
+        migrations.AlterField(
+            model_name='adhocsearchsource',
+            name='location',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='instanalysis.InstagramLocation'),
+        ),
+        migrations.AddField(
+            model_name='adhocsearchsource',
+            name='search',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='instanalysis.ADHOCSearch'),
+        ),
+        migrations.RunPython(set_adhoc_keys, migrations.RunPython.noop),
+    ]
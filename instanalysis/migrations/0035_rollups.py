@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Only the tables are created. The rollups of the publications already stored are built by the command
+# rebuild_rollups, a city per transaction, run by fab deploy after migrating
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instanalysis', '0034_adhoc_query_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HashtagDayRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('publications', models.PositiveIntegerField(default=0)),
+                ('likes', models.BigIntegerField(default=0)),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='instanalysis.City')),
+                ('hashtag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='instanalysis.Hashtag')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LocationHourRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('hour', models.PositiveSmallIntegerField()),
+                ('publications', models.PositiveIntegerField(default=0)),
+                ('likes', models.BigIntegerField(default=0)),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='instanalysis.City')),
+                ('location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='instanalysis.InstagramLocation')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='hashtagdayrollup',
+            unique_together=set([('city', 'date', 'hashtag')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='locationhourrollup',
+            unique_together=set([('location', 'date', 'hour')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='locationhourrollup',
+            index_together=set([('city', 'date')]),
+        ),
+    ]
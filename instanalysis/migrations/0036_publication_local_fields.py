@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Only the columns and their indexes are added. The publications already stored are updated by the command
+# denormalize_publications, in batches of ids each in its own transaction, run by fab deploy after migrating
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instanalysis', '0035_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='publication',
+            name='city',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='instanalysis.City'),
+        ),
+        migrations.AddField(
+            model_name='publication',
+            name='local_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='publication',
+            name='local_hour',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='publication',
+            name='local_month',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='publication',
+            name='local_weekday',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='1 is Sunday, 7 is Saturday', null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='publication',
+            index_together=set([('city', 'local_month'), ('city', 'local_date'), ('city', 'local_weekday', 'local_hour'), ('city', 'local_hour')]),
+        ),
+    ]
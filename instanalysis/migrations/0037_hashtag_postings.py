@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Only the tables are created. The index of the publications already stored is built by the command
+# rebuild_hashtag_index, a chunk of publications per transaction, run by fab deploy after migrating
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instanalysis', '0036_publication_local_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HashtagPosting',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chunk', models.PositiveIntegerField(help_text='High bits of the ids of the publications')),
+                ('data', models.BinaryField()),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='instanalysis.City')),
+                ('hashtag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='instanalysis.Hashtag')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='hashtagposting',
+            unique_together=set([('city', 'hashtag', 'chunk')]),
+        ),
+        migrations.CreateModel(
+            name='PendingPublication',
+            fields=[
+                ('publication', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='instanalysis.Publication')),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='instanalysis.City')),
+            ],
+        ),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+# Used by the && (overlap) filter of the categories, see MapView.getMapInfo
+CATEGORIES_INDEX = """
+CREATE INDEX instanalysis_publication_category_ids ON instanalysis_publication USING GIN (category_ids);
+"""
+
+DROP_CATEGORIES_INDEX = """
+DROP INDEX instanalysis_publication_category_ids;
+"""
+
+# Categories of the hashtags of the publications stored, the new column is empty for the rest. Same query as
+# refresh_publication_categories in instanalysis.models, which may change after this migration
+SET_PUBLICATION_CATEGORIES = """
+UPDATE instanalysis_publication p
+SET category_ids = ARRAY(SELECT DISTINCT hc.category_id FROM instanalysis_hashtag_publications hp
+                         JOIN instanalysis_hashtag_categories hc ON hc.hashtag_id = hp.hashtag_id
+                         WHERE hp.publication_id = p.id ORDER BY hc.category_id)
+WHERE p.id IN (SELECT hp.publication_id FROM instanalysis_hashtag_publications hp
+               JOIN instanalysis_hashtag_categories hc ON hc.hashtag_id = hp.hashtag_id);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instanalysis', '0037_hashtag_postings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='publication',
+            name='category_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), blank=True, default=list, size=None),
+        ),
+        migrations.RunSQL(SET_PUBLICATION_CATEGORIES, migrations.RunSQL.noop),
+        migrations.RunSQL(CATEGORIES_INDEX, DROP_CATEGORIES_INDEX),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Only the table is created. The sketches of the publications already stored are built by the command
+# rebuild_rollups, a city per transaction, run by fab deploy after migrating
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instanalysis', '0039_hashtag_sketches'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DistinctSketch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('hour', models.PositiveSmallIntegerField()),
+                ('authors', models.BinaryField()),
+                ('hashtags', models.BinaryField()),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='instanalysis.City')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='distinctsketch',
+            unique_together=set([('city', 'date', 'hour')]),
+        ),
+    ]
@@ -1,28 +1,95 @@
 import logging
 import StringIO
+import time
+from itertools import groupby
 from pytz.exceptions import AmbiguousTimeError
 
-from datetime import datetime, timedelta
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
+from django.db import connection, transaction
 from django.contrib.gis.db import models
+from django.contrib.postgres.fields import ArrayField
 from django.contrib.gis.geos import Point
 from django_extensions.db.models import TimeStampedModel
-from django.core.exceptions import MultipleObjectsReturned
 
 
 from xlsxwriter.workbook import Workbook
 
-from . import api
-from .utils import _get_init_datetime_location, created_from_timestamp_instagram
+from .cache import hashtag_ids_cache, instagram_user_ids_cache
+from . import api, rollups, scheduler
+from .bitmaps import RoaringBitmap, deserialize_container, serialize_container
+from .sketches import HyperLogLog, SpaceSaving
+from .db import INSERT_BATCH_SIZE, bulk_update, insert_ignore_conflicts, stream, upsert
+from .utils import _get_init_datetime_location, created_from_timestamp_instagram, day_range, as_local_date
+from .utils import adhoc_area_key, adhoc_query_key
 
 logger = logging.getLogger(__name__)
 
+# Sets the columns of the publications denormalized from their location and date, see Publication.set_local_fields.
+# Weekdays follow Django's __week_day (1 is Sunday)
+DENORMALIZE_PUBLICATIONS_SQL = """
+    UPDATE instanalysis_publication p
+    SET city_id = CASE WHEN p.adhocsearch_id IS NULL THEN (SELECT s.city_id FROM instanalysis_instagramlocation l
+                                                          JOIN instanalysis_spot s ON s.id = l.spot_id
+                                                          WHERE l.id = p.location_id) END,
+        local_date = (p.publication_date AT TIME ZONE %%(tz)s)::date,
+        local_hour = EXTRACT(hour FROM p.publication_date AT TIME ZONE %%(tz)s),
+        local_weekday = EXTRACT(dow FROM p.publication_date AT TIME ZONE %%(tz)s) + 1,
+        local_month = EXTRACT(month FROM p.publication_date AT TIME ZONE %%(tz)s)
+    WHERE p.id >= %%(first_id)s AND p.id < %%(last_id)s %s
+"""
+
+
+def denormalize_publications(first_id, last_id, missing_only=True):
+    """ Sets the city and the local date fields of the publications with ids from first_id to last_id (excluded).
+    With missing_only, only publications without them are updated. Returns the number of publications updated
+    """
+    sql = DENORMALIZE_PUBLICATIONS_SQL % ("AND p.local_date IS NULL" if missing_only else "")
+    with connection.cursor() as cursor:
+        cursor.execute(sql, {"tz": settings.TIME_ZONE, "first_id": first_id, "last_id": last_id})
+        return cursor.rowcount
+
+
+# Sets the categories of the publications from the categories of their hashtags, see Publication.category_ids
+REFRESH_PUBLICATION_CATEGORIES_SQL = """
+    UPDATE instanalysis_publication p
+    SET category_ids = ARRAY(SELECT DISTINCT hc.category_id FROM instanalysis_hashtag_publications hp
+                             JOIN instanalysis_hashtag_categories hc ON hc.hashtag_id = hp.hashtag_id
+                             WHERE hp.publication_id = p.id ORDER BY hc.category_id)
+    WHERE %s
+"""
+
+
+def refresh_publication_categories(hashtag_ids=None):
+    """ Recomputes the categories of the publications with any of the hashtags passed by parameter (ids), of all
+    the publications when None. Returns the number of publications updated
+    """
+    if hashtag_ids is None:
+        where, params = ("p.category_ids <> '{}' OR p.id IN (SELECT hp.publication_id "
+                         "FROM instanalysis_hashtag_publications hp JOIN instanalysis_hashtag_categories hc "
+                         "ON hc.hashtag_id = hp.hashtag_id)"), []
+    else:
+        where = "p.id IN (SELECT publication_id FROM instanalysis_hashtag_publications WHERE hashtag_id = ANY(%s))"
+        params = [list(hashtag_ids)]
+    with connection.cursor() as cursor:
+        cursor.execute(REFRESH_PUBLICATION_CATEGORIES_SQL % where, params)
+        return cursor.rowcount
+
 
 class PublicationManager(models.Manager):
 
-    def export_to_excel(self, data_publications, data_tags):
+    def of_city(self, name):
+        """ Publications of the city with the name passed by parameter. Publications of adhoc searches are excluded,
+        even if their locations belong to the city: their city is not set
+        """
+        return self.filter(city__name=name)
+
+    def export_to_excel(self, data_publications, data_tags, progress=None):
         """ Export the current queryset to CSV.
         Data is a Queryset of Publication, these are the publications that will be taken into account.
+        progress is called with the number of publications written every EXPORT_PROGRESS_ROWS publications
         """
         # create a workbook in memory
         output = StringIO.StringIO()
@@ -59,6 +126,8 @@ class PublicationManager(models.Manager):
                 sheet.write(row_index, column_index, value)
                 column_index += 1
             row_index += 1
+            if progress is not None and row_index % settings.EXPORT_PROGRESS_ROWS == 0:
+                progress(row_index - 1)
 
         # Adding tag page
         sheet = book.add_worksheet('Tags')
@@ -101,12 +170,42 @@ class Publication(TimeStampedModel):
     location = models.ForeignKey('InstagramLocation', null=True)
     adhocsearch = models.ForeignKey('ADHOCSearch', null=True)
 
+    # Denormalized so the filters of the map do not join the location and spot, nor compute local times
+    # (see set_local_fields and the command denormalize_publications). city is not set for adhoc publications
+    city = models.ForeignKey('City', null=True, blank=True, related_name='+')
+    local_date = models.DateField(null=True, blank=True)
+    local_hour = models.PositiveSmallIntegerField(null=True, blank=True)
+    local_weekday = models.PositiveSmallIntegerField(null=True, blank=True, help_text='1 is Sunday, 7 is Saturday')
+    local_month = models.PositiveSmallIntegerField(null=True, blank=True)
+    # Ids of the categories of the hashtags of the publication, sorted, with a GIN index (migration 0038). Refreshed
+    # when the categories of the hashtags change, see refresh_publication_categories
+    category_ids = ArrayField(models.IntegerField(), default=list, blank=True)
+
     objects = PublicationManager()
 
+    # Fields set when publications are inserted in bulk, see InstagramLocation.add_media_page.
+    # instagramID is unique for city publications, and per adhoc search for adhoc ones (migration 0032)
+    insert_fields = ['created', 'modified', 'instagramID', 'publication_date', 'mediaType', 'instagram_url',
+                     'caption', 'likes', 'author', 'location', 'adhocsearch', 'city', 'local_date', 'local_hour',
+                     'local_weekday', 'local_month', 'category_ids']
+
     def __unicode__(self):
         _type = self._choices_mediaType[int(self.mediaType)][1]
         return "<Media %s: %s %s>" % (_type, self.instagramID, self.publication_date)
 
+    def set_local_fields(self):
+        """ Sets the local date, hour, weekday and month (settings.TIME_ZONE) from publication_date
+        """
+        local = timezone.localtime(self.publication_date)
+        self.local_date = local.date()
+        self.local_hour = local.hour
+        self.local_weekday = local.isoweekday() % 7 + 1
+        self.local_month = local.month
+
+    class Meta:
+        index_together = (('city', 'local_date'), ('city', 'local_month'), ('city', 'local_weekday', 'local_hour'),
+                          ('city', 'local_hour'))
+
 
 class PublicationADHOC(PublicationManager):
     pass
@@ -135,10 +234,65 @@ class ADHOCSearch(TimeStampedModel):
     categories = models.ManyToManyField('Category', null=True, blank=True)
     query_url = models.TextField()
     traceback = models.TextField(blank=True, null=True)
+    # See instanalysis.utils.adhoc_query_key and adhoc_area_key
+    query_key = models.CharField(max_length=40, blank=True, db_index=True,
+                                 help_text='Hash of the normalized parameters of the search')
+    area_key = models.CharField(max_length=60, blank=True, db_index=True,
+                                help_text='Normalized position and radius of the search')
 
     def __unicode__(self):
         return "AdhocSearch %s" % self.id
 
+    def publications(self):
+        """ Publications of this search: those downloaded for it, and those of its sources, already stored in the
+        database (see instanalysis.planner)
+        """
+        query = models.Q(adhocsearch=self)
+        local = dict()  # (start date, end date) -> ids of the locations
+        for source in self.sources.select_related('search'):
+            if source.search is not None:
+                since, until = day_range(source.start_date, source.end_date)
+                query |= models.Q(id__in=source.search.publications().filter(publication_date__gte=since,
+                                                                              publication_date__lt=until)
+                                                                      .values('id'))
+            else:
+                local.setdefault((source.start_date, source.end_date), []).append(source.location_id)
+        for (start_date, end_date), location_ids in local.items():
+            since, until = day_range(start_date, end_date)
+            query |= models.Q(adhocsearch__isnull=True, location_id__in=location_ids,
+                              publication_date__gte=since, publication_date__lt=until)
+        return Publication.objects.filter(query)
+
+    def set_keys(self, hashtags, categories):
+        """ Sets the keys of this search from its parameters and the labels of the hashtags and categories filtered
+        """
+        self.area_key = adhoc_area_key(self.position, self.radius)
+        self.query_key = adhoc_query_key(self.position, self.radius, self.start_date, self.end_date, self.month,
+                                         self.weekday, self.slotrange, hashtags, categories)
+
+    def covered_interval(self):
+        """ Interval of dates whose media was completely downloaded by this search. Media published after the
+        search started is not, so the day it started is excluded
+        """
+        started = timezone.localtime(self.created).date()
+        return self.start_date, min(self.end_date, started - timedelta(days=1))
+
+
+class ADHOCSearchSource(models.Model):
+    """ Publications between two dates that are not downloaded again for the adhoc search: those of a location,
+    downloaded for the cities, or those of a previous search of the same area
+    """
+    adhoc_search = models.ForeignKey(ADHOCSearch, related_name='sources')
+    location = models.ForeignKey('InstagramLocation', related_name='+', null=True, blank=True)
+    search = models.ForeignKey(ADHOCSearch, related_name='+', null=True, blank=True)
+    start_date = models.DateField()
+    end_date = models.DateField()
+
+    def __unicode__(self):
+        source = "search %s" % self.search_id if self.search_id else "location %s" % self.location_id
+        return "<ADHOCSearchSource %s: %s from %s to %s>" % (self.adhoc_search_id, source,
+                                                             self.start_date, self.end_date)
+
 
 class Category(TimeStampedModel):
     """
@@ -150,6 +304,35 @@ class Category(TimeStampedModel):
         return "<Category `%s`>" % self.label
 
 
+class HashtagManager(models.Manager):
+
+    def ids_for_labels(self, labels):
+        """ Returns a dictionary label -> id for all the labels passed by parameter. Hashtags that are not stored
+        yet are created. Labels are looked up first in the process-local cache, so popular hashtags do not hit the
+        database at all. The number of queries does not depend on the number of labels
+        """
+        labels = set(labels)
+        if not labels:
+            return dict()
+        ids = hashtag_ids_cache.get_many(labels)
+        missing = labels - set(ids.keys())
+        if not missing:
+            return ids
+        found = dict(self.filter(label__in=missing).values_list('label', 'id'))
+        hashtag_ids_cache.set_many(found)
+        ids.update(found)
+        missing = missing - set(found.keys())
+        if missing:
+            # Other workers could be creating the same hashtags at the same time
+            insert_ignore_conflicts(Hashtag, [Hashtag(label=label) for label in missing],
+                                    ['created', 'modified', 'label'])
+            created = dict(self.filter(label__in=missing).values_list('label', 'id'))
+            ids.update(created)
+            # The new rows could be rolled back, we only cache them once they are committed
+            transaction.on_commit(lambda: hashtag_ids_cache.set_many(created))
+        return ids
+
+
 class Hashtag(TimeStampedModel):
     """ Stores all hashtags that have been stored
     """
@@ -157,22 +340,308 @@ class Hashtag(TimeStampedModel):
     publications = models.ManyToManyField(Publication, null=True, blank=True)
     categories = models.ManyToManyField(Category, blank=True)
 
+    objects = HashtagManager()
+
     def __unicode__(self):
         return "<Hashtag `#%s`" % self.label
 
 
+# Merges of the pending publications, and rebuilds of what they are merged into, hold this advisory lock (an arbitrary
+# number), so only one of them runs at a time
+PENDING_MERGE_LOCK = 7311
+
+
+def lock_pending_merge(wait=True):
+    """ Takes the lock of the merges of the pending publications until the end of the transaction. Without wait,
+    returns False at once if another transaction holds it
+    """
+    with connection.cursor() as cursor:
+        if wait:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [PENDING_MERGE_LOCK])
+            return True
+        cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", [PENDING_MERGE_LOCK])
+        return cursor.fetchone()[0]
+
+
+class PendingPublicationManager(models.Manager):
+    """ Publications of the cities stored but not merged yet into the hashtag index (see HashtagPostingManager). The
+    ingestion only inserts rows here, which never conflict between workers, and the shared rows of the index and of
+    the sketches are updated by merge, run every minute by the task merge_pending_publications
+    """
+
+    def merge(self, limit=None):
+        """ Merges the oldest pending publications, up to limit (PENDING_MERGE_BATCH_SIZE by default), in a single
+        transaction. Returns the number of publications merged, 0 if another merge or a rebuild is running
+        """
+        limit = limit or settings.PENDING_MERGE_BATCH_SIZE
+        with transaction.atomic():
+            if not lock_pending_merge(wait=False):
+                return 0
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    DELETE FROM instanalysis_pendingpublication WHERE publication_id IN (
+                        SELECT publication_id FROM instanalysis_pendingpublication ORDER BY publication_id LIMIT %s)
+                    RETURNING publication_id""", [limit])
+                publication_ids = [row[0] for row in cursor.fetchall()]
+            if publication_ids:
+                HashtagPosting.objects.merge(publication_ids)
+                HashtagSketch.objects.merge(publication_ids)
+                DistinctSketch.objects.merge(publication_ids)
+        return len(publication_ids)
+
+
+class PendingPublication(models.Model):
+    """ Publication of a city waiting to be merged, see PendingPublicationManager
+    """
+    publication = models.OneToOneField(Publication, primary_key=True, related_name='+')
+    city = models.ForeignKey('City', related_name='+')
+
+    objects = PendingPublicationManager()
+
+
+# Publications with a hashtag, the condition on the hashtag id is appended
+HAS_HASHTAG_SQL = ('EXISTS (SELECT 1 FROM instanalysis_hashtag_publications hp '
+                   'WHERE hp.publication_id = "instanalysis_publication"."id" AND hp.hashtag_id %s)')
+
+
+class HashtagPostingManager(models.Manager):
+    """ Inverted index hashtag -> bitmap of the ids of its publications (see instanalysis.bitmaps), per city. Every row
+    is a container of a bitmap: the publications of the city with the hashtag whose ids have the high bits `chunk`.
+    Only publications of the cities are indexed. They are added by PendingPublicationManager.merge, the ones not
+    merged yet are read from the pending publications
+    """
+
+    def merge(self, publication_ids):
+        """ Adds to the index the publications passed by parameter (ids). Called by PendingPublicationManager.merge,
+        only one runs at a time, so the rows are not locked
+        """
+        lows = dict()  # (city id, hashtag id, chunk) -> publication ids
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT p.city_id, hp.hashtag_id, hp.publication_id FROM instanalysis_hashtag_publications hp
+                JOIN instanalysis_publication p ON p.id = hp.publication_id
+                WHERE hp.publication_id = ANY(%s) AND p.city_id IS NOT NULL""", [list(publication_ids)])
+            for city_id, hashtag_id, publication_id in cursor.fetchall():
+                lows.setdefault((city_id, hashtag_id, publication_id >> 16), []).append(publication_id)
+        if not lows:
+            return
+        keys = sorted(lows)
+        insert_ignore_conflicts(HashtagPosting, [HashtagPosting(city_id=c, hashtag_id=h, chunk=k, data='')
+                                                 for c, h, k in keys], ['city', 'hashtag', 'chunk', 'data'])
+        changed = []
+        for posting in self.filter(city_id__in=set(c for c, h, k in keys), hashtag_id__in=set(h for c, h, k in keys),
+                                   chunk__in=set(k for c, h, k in keys)):
+            ids = lows.get((posting.city_id, posting.hashtag_id, posting.chunk))
+            if ids is None:
+                continue
+            bitmap = posting.bitmap()
+            bitmap.update(ids)
+            posting.data = serialize_container(bitmap.containers[posting.chunk])
+            changed.append(posting)
+        bulk_update(HashtagPosting, changed, ['data'])
+
+    def bitmaps(self, city_id, hashtag_ids):
+        """ Returns a dictionary hashtag id -> RoaringBitmap of the publications of the city with the hashtag
+        """
+        hashtag_ids = list(hashtag_ids)
+        pending = dict((hashtag_id, []) for hashtag_id in hashtag_ids)
+        # Pending publications are read first: if a merge commits before the postings are read, they are in them
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT hp.hashtag_id, hp.publication_id FROM instanalysis_pendingpublication pp
+                JOIN instanalysis_hashtag_publications hp ON hp.publication_id = pp.publication_id
+                WHERE pp.city_id = %s AND hp.hashtag_id = ANY(%s)""", [city_id, hashtag_ids])
+            for hashtag_id, publication_id in cursor.fetchall():
+                pending[hashtag_id].append(publication_id)
+        containers = dict((hashtag_id, dict()) for hashtag_id in hashtag_ids)
+        for posting in self.filter(city_id=city_id, hashtag_id__in=hashtag_ids):
+            if posting.data:
+                containers[posting.hashtag_id][posting.chunk] = deserialize_container(posting.data)
+        bitmaps = dict()
+        for hashtag_id, hashtag_containers in containers.items():
+            bitmaps[hashtag_id] = RoaringBitmap.from_containers(hashtag_containers)
+            bitmaps[hashtag_id].update(pending[hashtag_id])
+        return bitmaps
+
+    def match(self, city_id, hashtag_ids, all_of=(), any_of=(), none_of=()):
+        """ Returns the bitmaps of the publications of the city with all the hashtags of all_of and any of the
+        hashtags of any_of (None when both are empty, any publication), and of the publications with any of the
+        hashtags of none_of (None when empty). Hashtags are given by label, hashtag_ids is a dictionary label -> id
+        """
+        bitmaps = self.bitmaps(city_id, set(hashtag_ids.values()))
+        get = lambda label: bitmaps[hashtag_ids[label]] if label in hashtag_ids else RoaringBitmap()
+        included = None
+        if all_of:
+            included = RoaringBitmap.intersection([get(label) for label in set(all_of)])
+        if any_of:
+            matching = RoaringBitmap.union([get(label) for label in set(any_of)])
+            included = matching if included is None else included & matching
+        excluded = RoaringBitmap.union([get(label) for label in set(none_of)]) if none_of else None
+        return included, excluded
+
+    def filter_publications(self, publications, city_id=None, all_of=(), any_of=(), none_of=()):
+        """ Filters the queryset of publications passed by parameter by their hashtags, see match. With city_id, the
+        queryset must only have publications of the city, and the publications matching are looked up in the index:
+        up to HASHTAG_FILTER_MAX_IDS of them are filtered by id. Larger matches, and publications of adhoc searches,
+        are filtered with semi-joins on the hashtags of the publications, so the ids are not sent to the database
+        """
+        hashtag_ids = dict(Hashtag.objects.filter(label__in=set(all_of) | set(any_of) | set(none_of))
+                                          .values_list('label', 'id'))
+        if any(label not in hashtag_ids for label in all_of) or \
+                (any_of and not any(label in hashtag_ids for label in any_of)):
+            return publications.none()
+        included = excluded = None
+        if city_id is not None:
+            included, excluded = self.match(city_id, hashtag_ids, all_of, any_of, none_of)
+        max_ids = settings.HASHTAG_FILTER_MAX_IDS
+        if included is not None and len(included) <= max_ids:
+            publications = publications.extra(where=['"instanalysis_publication"."id" = ANY(%s)'],
+                                              params=[list(included)])
+        elif all_of or any_of:
+            for label in set(all_of):
+                publications = publications.extra(where=[HAS_HASHTAG_SQL % "= %s"], params=[hashtag_ids[label]])
+            if any_of:
+                publications = publications.extra(where=[HAS_HASHTAG_SQL % "= ANY(%s)"],
+                                                  params=[[hashtag_ids[l] for l in set(any_of) if l in hashtag_ids]])
+        excluded_ids = [hashtag_ids[label] for label in set(none_of) if label in hashtag_ids]
+        if excluded is not None and len(excluded) <= max_ids:
+            if excluded:
+                publications = publications.extra(where=['NOT ("instanalysis_publication"."id" = ANY(%s))'],
+                                                  params=[list(excluded)])
+        elif excluded_ids:
+            publications = publications.extra(where=["NOT %s" % (HAS_HASHTAG_SQL % "= ANY(%s)")],
+                                              params=[excluded_ids])
+        return publications
+
+    def rebuild(self, missing=False):
+        """ Recomputes the index from the hashtags of the publications of the cities, a chunk of publications per
+        transaction. Merges wait meanwhile, the pending publications are left to them. With missing, only the chunks
+        without any container are built, as after the migration that creates the index
+        """
+        bounds = Publication.objects.filter(city__isnull=False).aggregate(first=models.Min('id'),
+                                                                          last=models.Max('id'))
+        if bounds['first'] is None:
+            if not missing:
+                self.all().delete()
+            return
+        built = set()
+        if missing:
+            built = set(self.values_list('chunk', flat=True).distinct())
+        else:
+            self.filter(chunk__lt=bounds['first'] >> 16).delete()
+            self.filter(chunk__gt=bounds['last'] >> 16).delete()
+        for chunk in range(bounds['first'] >> 16, (bounds['last'] >> 16) + 1):
+            if chunk in built:
+                continue
+            with transaction.atomic():
+                lock_pending_merge()
+                self.filter(chunk=chunk).delete()
+                ids = dict()  # (city id, hashtag id) -> publication ids
+                with connection.cursor() as cursor:
+                    cursor.execute("""
+                        SELECT p.city_id, hp.hashtag_id, hp.publication_id FROM instanalysis_hashtag_publications hp
+                        JOIN instanalysis_publication p ON p.id = hp.publication_id
+                        WHERE hp.publication_id >= %s AND hp.publication_id < %s AND p.city_id IS NOT NULL
+                        AND NOT EXISTS (SELECT 1 FROM instanalysis_pendingpublication pp
+                                        WHERE pp.publication_id = p.id)""", [chunk << 16, (chunk + 1) << 16])
+                    for city_id, hashtag_id, publication_id in cursor.fetchall():
+                        ids.setdefault((city_id, hashtag_id), []).append(publication_id)
+                self.bulk_create([HashtagPosting(city_id=city_id, hashtag_id=hashtag_id, chunk=chunk,
+                                                 data=serialize_container(RoaringBitmap(values).containers[chunk]))
+                                  for (city_id, hashtag_id), values in ids.items()], batch_size=INSERT_BATCH_SIZE)
+            logger.debug("Hashtag index of publications %s to %s rebuilt" % (chunk << 16, ((chunk + 1) << 16) - 1))
+
+
+class HashtagPosting(models.Model):
+    """ Container of the bitmap of the publications of a city with a hashtag, see HashtagPostingManager
+    """
+    city = models.ForeignKey('City', related_name='+')
+    hashtag = models.ForeignKey(Hashtag, related_name='+')
+    chunk = models.PositiveIntegerField(help_text='High bits of the ids of the publications')
+    data = models.BinaryField()
+
+    objects = HashtagPostingManager()
+
+    class Meta:
+        unique_together = (('city', 'hashtag', 'chunk'),)
+
+    def bitmap(self):
+        """ Bitmap of the publications of this container
+        """
+        if not self.data:
+            return RoaringBitmap()
+        return RoaringBitmap.from_containers({self.chunk: deserialize_container(self.data)})
+
+
+class InstagramUserManager(models.Manager):
+
+    def _oldest_ids(self, instagram_ids):
+        """ Returns a dictionary instagramID -> id. instagramID is unique since migration 0032, but if a duplicate
+        existed the oldest user would be used, so the result is always the same for a given instagramID
+        """
+        ids = dict()
+        # Ordering by descending id, so the oldest duplicate is the one that remains in the dictionary
+        for instagram_id, pk in self.filter(instagramID__in=instagram_ids).order_by('-id')\
+                                   .values_list('instagramID', 'id'):
+            ids[instagram_id] = pk
+        return ids
+
+    def ids_for_users(self, users):
+        """ Returns a dictionary instagramID -> id for the users passed by parameter. users is a dictionary
+        instagramID -> username. Users that are not stored yet are created. Users are looked up first in the
+        process-local cache.
+        """
+        if not users:
+            return dict()
+        ids = instagram_user_ids_cache.get_many(users.keys())
+        missing = set(users.keys()) - set(ids.keys())
+        if not missing:
+            return ids
+        found = self._oldest_ids(missing)
+        instagram_user_ids_cache.set_many(found)
+        ids.update(found)
+        missing = missing - set(found.keys())
+        if missing:
+            insert_ignore_conflicts(InstagramUser, [InstagramUser(username=users[instagram_id], instagramID=instagram_id)
+                                                    for instagram_id in missing],
+                                    ['created', 'modified', 'username', 'instagramID'])
+            created = self._oldest_ids(missing)
+            ids.update(created)
+            # The new rows could be rolled back, we only cache them once they are committed
+            transaction.on_commit(lambda: instagram_user_ids_cache.set_many(created))
+        return ids
+
+
 class InstagramUser(TimeStampedModel):
-    """ Instagram users account information
+    """ Instagram users account information. instagramID is unique (migration 0032)
     """
     username = models.CharField(max_length=256)
     instagramID = models.CharField(max_length=300)
 
+    objects = InstagramUserManager()
+
     def __unicode__(self):
         return "<InstagramUser: %s>" % self.username
 
 
+class InstagramLocationQuerySet(models.QuerySet):
+
+    def monitored(self):
+        """ Locations of the cities, whose media is downloaded periodically
+        """
+        return self.filter(spot__city__isnull=False).exclude(instagramID='0')
+
+    def within(self, point, radius):
+        """ Locations within radius meters of the point. Uses the GiST index on position::geography (migration 0033)
+        """
+        return self.extra(where=['ST_DWithin("instanalysis_instagramlocation"."position"::geography, '
+                                 'ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography, %s)'],
+                          params=[point.x, point.y, radius])
+
+
 class InstagramLocation(TimeStampedModel):
-    """ Instagram location information
+    """ Instagram location information. instagramID is unique, except for custom locations, whose id is '0'
+    (migration 0032)
     """
     name = models.CharField(db_index=True, max_length=300)
     instagramID = models.CharField(max_length=200)
@@ -182,71 +651,176 @@ class InstagramLocation(TimeStampedModel):
     latest_media_id = models.CharField(max_length=256, blank=True, null=True,
                                        help_text='Last id obtained, useful for pagination')
     updated_at = models.DateTimeField(blank=True, null=True, default=_get_init_datetime_location)
+    next_update_at = models.DateTimeField(db_index=True, default=timezone.now,
+                                          help_text='When the media of this location has to be updated again')
+    poll_interval = models.PositiveIntegerField(default=0, help_text='Seconds between the last two updates')
+    posts_per_hour = models.FloatField(blank=True, null=True, help_text='Smoothed rate of new publications')
+    last_post_at = models.DateTimeField(blank=True, null=True, help_text='Date of the latest publication')
+
+    objects = InstagramLocationQuerySet.as_manager()
 
     def __unicode__(self):
         return "<InstagramLocation: `%s`, InstagramID: `%s`>" % (self.name, self.instagramID)
 
     def get_latest_media(self, commit=True):
-        """ Obtains and updates the posts for this location and Stores them in the database
+        """ Obtains and updates the posts for this location and Stores them in the database. Every page is stored
+        as soon as it arrives, while the next one is downloaded.
+        """
+        publications = []
+        new_min_id = None
+        for page in self.fetch_latest_pages(prefetch=True):
+            if new_min_id is None and page:
+                new_min_id = page[0]['id']
+            publications += self.add_media_page(page)
+        self.finish_update(publications, new_min_id)
+
+    def fetch_latest_pages(self, prefetch=False):
+        """ Yields the pages of the latest posts for this location from Instagram, newest first, without storing them
         """
-
         logger.debug("Getting latest posts from location `%s`" % self.name)
-        data, new_min_id = api.getLatestPostsInfo(self.instagramID, min_id=self.latest_media_id)
-        for media_post in data:
-            if Publication.objects.filter(instagramID=media_post['id']).count() > 0:
-                logger.warning("Publication with id `%s` already in database" % media_post['id'])
-            else:
-                publication = self.add_media_from_api(media_post)
-                logger.debug("Publication's instagram ID is `%s`" % publication.instagramID)
+        return api.iterLatestPostsPages(self.instagramID, min_id=self.latest_media_id, prefetch=prefetch)
 
-        logger.debug("Updating min_id for location. New min_id is %s" % new_min_id)
-        self.latest_media_id = new_min_id
+    def finish_update(self, publications, new_min_id):
+        """ Updates the location once all pages of an update are stored and schedules its next update.
+        min_id is only moved forward here: pages arrive newest first, so if an update fails in the middle the next one
+        must start again from the previous min_id. Pages already stored are skipped by the unique indexes.
+        """
+        logger.debug("%s new publications stored for location `%s`" % (len(publications), self.name))
+        self.schedule_next_update(publications)
+        if new_min_id is not None:
+            # Without new posts we keep the current min_id, otherwise we would download the latest posts again
+            logger.debug("Updating min_id for location. New min_id is %s" % new_min_id)
+            self.latest_media_id = new_min_id
         self.updated_at = timezone.now()
-        self.save()
+        self.save(update_fields=['latest_media_id', 'updated_at', 'modified', 'next_update_at', 'poll_interval',
+                                 'posts_per_hour', 'last_post_at'])
 
-    def get_media_between_dates(self, start_date, end_date, adhoc_id):
-        """ Retrieves media from this location and stores only those that belongs to the dates passed by parameter
+    def schedule_next_update(self, publications):
+        """ Updates the posting rate of the location with the new publications and calculates when the location
+        has to be updated again. See instanalysis.scheduler
+        """
+        now = timezone.now()
+        if publications:
+            newest = max(p.publication_date for p in publications)
+            self.last_post_at = max(newest, self.last_post_at) if self.last_post_at else newest
+        if self.latest_media_id and self.updated_at:
+            since = self.updated_at
+        elif publications:
+            # First update of the location, we estimate the rate from the publications obtained
+            since = min(p.publication_date for p in publications)
+        else:
+            since = now
+        hours = (now - since).total_seconds() / 3600
+        min_interval, max_interval, target_posts = scheduler.poll_settings()
+        self.posts_per_hour = scheduler.posting_rate(self.posts_per_hour, len(publications), hours)
+        self.poll_interval = scheduler.poll_interval(self.posts_per_hour or 0, len(publications), self.poll_interval,
+                                                     min_interval, max_interval, target_posts)
+        self.next_update_at = now + timedelta(seconds=self.poll_interval)
+        logger.debug("Location `%s` posts %.2f publications per hour, next update in %s seconds" %
+                     (self.name, self.posts_per_hour or 0, self.poll_interval))
+
+    def get_media_between_dates(self, start_date, end_date, adhoc_id, intervals=None):
+        """ Retrieves media from this location and stores only those that belongs to the dates passed by parameter.
+        intervals is a list of (start date, end date) within them, when only part of the dates has to be stored.
+        Dates can also be datetimes, their local dates are used. Returns the number of publications stored
         """
         logger.debug("Getting media from %s and %s por location %s" % (start_date, end_date, self))
-        data, new_min_id = api.getLatestPostsInfo(self.instagramID, min_id=self.latest_media_id,
-                                                  is_adhoc=True, start_date=start_date)
+        if intervals is None:
+            intervals = [(start_date, end_date)]
+        intervals = [(as_local_date(start), as_local_date(end)) for start, end in intervals]
+        # Media is returned newest first, we have to go back to the start of the oldest interval
+        oldest = min(start for start, end in intervals)
+        stored = 0
+        # Locations can be shared with the cities, we can not use their min_id to get past media
+        for page in api.iterLatestPostsPages(self.instagramID, is_adhoc=True, start_date=oldest, prefetch=True):
+            page = [media_post for media_post in page
+                    if any(start <= timezone.localtime(created_from_timestamp_instagram(media_post['created_time']))
+                           .date() <= end for start, end in intervals)]
+            stored += len(self.add_media_page(page, adhoc_id=adhoc_id))
+        return stored
+
+    def add_media_page(self, data, adhoc_id=None):
+        """ Stores a whole page of media, as returned by InstagramAPI.getLatestPostsInfo, in a single transaction.
+        Publications already stored (for the cities, or for the adhoc search) are skipped by the unique indexes on
+        instagramID. Authors and hashtags are resolved in bulk, so the number of queries does not depend on the size
+        of the page. Returns the list of created publications
+        """
+        # Removing publications repeated within the page
+        media = []
+        seen = set()
         for media_post in data:
-            c = created_from_timestamp_instagram(media_post['created_time'])
-            created_time = datetime(c.year, c.month, c.day)
-            logger.debug("Publication with date `%s`" % created_time)
-            publication = self.add_media_from_api(media_post, adhoc_id=adhoc_id)
+            if media_post['id'] not in seen:
+                seen.add(media_post['id'])
+                media.append(media_post)
+        if len(media) == 0:
+            return []
+
+        city_id = self.spot.city_id if adhoc_id is None else None
+        with transaction.atomic():
+            authors = InstagramUser.objects.ids_for_users(
+                dict((m['user']['id'], m['user']['username']) for m in media))
+            hashtags = Hashtag.objects.ids_for_labels(tag for m in media for tag in m['tags'])
+            hashtag_categories = dict()  # hashtag id -> category ids
+            for hashtag_id, category_id in Hashtag.categories.through.objects.filter(
+                    hashtag_id__in=hashtags.values()).values_list('hashtag_id', 'category_id'):
+                hashtag_categories.setdefault(hashtag_id, set()).add(category_id)
+
+            publications = dict()
+            for media_post in media:
+                mediaType = Publication._mt_photo if media_post['type'] == 'image' else Publication._mt_video
+                caption = media_post['caption']['text'] if media_post['caption'] is not None else None
+                publications[media_post['id']] = Publication(instagramID=media_post['id'],
+                                                             publication_date=created_from_timestamp_instagram(
+                                                                 media_post['created_time']),
+                                                             mediaType=mediaType,
+                                                             instagram_url=media_post['link'],
+                                                             caption=caption,
+                                                             likes=media_post['likes']['count'],
+                                                             author_id=authors[media_post['user']['id']],
+                                                             location=self,
+                                                             adhocsearch_id=adhoc_id,
+                                                             city_id=city_id)
+                publications[media_post['id']].set_local_fields()
+                categories = set()
+                for tag in media_post['tags']:
+                    categories.update(hashtag_categories.get(hashtags[tag], ()))
+                publications[media_post['id']].category_ids = sorted(categories)
+            inserted = insert_ignore_conflicts(Publication, publications.values(), Publication.insert_fields,
+                                               returning=['id', 'instagramID'])
+            if len(inserted) < len(publications):
+                logger.warning("%s publications already in database for location `%s`" %
+                               (len(publications) - len(inserted), self.name))
+            created = []
+            for pk, instagram_id in inserted:
+                publications[instagram_id].id = pk
+                created.append(publications[instagram_id])
+
+            # Linking hashtags
+            HashtagPublication = Hashtag.publications.through
+            links = []
+            for media_post in media:
+                publication = publications[media_post['id']]
+                if publication.id is None:
+                    continue
+                for tag in set(media_post['tags']):
+                    links.append(HashtagPublication(hashtag_id=hashtags[tag], publication_id=publication.id))
+            HashtagPublication.objects.bulk_create(links)
+            if adhoc_id is None and city_id is not None:
+                rollups.add_publications([p.id for p in created])
+                # The hashtag index and the sketches are updated by the task merge_pending_publications
+                PendingPublication.objects.bulk_create([PendingPublication(publication_id=p.id, city_id=city_id)
+                                                        for p in created])
+
+        logger.info("%s publications saved for location `%s`" % (len(created), self.name))
+        return created
 
     def add_media_from_api(self, data, adhoc_id=None):
         """ Creates a new Publication item from data provided by a dictionary. The dictionary contains the
         information as described as in https://www.instagram.com/developer/endpoints/media/#get_media
-        Returns the created publication
-        """
-        created_timestamp = created_from_timestamp_instagram(data['created_time'])
-        mediaType = Publication._mt_photo if data['type'] == 'image' else Publication._mt_video
-        try:
-            author, created = InstagramUser.objects.get_or_create(username=data['user']['username'],
-                                                                  instagramID=data['user']['id'])
-        except MultipleObjectsReturned:
-            author = InstagramUser.objects.filter(username=data['user']['username'],
-                                                  instagramID=data['user']['id']).first()
-
-        logger.info("Publication with id %s saved!!!" % data['id'])
-        p = Publication(instagramID=data['id'],
-                       publication_date=created_timestamp,
-                       mediaType=mediaType,
-                       instagram_url=data['link'],
-                       caption=data['caption']['text'] if data['caption'] is not None else None,
-                       likes=data['likes']['count'],
-                       author=author,
-                       location=self,
-                       adhocsearch=ADHOCSearch.objects.get(id=adhoc_id) if adhoc_id is not None else None)
-        p.save()
-        # Linking hashtags
-        for hashtag in data['tags']:
-            hashtag, created = Hashtag.objects.get_or_create(label=hashtag)
-            hashtag.publications.add(p)
-
-        return p
+        Returns the created publication, None if it was already stored
+        """
+        publications = self.add_media_page([data], adhoc_id=adhoc_id)
+        return publications[0] if publications else None
 
     class Meta:
         ordering = None
@@ -266,19 +840,44 @@ class Spot(TimeStampedModel):
     city = models.ForeignKey(City, blank=True, null=True)
     is_adhoc = models.BooleanField(blank=True, default=False)
 
-    def update_locations(self, location_data, is_adhoc=False):
+    def update_locations(self, location_data):
         """ Update the locations related to this spot. location_data is a structure that contains locations in
         instagram. See https://www.instagram.com/developer/endpoints/locations/#get_locations_search
+        New locations are assigned to this spot, existing ones keep their spot. Returns all the locations found
         """
+        self.upsert_locations(location_data)
+        instagram_ids = [location['id'] for location in location_data['data']]
+        return list(InstagramLocation.objects.filter(instagramID__in=instagram_ids).exclude(instagramID='0'))
+
+    def upsert_locations(self, location_data):
+        """ Stores the locations of location_data in a single statement. New locations are assigned to this spot,
+        existing ones keep their spot and get their name and position updated, unless this spot is of a city and
+        theirs is not: locations found first by adhoc searches are adopted by the city. Returns the number of new
+        locations and the number of changed ones
+        """
+        locations = dict()
         for location in location_data['data']:
-            logger.debug("Storing location with id %s" % location['id'])
-            location_in_db = InstagramLocation.objects.filter(instagramID=location['id'])
-            if location_in_db.count() == 0 or is_adhoc:
-                logger.info("New instagram location found named `%s`" % location['name'])
-                position = Point(location['longitude'], location['latitude'])
-                new_location = InstagramLocation(name=location['name'], instagramID=location['id'],
-                                                 position=position, spot=self)
-                new_location.save()
+            if location['id'] != '0':
+                locations[location['id']] = InstagramLocation(
+                    name=location['name'], instagramID=location['id'], spot=self,
+                    position=Point(location['longitude'], location['latitude']))
+        rows = upsert(InstagramLocation, locations.values(),
+                      ['created', 'modified', 'name', 'instagramID', 'position', 'spot', 'updated_at',
+                       'next_update_at', 'poll_interval'],
+                      conflict=['instagramID'], conflict_where='"instagramID" <> \'0\'',
+                      update_fields=['name', 'position'], compare={'position': 'ST_OrderingEquals(%s, %s)'})
+        created = len([pk for pk, inserted in rows if inserted])
+        if created:
+            logger.info("%s new instagram locations found by spot %s" % (created, self.id))
+        if self.city_id is not None and locations:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE instanalysis_instagramlocation l SET spot_id = %s FROM instanalysis_spot s
+                    WHERE s.id = l.spot_id AND s.city_id IS NULL AND l."instagramID" = ANY(%s)""",
+                               [self.id, list(locations.keys())])
+                if cursor.rowcount:
+                    logger.info("%s adhoc locations adopted by spot %s" % (cursor.rowcount, self.id))
+        return created, len(rows) - created
 
     def __unicode__(self):
         if self.city is not None:
@@ -287,12 +886,247 @@ class Spot(TimeStampedModel):
             return "Unassigned spot with id %s" % self.id
 
 
+class LocationHourRollup(models.Model):
+    """ Publications and likes of a location of a city per local date and hour, see instanalysis.rollups
+    """
+    city = models.ForeignKey(City, related_name='+')
+    location = models.ForeignKey(InstagramLocation, related_name='+')
+    date = models.DateField()
+    hour = models.PositiveSmallIntegerField()
+    publications = models.PositiveIntegerField(default=0)
+    likes = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('location', 'date', 'hour'),)
+        index_together = (('city', 'date'),)
+
+
+class HashtagDayRollup(models.Model):
+    """ Publications and likes of a city with a hashtag per local date, see instanalysis.rollups
+    """
+    city = models.ForeignKey(City, related_name='+')
+    date = models.DateField()
+    hashtag = models.ForeignKey(Hashtag, related_name='+')
+    publications = models.PositiveIntegerField(default=0)
+    likes = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('city', 'date', 'hashtag'),)
+
+
+class HashtagSketchManager(models.Manager):
+    """ Sketches are updated with the pending publications (see PendingPublicationManager), so they miss the
+    publications stored in the last minute or so
+    """
+
+    def merge(self, publication_ids):
+        """ Adds to the sketches the hashtags of the publications passed by parameter (ids). Called by
+        PendingPublicationManager.merge, only one runs at a time, so the rows are not locked
+        """
+        counts = dict()  # (city id, date, hour) -> hashtag id -> publications
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT p.city_id, p.local_date, p.local_hour, hp.hashtag_id, COUNT(*)
+                FROM instanalysis_hashtag_publications hp
+                JOIN instanalysis_publication p ON p.id = hp.publication_id
+                WHERE hp.publication_id = ANY(%s) AND p.city_id IS NOT NULL
+                GROUP BY 1, 2, 3, 4""", [list(publication_ids)])
+            for city_id, date, hour, hashtag_id, count in cursor.fetchall():
+                counts.setdefault((city_id, date, hour), dict())[hashtag_id] = count
+        if not counts:
+            return
+        keys = sorted(counts)
+        insert_ignore_conflicts(HashtagSketch, [HashtagSketch(city_id=c, date=d, hour=h, data='')
+                                                for c, d, h in keys], ['city', 'date', 'hour', 'data'])
+        changed = []
+        for sketch in self.filter(city_id__in=set(c for c, d, h in keys), date__in=set(d for c, d, h in keys),
+                                  hour__in=set(h for c, d, h in keys)):
+            window = counts.get((sketch.city_id, sketch.date, sketch.hour))
+            if window is None:
+                continue
+            summary = sketch.summary()
+            summary.update(window)
+            sketch.data = summary.to_bytes()
+            changed.append(sketch)
+        bulk_update(HashtagSketch, changed, ['data'])
+
+    def rebuild(self, city_ids=None):
+        """ Recomputes the sketches of the cities passed by parameter (ids), of all of them when None, from their
+        publications. A city per transaction, its hashtag counts are streamed ordered by date and hour so a single
+        window is kept in memory. Merges wait meanwhile, the pending publications are left to them
+        """
+        if city_ids is None:
+            city_ids = City.objects.values_list('id', flat=True)
+        for city_id in city_ids:
+            with transaction.atomic():
+                lock_pending_merge()
+                self.filter(city_id=city_id).delete()
+                rows = stream("""
+                    SELECT p.local_date, p.local_hour, hp.hashtag_id, COUNT(*)
+                    FROM instanalysis_hashtag_publications hp
+                    JOIN instanalysis_publication p ON p.id = hp.publication_id
+                    WHERE p.city_id = %s AND NOT EXISTS (SELECT 1 FROM instanalysis_pendingpublication pp
+                                                         WHERE pp.publication_id = p.id)
+                    GROUP BY 1, 2, 3 ORDER BY 1, 2""", [city_id], 'hashtag_sketches')
+                sketches = []
+                for (date, hour), counts in groupby(rows, key=lambda row: row[:2]):
+                    summary = SpaceSaving(settings.HASHTAG_SKETCH_CAPACITY)
+                    summary.update(dict((hashtag_id, count) for _, _, hashtag_id, count in counts))
+                    sketches.append(HashtagSketch(city_id=city_id, date=date, hour=hour, data=summary.to_bytes()))
+                    if len(sketches) == INSERT_BATCH_SIZE:
+                        self.bulk_create(sketches)
+                        sketches = []
+                self.bulk_create(sketches)
+            logger.debug("Hashtag sketches of city %s rebuilt" % city_id)
+
+
+class HashtagSketch(models.Model):
+    """ Most frequent hashtags of the publications of a city in a local date and hour, a Space-Saving summary of
+    HASHTAG_SKETCH_CAPACITY counters (see instanalysis.sketches)
+    """
+    city = models.ForeignKey(City, related_name='+')
+    date = models.DateField()
+    hour = models.PositiveSmallIntegerField()
+    data = models.BinaryField()
+
+    objects = HashtagSketchManager()
+
+    class Meta:
+        unique_together = (('city', 'date', 'hour'),)
+
+    def summary(self):
+        return SpaceSaving.from_bytes(self.data or '', settings.HASHTAG_SKETCH_CAPACITY)
+
+
+class DistinctSketchManager(models.Manager):
+    """ Sketches are updated with the pending publications (see PendingPublicationManager), so they miss the
+    publications stored in the last minute or so
+    """
+
+    def merge(self, publication_ids):
+        """ Adds to the sketches the authors and hashtags of the publications passed by parameter (ids). Called by
+        PendingPublicationManager.merge, only one runs at a time, so the rows are not locked
+        """
+        windows = self._sketches("p.id = ANY(%s) AND p.city_id IS NOT NULL", [list(publication_ids)])
+        if not windows:
+            return
+        keys = sorted(windows)
+        insert_ignore_conflicts(DistinctSketch, [DistinctSketch(city_id=c, date=d, hour=h, authors='', hashtags='')
+                                                 for c, d, h in keys], ['city', 'date', 'hour', 'authors', 'hashtags'])
+        changed = []
+        for sketch in self.filter(city_id__in=set(c for c, d, h in keys), date__in=set(d for c, d, h in keys),
+                                  hour__in=set(h for c, d, h in keys)):
+            window = windows.get((sketch.city_id, sketch.date, sketch.hour))
+            if window is None:
+                continue
+            for field in ('authors', 'hashtags'):
+                summary = HyperLogLog.merge([sketch.summary(field), window[field]])
+                setattr(sketch, field, summary.to_bytes())
+            changed.append(sketch)
+        bulk_update(DistinctSketch, changed, ['authors', 'hashtags'])
+
+    def rebuild(self, city_ids=None):
+        """ Recomputes the sketches of the cities passed by parameter (ids), of all of them when None, from their
+        publications. A city per transaction, its authors and hashtags are streamed ordered by date and hour so a
+        single window is kept in memory. Merges wait meanwhile, the pending publications are left to them
+        """
+        if city_ids is None:
+            city_ids = City.objects.values_list('id', flat=True)
+        not_pending = "NOT EXISTS (SELECT 1 FROM instanalysis_pendingpublication pp WHERE pp.publication_id = p.id)"
+        for city_id in city_ids:
+            with transaction.atomic():
+                lock_pending_merge()
+                self.filter(city_id=city_id).delete()
+                rows = stream("""
+                    SELECT p.local_date, p.local_hour, 'authors', p.author_id FROM instanalysis_publication p
+                    WHERE p.city_id = %%s AND p.author_id IS NOT NULL AND %s
+                    UNION ALL
+                    SELECT p.local_date, p.local_hour, 'hashtags', hp.hashtag_id
+                    FROM instanalysis_hashtag_publications hp
+                    JOIN instanalysis_publication p ON p.id = hp.publication_id
+                    WHERE p.city_id = %%s AND %s
+                    ORDER BY 1, 2""" % (not_pending, not_pending), [city_id, city_id], 'distinct_sketches')
+                sketches = []
+                for (date, hour), items in groupby(rows, key=lambda row: row[:2]):
+                    window = dict(authors=HyperLogLog(settings.HLL_PRECISION),
+                                  hashtags=HyperLogLog(settings.HLL_PRECISION))
+                    for _, _, field, item in items:
+                        window[field].add(item)
+                    sketches.append(DistinctSketch(city_id=city_id, date=date, hour=hour,
+                                                   authors=window['authors'].to_bytes(),
+                                                   hashtags=window['hashtags'].to_bytes()))
+                    if len(sketches) == INSERT_BATCH_SIZE:
+                        self.bulk_create(sketches)
+                        sketches = []
+                self.bulk_create(sketches)
+            logger.debug("Distinct sketches of city %s rebuilt" % city_id)
+
+    def _sketches(self, where, params):
+        """ HyperLogLog sketches of the authors and hashtags of the publications p matching the SQL condition where,
+        a dictionary (city id, date, hour) -> field -> HyperLogLog
+        """
+        windows = dict()
+        queries = (('authors', """SELECT p.city_id, p.local_date, p.local_hour, p.author_id
+                                 FROM instanalysis_publication p WHERE p.author_id IS NOT NULL AND (%s)"""),
+                   ('hashtags', """SELECT p.city_id, p.local_date, p.local_hour, hp.hashtag_id
+                                  FROM instanalysis_hashtag_publications hp
+                                  JOIN instanalysis_publication p ON p.id = hp.publication_id WHERE (%s)"""))
+        with connection.cursor() as cursor:
+            for field, sql in queries:
+                cursor.execute(sql % where, params)
+                for city_id, date, hour, item in cursor.fetchall():
+                    window = windows.get((city_id, date, hour))
+                    if window is None:
+                        window = windows[(city_id, date, hour)] = dict(
+                            authors=HyperLogLog(settings.HLL_PRECISION), hashtags=HyperLogLog(settings.HLL_PRECISION))
+                    window[field].add(item)
+        return windows
+
+
+class DistinctSketch(models.Model):
+    """ Distinct authors and hashtags of the publications of a city in a local date and hour, HyperLogLog sketches of
+    2 ** HLL_PRECISION registers (see instanalysis.sketches)
+    """
+    city = models.ForeignKey(City, related_name='+')
+    date = models.DateField()
+    hour = models.PositiveSmallIntegerField()
+    authors = models.BinaryField()
+    hashtags = models.BinaryField()
+
+    objects = DistinctSketchManager()
+
+    class Meta:
+        unique_together = (('city', 'date', 'hour'),)
+
+    def summary(self, field):
+        """ HyperLogLog of the field passed by parameter, authors or hashtags
+        """
+        return HyperLogLog.from_bytes(getattr(self, field), settings.HLL_PRECISION)
+
+
 class SettingManager(models.Manager):
+    """ Settings are read on every API call and on every page view, so values are cached at two levels: in the
+    memory of the process for SETTINGS_LOCAL_CACHE_TTL seconds, and in the shared cache, which is updated every time
+    a setting is saved. A change is then seen by every process after SETTINGS_LOCAL_CACHE_TTL seconds at the most.
+    """
+    _local_cache = dict()  # name -> (value, expiration timestamp)
+
+    def _cache_key(self, option):
+        return "setting:%s" % option
 
     def get_value(self, option):
         """ Returns the option
         """
-        return Setting.objects.get(name=option).value
+        now = time.time()
+        cached = self._local_cache.get(option)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        value = cache.get(self._cache_key(option))
+        if value is None:
+            value = Setting.objects.get(name=option).value
+            cache.set(self._cache_key(option), value, getattr(settings, 'SETTINGS_SHARED_CACHE_TTL', 3600))
+        self._local_cache[option] = (value, now + getattr(settings, 'SETTINGS_LOCAL_CACHE_TTL', 10))
+        return value
 
     def set_value(self, option, value):
         """ Returns the option
@@ -301,6 +1135,16 @@ class SettingManager(models.Manager):
         s.value = value
         s.save()
 
+    def invalidate(self, option, value=None):
+        """ Removes the option from the caches. When value is provided, the shared cache is updated with it
+        """
+        self._local_cache.pop(option, None)
+        if value is None:
+            cache.delete(self._cache_key(option))
+        else:
+            cache.set(self._cache_key(option), value, getattr(settings, 'SETTINGS_SHARED_CACHE_TTL', 3600))
+
+
 class Setting(TimeStampedModel):
     """ Application information
     """
@@ -310,11 +1154,13 @@ class Setting(TimeStampedModel):
 
     objects = SettingManager()
 
+    def save(self, *args, **kwargs):
+        super(Setting, self).save(*args, **kwargs)
+        Setting.objects.invalidate(self.name, unicode(self.value))
 
-class InstagramRequest(TimeStampedModel):
-    """ Requests done to nstagram API
-    """
-    pass
+    def delete(self, *args, **kwargs):
+        Setting.objects.invalidate(self.name)
+        super(Setting, self).delete(*args, **kwargs)
 
 
 class ExportForm(TimeStampedModel):
@@ -0,0 +1,137 @@
+""" Decides which part of an adhoc search can be answered with the media already stored, for the cities or for
+previous searches of the same area, and which one has to be downloaded from Instagram. Dates are local dates
+(settings.TIME_ZONE), intervals are (start, end) tuples of dates, both included.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import ADHOCSearch, ADHOCSearchSource, InstagramLocation, Spot
+from .geo import distance_meters, hex_vertices
+from .utils import day_range
+
+logger = logging.getLogger(__name__)
+
+
+def subtract_intervals(interval, covered):
+    """ Returns the parts of interval that are not within any of the covered intervals, sorted
+    """
+    missing = []
+    start, end = interval
+    for covered_start, covered_end in sorted(covered):
+        if covered_end < start or covered_start > end:
+            continue
+        if covered_start > start:
+            missing.append((start, covered_start - timedelta(days=1)))
+        start = max(start, covered_end + timedelta(days=1))
+        if start > end:
+            break
+    if start <= end:
+        missing.append((start, end))
+    return missing
+
+
+def local_interval(location, start_date, end_date, now=None):
+    """ Returns the interval of dates, within start_date and end_date, whose media of the location passed by
+    parameter is already stored, or None. Monitored locations have all their media since the day after they were
+    found (their first update only downloads the latest media), until their last update. A location updated less
+    than ADHOC_LOCAL_MAX_DELAY seconds before the end of the search is considered up to date
+    """
+    if location.latest_media_id is None or location.updated_at is None:
+        return None
+    now = now or timezone.now()
+    since = timezone.localtime(location.created).date() + timedelta(days=1)
+    end_of_search = min(day_range(end_date, end_date)[1], now)
+    if location.updated_at >= end_of_search - timedelta(seconds=settings.ADHOC_LOCAL_MAX_DELAY):
+        until = end_date
+    else:
+        # The media of the day of the last update may be incomplete
+        until = timezone.localtime(location.updated_at).date() - timedelta(days=1)
+    start, end = max(start_date, since), min(end_date, until)
+    return (start, end) if start <= end else None
+
+
+def monitored_area_covers(lat, lng, radius):
+    """ Whether the circle passed by parameter is within the area whose locations are searched for the cities, that
+    is, its center and the vertices of its inscribed hexagon are within CITY_SPOT_RADIUS of a city spot. New locations
+    are found there by the periodic update of locations, so the circle does not need a location search
+    """
+    points = [(lat, lng)] + hex_vertices(lat, lng, radius)
+    spots = Spot.objects.filter(city__isnull=False).extra(
+        where=['ST_DWithin("instanalysis_spot"."position"::geography, '
+               'ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography, %s)'],
+        params=[lng, lat, radius + settings.CITY_SPOT_RADIUS])
+    spots = [(spot.position.y, spot.position.x) for spot in spots]
+    return all(any(distance_meters(point[0], point[1], spot[0], spot[1]) <= settings.CITY_SPOT_RADIUS
+                   for spot in spots) for point in points)
+
+
+def reused_searches(adhoc_search):
+    """ Returns the sources (ADHOCSearchSource instances, not saved) of the finished searches of the same area whose
+    dates overlap with the ones of the adhoc search, and the intervals they cover. The most recent searches are used
+    first, every date is taken from a single search
+    """
+    requested = (adhoc_search.start_date, adhoc_search.end_date)
+    previous = ADHOCSearch.objects.filter(area_key=adhoc_search.area_key, status=ADHOCSearch._mt_finished,
+                                          start_date__lte=adhoc_search.end_date,
+                                          end_date__gte=adhoc_search.start_date)
+    sources = []
+    covered = []
+    for search in previous.exclude(id=adhoc_search.id).order_by('-created'):
+        start, end = search.covered_interval()
+        start, end = max(start, requested[0]), min(end, requested[1])
+        if start > end:
+            continue
+        for interval in subtract_intervals((start, end), covered):
+            sources.append(ADHOCSearchSource(adhoc_search=adhoc_search, search=search,
+                                             start_date=interval[0], end_date=interval[1]))
+            covered.append(interval)
+    return sources, sorted(covered)
+
+
+class AdhocPlan(object):
+    """ Result of plan_adhoc_search.
+
+    :param sources: ADHOCSearchSource instances, not saved, of the data answered from the database
+    :param fetch: Dictionary location id -> list of intervals to download from Instagram
+    """
+
+    def __init__(self, sources, fetch):
+        self.sources = sources
+        self.fetch = fetch
+
+    def save(self):
+        ADHOCSearchSource.objects.bulk_create(self.sources)
+
+
+def plan_adhoc_search(adhoc_search, locations, reused=None):
+    """ Plans the download of the adhoc search, locations are all the locations within its circle and reused the
+    result of reused_searches. Dates covered by previous searches are taken from them. For the rest, media of the
+    monitored locations is answered from the database for the dates they are up to date, the rest is downloaded
+    """
+    requested = (adhoc_search.start_date, adhoc_search.end_date)
+    now = timezone.now()
+    sources, reused_intervals = reused if reused is not None else ([], [])
+    sources = list(sources)
+    fetch = dict()
+    monitored = set(InstagramLocation.objects.monitored().filter(id__in=[l.id for l in locations])
+                                                        .values_list('id', flat=True))
+    local_locations = 0
+    for location in locations:
+        covered = list(reused_intervals)
+        if location.id in monitored:
+            interval = local_interval(location, adhoc_search.start_date, adhoc_search.end_date, now)
+            if interval is not None:
+                for start, end in subtract_intervals(interval, reused_intervals):
+                    covered.append((start, end))
+                    sources.append(ADHOCSearchSource(adhoc_search=adhoc_search, location=location,
+                                                     start_date=start, end_date=end))
+                local_locations += 1
+        missing = subtract_intervals(requested, covered)
+        if missing:
+            fetch[location.id] = missing
+    logger.debug("Adhoc search `%s`: %s dates reused from previous searches, %s locations answered from the "
+                 "database, %s downloaded" % (adhoc_search.id, reused_intervals, local_locations, len(fetch)))
+    return AdhocPlan(sources, fetch)
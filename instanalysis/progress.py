@@ -0,0 +1,121 @@
+""" Progress of the background jobs (adhoc searches and exports), written by the Celery tasks to redis and read by
+the views. Every change increments the version of the job and is published on its channel, so a view can block
+until the progress changes instead of polling the database.
+
+Example:
+    >>> progress = JobProgress('adhoc', 12)
+    >>> progress.start(locations_total=40)
+    >>> progress.increment(locations_done=1, publications=230)
+    >>> progress.wait(version=1, timeout=20)
+    {'status': 'running', 'locations_total': 40, 'locations_done': 1, 'publications': 230, 'eta': 35, ...}
+"""
+import json
+import logging
+import time
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+RUNNING, FINISHED, ERROR = 'running', 'finished', 'error'
+
+_redis = None
+
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.StrictRedis.from_url(settings.PROGRESS_REDIS_URL)
+    return _redis
+
+
+class JobProgress(object):
+    """ Progress of a job, stored in a redis hash whose values are JSON encoded. Fields are free, `status`,
+    `started`, `updated` and `version` are set by this class. When `<name>_total` and `<name>_done` fields are set,
+    the estimated seconds to finish are returned as `eta`.
+    Errors of redis are logged and ignored, progress is informative only.
+
+    :param kind: Kind of job, as 'adhoc' or 'export'
+    :param job_id: Id of the job within its kind
+    """
+
+    def __init__(self, kind, job_id):
+        self.key = "progress:%s:%s" % (kind, job_id)
+        self.channel = self.key
+
+    def _write(self, fields, increments=None):
+        fields = dict(fields, updated=time.time())
+        try:
+            pipe = get_redis().pipeline()
+            pipe.hmset(self.key, dict((name, json.dumps(value)) for name, value in fields.items()))
+            for name, amount in (increments or {}).items():
+                pipe.hincrby(self.key, name, amount)
+            pipe.hincrby(self.key, 'version', 1)
+            pipe.expire(self.key, settings.PROGRESS_TTL)
+            result = pipe.execute()
+            get_redis().publish(self.channel, result[-2])
+        except redis.RedisError as e:
+            logger.warning("Progress of `%s` could not be written: %s" % (self.key, e))
+
+    def start(self, **fields):
+        self._write(dict(fields, status=RUNNING, started=time.time()))
+
+    def update(self, **fields):
+        self._write(fields)
+
+    def increment(self, **amounts):
+        """ Adds the amounts passed by parameter to integer fields
+        """
+        self._write({}, amounts)
+
+    def finish(self, **fields):
+        self._write(dict(fields, status=FINISHED))
+
+    def error(self, **fields):
+        self._write(dict(fields, status=ERROR))
+
+    def get(self):
+        """ Returns the progress as a dictionary, None when the job has no progress stored
+        """
+        try:
+            data = get_redis().hgetall(self.key)
+        except redis.RedisError as e:
+            logger.warning("Progress of `%s` could not be read: %s" % (self.key, e))
+            return None
+        if not data:
+            return None
+        progress = dict((name, json.loads(value)) for name, value in data.items())
+        if progress.get('status') == RUNNING:
+            for name in progress.keys():
+                if not name.endswith('_total') or not progress[name]:
+                    continue
+                done = progress.get(name[:-len('_total')] + '_done', 0)
+                if done and 'started' in progress:
+                    elapsed = time.time() - progress['started']
+                    progress['eta'] = int(elapsed * (progress[name] - done) / done)
+        return progress
+
+    def wait(self, version=None, timeout=None):
+        """ Returns the progress once its version is not the one passed by parameter, or after timeout seconds
+        """
+        timeout = settings.PROGRESS_WAIT_TIMEOUT if timeout is None else timeout
+        pubsub = None
+        try:
+            # Subscribing before reading, a change published in between is not lost
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(self.channel)
+            progress = self.get()
+            deadline = time.time() + timeout
+            while (progress is None or progress.get('version') == version) and time.time() < deadline:
+                if pubsub.get_message(timeout=max(min(deadline - time.time(), 1), 0)) is not None:
+                    progress = self.get()
+            return progress
+        except redis.RedisError as e:
+            # Clients ask again as soon as they get an answer, they are slowed down while redis is failing
+            logger.warning("Progress of `%s` could not be waited: %s" % (self.key, e))
+            time.sleep(min(timeout, settings.PROGRESS_ERROR_DELAY))
+            return self.get()
+        finally:
+            if pubsub is not None:
+                pubsub.close()
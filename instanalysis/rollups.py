@@ -0,0 +1,220 @@
+""" Rollups of the publications of the cities: counts and likes pre-aggregated at two grains, so the statistics of
+the map do not read the publications.
+- LocationHourRollup: per city, location, local date and local hour
+- HashtagDayRollup: per city, local date and hashtag
+Rollups are updated by InstagramLocation.add_media_page in the transaction that stores the publications, and
+rebuilt by the command rebuild_rollups. Publications of adhoc searches are not rolled up.
+Dates and hours are local (settings.TIME_ZONE), weekdays follow Django's __week_day (1 is Sunday).
+
+Only SQL is used here, models.py imports this module.
+"""
+import logging
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .sketches import HyperLogLog, SpaceSaving, top_items
+
+logger = logging.getLogger(__name__)
+
+LOCATION_ROLLUP_TABLE = 'instanalysis_locationhourrollup'
+HASHTAG_ROLLUP_TABLE = 'instanalysis_hashtagdayrollup'
+
+# Rows are grouped and sorted by the conflict columns, so concurrent workers lock them in the same order
+LOCATION_ROLLUP_SQL = """
+    INSERT INTO instanalysis_locationhourrollup AS r (city_id, location_id, date, hour, publications, likes)
+    SELECT s.city_id, p.location_id, (p.publication_date AT TIME ZONE %%s)::date,
+           EXTRACT(hour FROM p.publication_date AT TIME ZONE %%s), COUNT(*), SUM(p.likes)
+    FROM instanalysis_publication p
+    JOIN instanalysis_instagramlocation l ON l.id = p.location_id
+    JOIN instanalysis_spot s ON s.id = l.spot_id
+    WHERE s.city_id IS NOT NULL AND p.adhocsearch_id IS NULL AND %s
+    GROUP BY 1, 2, 3, 4 ORDER BY 2, 3, 4
+    ON CONFLICT (location_id, date, hour) DO UPDATE
+    SET publications = r.publications + EXCLUDED.publications, likes = r.likes + EXCLUDED.likes
+"""
+
+HASHTAG_ROLLUP_SQL = """
+    INSERT INTO instanalysis_hashtagdayrollup AS r (city_id, date, hashtag_id, publications, likes)
+    SELECT s.city_id, (p.publication_date AT TIME ZONE %%s)::date, hp.hashtag_id, COUNT(*), SUM(p.likes)
+    FROM instanalysis_hashtag_publications hp
+    JOIN instanalysis_publication p ON p.id = hp.publication_id
+    JOIN instanalysis_instagramlocation l ON l.id = p.location_id
+    JOIN instanalysis_spot s ON s.id = l.spot_id
+    WHERE s.city_id IS NOT NULL AND p.adhocsearch_id IS NULL AND %s
+    GROUP BY 1, 2, 3 ORDER BY 1, 2, 3
+    ON CONFLICT (city_id, date, hashtag_id) DO UPDATE
+    SET publications = r.publications + EXCLUDED.publications, likes = r.likes + EXCLUDED.likes
+"""
+
+
+def _roll_up(where, params):
+    tz = settings.TIME_ZONE
+    with connection.cursor() as cursor:
+        cursor.execute(LOCATION_ROLLUP_SQL % where, [tz, tz] + params)
+        cursor.execute(HASHTAG_ROLLUP_SQL % where, [tz] + params)
+
+
+def add_publications(publication_ids):
+    """ Adds the publications passed by parameter (ids) to the rollups. Has to be called in the transaction that
+    stores them, once their hashtags are linked, and only once per publication
+    """
+    if publication_ids:
+        _roll_up("p.id = ANY(%s)", [list(publication_ids)])
+
+
+@transaction.atomic
+def rebuild(city_ids=None):
+    """ Recomputes the rollups of the cities passed by parameter (ids), of all of them when None. The rollups are
+    locked until the transaction finishes: publications stored meanwhile wait for it, and are added after the rebuild
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("LOCK TABLE %s, %s IN EXCLUSIVE MODE" % (LOCATION_ROLLUP_TABLE, HASHTAG_ROLLUP_TABLE))
+        if city_ids is None:
+            where, params = "true", []
+        else:
+            where, params = "s.city_id = ANY(%s)", [list(city_ids)]
+        for table in (LOCATION_ROLLUP_TABLE, HASHTAG_ROLLUP_TABLE):
+            cursor.execute("DELETE FROM %s s WHERE %s" % (table, where), params)
+    _roll_up(where, params)
+    logger.info("Rollups rebuilt for %s" % ("all cities" if city_ids is None else "cities %s" % list(city_ids)))
+
+
+def _date_filters(start_date, end_date, month, weekday):
+    where, params = [], []
+    if start_date is not None:
+        where.append("r.date >= %s")
+        params.append(start_date)
+    if end_date is not None:
+        where.append("r.date <= %s")
+        params.append(end_date)
+    if month is not None:
+        where.append("EXTRACT(month FROM r.date) = %s")
+        params.append(month)
+    if weekday is not None:
+        where.append("EXTRACT(dow FROM r.date) + 1 = %s")
+        params.append(weekday)
+    return where, params
+
+
+def city_statistics(city_id, start_date=None, end_date=None, month=None, weekday=None, hours=None,
+                    hashtag_id=None, exact=False):
+    """ Statistics of the map for the publications of a city, computed from the rollups in a single statement.
+    Dates are local dates (both included), hours a list of local hours and hashtag_id the id of a hashtag the
+    publications must have. Returns a dictionary with:
+    - num_publications and likes of the publications within the filters
+    - hashtags (top 100, as dictionaries with id, hashtag__label and count) and num_hashtags, or None for both when
+      filtering by hours or by hashtag, the rollups do not have them at that grain. When filtering by hours, unless
+      exact, hashtags are estimated from the hashtag sketches (see sketch_top_hashtags). Without exact, num_hashtags
+      is estimated from the distinct sketches (see sketch_distinct_counts)
+    - num_authors, estimated from the distinct sketches, or None with exact or hashtag_id: distinct counts are not
+      additive, they are not in the rollups
+    - locations (positions of the locations of the city), oldest_location (their oldest update) and total_posts
+    hashtag_id and hours can not be used together, see can_answer.
+    """
+    date_where, date_params = _date_filters(start_date, end_date, month, weekday)
+    city_where = ["r.city_id = %s"]
+    totals_where, totals_params = city_where + date_where, [city_id] + date_params
+    if hashtag_id is not None:
+        totals_table = HASHTAG_ROLLUP_TABLE
+        totals_where.append("r.hashtag_id = %s")
+        totals_params.append(hashtag_id)
+    else:
+        totals_table = LOCATION_ROLLUP_TABLE
+        if hours is not None:
+            totals_where.append("r.hour = ANY(%s)")
+            totals_params.append(list(hours))
+    with_hashtags = hours is None and hashtag_id is None
+    hashtags_sql = "NULL, NULL"
+    hashtags_params = []
+    if with_hashtags:
+        where = " AND ".join(city_where + date_where)
+        # Without exact, the distinct hashtags are estimated from the sketches below
+        distinct_sql = "NULL"
+        if exact:
+            distinct_sql = "(SELECT COUNT(DISTINCT r.hashtag_id) FROM %s r WHERE %s)" % (HASHTAG_ROLLUP_TABLE, where)
+            hashtags_params += [city_id] + date_params
+        hashtags_sql = """
+            %(distinct)s,
+            (SELECT json_agg(t) FROM (SELECT h.id, h.label AS hashtag__label, t.count
+                                      FROM (SELECT r.hashtag_id, SUM(r.publications) AS count FROM %(table)s r
+                                            WHERE %(where)s GROUP BY r.hashtag_id
+                                            ORDER BY count DESC LIMIT 100) t
+                                      JOIN instanalysis_hashtag h ON h.id = t.hashtag_id
+                                      ORDER BY t.count DESC) t)
+        """ % {"distinct": distinct_sql, "table": HASHTAG_ROLLUP_TABLE, "where": where}
+        hashtags_params += [city_id] + date_params
+    sql = """
+        WITH city_locations AS (SELECT l.position, l.updated_at FROM instanalysis_instagramlocation l
+                                WHERE l.id IN (SELECT r.location_id FROM %(locations)s r WHERE r.city_id = %%s))
+        SELECT (SELECT COALESCE(SUM(r.publications), 0) FROM %(totals)s r WHERE %(where)s),
+               (SELECT COALESCE(SUM(r.likes), 0) FROM %(totals)s r WHERE %(where)s),
+               %(hashtags)s,
+               (SELECT json_agg(json_build_object('lat', ST_Y(position), 'lng', ST_X(position)))
+                FROM city_locations),
+               (SELECT MIN(updated_at) FROM city_locations),
+               (SELECT COALESCE(SUM(r.publications), 0) FROM %(locations)s r WHERE r.city_id = %%s)
+    """ % {"locations": LOCATION_ROLLUP_TABLE, "totals": totals_table, "where": " AND ".join(totals_where),
+           "hashtags": hashtags_sql}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [city_id] + totals_params * 2 + hashtags_params + [city_id])
+        row = cursor.fetchone()
+    statistics = {"num_publications": row[0], "likes": row[1],
+                  "num_hashtags": row[2], "hashtags": (row[3] or []) if with_hashtags else None,
+                  "locations": row[4] or [], "oldest_location": row[5], "total_posts": row[6]}
+    statistics['num_authors'] = None
+    if hashtag_id is None and not exact:
+        num_authors, num_hashtags = sketch_distinct_counts(city_id, start_date, end_date, month, weekday, hours)
+        statistics['num_authors'], statistics['num_hashtags'] = num_authors, num_hashtags
+        if hours is not None:
+            statistics['hashtags'] = sketch_top_hashtags(city_id, start_date, end_date, month, weekday, hours)
+    return statistics
+
+
+def _sketch_filters(city_id, start_date, end_date, month, weekday, hours):
+    where, params = _date_filters(start_date, end_date, month, weekday)
+    where, params = ["r.city_id = %s"] + where, [city_id] + params
+    if hours is not None:
+        where.append("r.hour = ANY(%s)")
+        params.append(list(hours))
+    return " AND ".join(where), params
+
+
+def sketch_distinct_counts(city_id, start_date=None, end_date=None, month=None, weekday=None, hours=None):
+    """ Estimated number of distinct authors and of distinct hashtags of the publications of a city, merging the
+    HyperLogLog sketches of the dates and hours within the filters (see instanalysis.sketches for the error)
+    """
+    where, params = _sketch_filters(city_id, start_date, end_date, month, weekday, hours)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT r.authors, r.hashtags FROM instanalysis_distinctsketch r WHERE %s" % where, params)
+        rows = cursor.fetchall()
+    precision = settings.HLL_PRECISION
+    authors = HyperLogLog.merge([HyperLogLog.from_bytes(row[0], precision) for row in rows], precision)
+    hashtags = HyperLogLog.merge([HyperLogLog.from_bytes(row[1], precision) for row in rows], precision)
+    return authors.count(), hashtags.count()
+
+
+def sketch_top_hashtags(city_id, start_date=None, end_date=None, month=None, weekday=None, hours=None, k=100):
+    """ Top k hashtags of the publications of a city, merging the hashtag sketches of the dates and hours within the
+    filters (see instanalysis.sketches). Counts are estimates: they exceed the real ones by at most the sum of the
+    floors of the sketches merged, and are exact when no sketch dropped hashtags
+    """
+    where, params = _sketch_filters(city_id, start_date, end_date, month, weekday, hours)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT r.data FROM instanalysis_hashtagsketch r WHERE %s" % where, params)
+        top = top_items([SpaceSaving.from_bytes(data, settings.HASHTAG_SKETCH_CAPACITY)
+                         for data, in cursor.fetchall()], k)
+        if not top:
+            return []
+        cursor.execute("SELECT id, label FROM instanalysis_hashtag WHERE id = ANY(%s)", [[item for item, c, g in top]])
+        labels = dict(cursor.fetchall())
+    return [{"id": item, "hashtag__label": labels.get(item), "count": count} for item, count, guaranteed in top]
+
+
+def can_answer(hashtags, categories, hours):
+    """ Whether city_statistics can answer the filters: hashtags and categories are the labels filtered. Categories
+    are not rolled up, and hashtags are rolled up per day, alone
+    """
+    if categories:
+        return False
+    return not hashtags or (len(hashtags) == 1 and hours is None)
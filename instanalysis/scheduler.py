@@ -0,0 +1,97 @@
+import heapq
+import logging
+import time
+
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Weight of the last poll in the posting rate of a location
+RATE_SMOOTHING = 0.3
+
+
+def poll_settings():
+    """ Returns the minimum and maximum seconds between two polls of a location, and the number of new posts we
+    expect to find on each poll
+    """
+    from instanalysis.models import Setting
+    return (int(Setting.objects.get_value('poll_min_interval')),
+            int(Setting.objects.get_value('poll_max_interval')),
+            int(Setting.objects.get_value('poll_target_posts')))
+
+
+def posting_rate(previous_rate, new_posts, hours):
+    """ Returns the posts per hour of a location, smoothing the rate observed in the last poll with the previous one
+    """
+    if hours <= 0:
+        return previous_rate
+    observed = new_posts / hours
+    if previous_rate is None:
+        return observed
+    return RATE_SMOOTHING * observed + (1 - RATE_SMOOTHING) * previous_rate
+
+
+def poll_interval(rate, new_posts, previous_interval, min_interval, max_interval, target_posts):
+    """ Returns the seconds to wait until the next poll of a location. Locations are polled when we expect
+    target_posts new posts. When a poll finds nothing the interval is doubled, so dormant locations are polled
+    exponentially less
+    """
+    if new_posts == 0:
+        interval = max(previous_interval, min_interval) * 2
+    elif rate > 0:
+        interval = target_posts * 3600.0 / rate
+    else:
+        interval = max_interval
+    return int(min(max(interval, min_interval), max_interval))
+
+
+def expected_requests_per_hour(intervals):
+    """ Returns the number of API requests per hour needed to poll locations with the intervals passed by parameter
+    """
+    return sum(3600.0 / interval for interval in intervals if interval > 0)
+
+
+class PollScheduler(object):
+    """ Priority queue of locations ordered by the time of their next poll. The queue is loaded from the database
+    in batches and reloaded when it is empty or older than refresh seconds, so changes done by other processes
+    are taken into account.
+
+    :param batch_size: Number of locations loaded at once
+    :param refresh: Seconds after which the queue is reloaded
+    """
+
+    def __init__(self, batch_size=500, refresh=60):
+        self.batch_size = batch_size
+        self.refresh = refresh
+        self.heap = []
+        self.loaded_at = 0
+
+    def load(self, exclude=()):
+        from instanalysis.models import InstagramLocation
+        locations = InstagramLocation.objects.monitored().exclude(id__in=list(exclude))
+        locations = locations.order_by('next_update_at')[:self.batch_size]
+        self.heap = [(location.next_update_at, location.id, location) for location in locations]
+        heapq.heapify(self.heap)
+        self.loaded_at = time.time()
+
+    def next_location(self, exclude=()):
+        """ Returns the location whose poll is most overdue, None when no location has to be polled yet
+        """
+        if not self.heap or time.time() - self.loaded_at > self.refresh:
+            self.load(exclude)
+        now = timezone.now()
+        while self.heap:
+            next_update_at, location_id, location = self.heap[0]
+            if next_update_at > now:
+                return None
+            heapq.heappop(self.heap)
+            if location_id not in exclude:
+                return location
+        return None
+
+    def expected_requests_per_hour(self):
+        """ Returns the number of API requests per hour needed to poll all locations as scheduled
+        """
+        from instanalysis.models import InstagramLocation
+        intervals = InstagramLocation.objects.monitored().values_list('poll_interval', flat=True)
+        return expected_requests_per_hour(intervals)
@@ -1,22 +1,37 @@
 from __future__ import absolute_import
+import base64
 import os
 import time
 import traceback
-from datetime import timedelta
-from django.utils import timezone
+from multiprocessing.pool import ThreadPool
+from django.utils.dateparse import parse_date
+from celery import chord, group
 from celery.decorators import task
 from celery.utils.log import get_task_logger
 from django.core.management import call_command
 from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.db import connection
 from django.db.models import F, Count
 
-from instanalysis.apps.instagram.api import InstagramAPI, APIGramException
+from instanalysis import api
+from instanalysis.apps.instagram.api import APIGramException
+from instanalysis.apps.instagram.quota import ConcurrencyLimiter
 
-from .models import Category, Hashtag, ADHOCSearch, PublicationADHOC, Setting
-from .models import InstagramRequest, Setting, Spot, InstagramLocation, ExportForm, Publication
+from .models import Category, Hashtag, ADHOCSearch, PublicationADHOC
+from .models import Setting, Spot, InstagramLocation, ExportForm, Publication, refresh_publication_categories
+from .models import PendingPublication
+from .bitmaps import RoaringBitmap
+from .cache import identity_cache_stats
+from .geo import distance_meters, hex_grid
+from .progress import JobProgress
+from .planner import monitored_area_covers, plan_adhoc_search, reused_searches, subtract_intervals
 
 logger = get_task_logger(__name__)
 
+# Slots of the adhoc searches downloading locations, shared by all the workers
+adhoc_slots = ConcurrencyLimiter('adhoc', settings.ADHOC_MAX_CONCURRENCY)
+
 
 @task
 def reset_adhoc():
@@ -28,35 +43,34 @@ def reset_adhoc():
 
 
 @task()
-def calculate_api_quotas():
+def update_media():
     """
-    Calculates the geonames quotas for the last hour and day
+    Updates media when necessary
     """
-    # Deleting older requests than a day ago
-    # day_ago = timezone.now() - timedelta(days=1)
-    hour_ago = timezone.now() - timedelta(seconds=60 * 60)
+    call_command('update_media')
 
-    oldest = InstagramRequest.objects.filter(created__lt=hour_ago)
-    num_deleted, deleted_per_object = oldest.delete()
-    logger.debug("Deleted `%s` instagram requests" % num_deleted)
 
-    # Caculating instagram quota
-    count = InstagramRequest.objects.filter(created__gte=hour_ago).count()
-    logger.debug("Instagram API usage quota is `%s`" % count)
-    s = Setting.objects.get(name="instagram_hourly")
-    s.value = count
-    s.save()
 
-    
+@task()
+def update_locations():
+    """
+    Updates the locations of all the cities
+    """
+    call_command('update_locations')
 
 
 @task()
-def update_media():
+def merge_pending_publications():
     """
-    Updates media when necessary
+    Merges the publications stored since the last run into the hashtag index, see PendingPublicationManager
     """
-    call_command('update_media')
-
+    merged = 0
+    while True:
+        count = PendingPublication.objects.merge()
+        merged += count
+        if count < settings.PENDING_MERGE_BATCH_SIZE:
+            break
+    logger.debug("%s pending publications merged" % merged)
 
 
 @task()
@@ -88,6 +102,11 @@ def process_csv_file(filepath_local):
                 categories_objects[c] = c_obj
         #Read the rest of the file
         rows = fileparam[1:]
+        labels = [r.split(",")[0].replace("#", "") for r in rows]
+        # Resolving all hashtags at once, creating the new ones
+        hashtag_ids = Hashtag.objects.ids_for_labels([label for label in labels if label != ''])
+        HashtagCategory = Hashtag.categories.through
+        changed = set()  # Ids of the hashtags whose categories changed
         for r in rows:
 
             values = r.split(",")
@@ -96,86 +115,219 @@ def process_csv_file(filepath_local):
                 hashtag_label = values[0].replace("#","") #Delete '#' because the model returns the label with #
                 if hashtag_label != '':
                     logger.debug("Processing hashtag %s" % hashtag_label)
-                    #Check if hashtag exists
-                    h_obj = None #Null object
-                    try:
-                        h_obj = Hashtag.objects.get(label=hashtag_label)
-                    except:
-                        #Create a new hashtag
-                        h_obj = Hashtag()
-                        h_obj.label = hashtag_label
-                        h_obj.save()
-                    
+                    h_id = hashtag_ids[hashtag_label]
+                    current = set(HashtagCategory.objects.filter(hashtag_id=h_id)
+                                                         .values_list('category_id', flat=True))
+
                     #Delete first column
                     values = values[1:]
 
+                    to_add = set()
+                    to_remove = set()
                     for i in range(len(values)):
                         c_label = categories[i].strip()
                         c_obj = categories_objects[c_label]
                         val = values[i].lower().strip()
                         if val.lower() != 'x':
-                            logger.debug("Removing category `%s` to hashtag `%s`" % (c_label, h_obj.label))
-                            if h_obj.categories.filter(label=c_label).exists():
-                                h_obj.categories.remove(c_obj)
-                        else:
-                            logger.debug("Adding category `%s` to hashtag `%s`" % (c_label, h_obj.label))
-                            #Check if category does not exists in the ManyToMany
-                            if not h_obj.categories.filter(label=c_label).exists():
-                                h_obj.categories.add(c_obj)
+                            if c_obj.id in current:
+                                logger.debug("Removing category `%s` to hashtag `%s`" % (c_label, hashtag_label))
+                                to_remove.add(c_obj.id)
+                        elif c_obj.id not in current:
+                            logger.debug("Adding category `%s` to hashtag `%s`" % (c_label, hashtag_label))
+                            to_add.add(c_obj.id)
+                    if to_remove:
+                        HashtagCategory.objects.filter(hashtag_id=h_id, category_id__in=to_remove).delete()
+                    if to_add:
+                        HashtagCategory.objects.bulk_create([HashtagCategory(hashtag_id=h_id, category_id=c_id)
+                                                             for c_id in to_add])
+                    if to_add or to_remove:
+                        changed.add(h_id)
+        if changed:
+            updated = refresh_publication_categories(changed)
+            logger.debug("Categories of %s publications of %s hashtags refreshed" % (updated, len(changed)))
+
+    logger.debug("Identity caches: %s" % identity_cache_stats())
+
+
+def adhoc_search_error(adhoc_search, error):
+    """ Marks the adhoc search as failed
+    """
+    logger.error("Exception occurred on Adhoc Search with id `%s`: Exception is %s" % (adhoc_search.id, error))
+    adhoc_search.status = ADHOCSearch._mt_error
+    adhoc_search.traceback = error
+    adhoc_search.save()
+    Setting.objects.set_value('is_adhoc_running', '0')
+    JobProgress('adhoc', adhoc_search.id).error()
+
+
+def find_adhoc_locations(adhoc_search):
+    """ Searches the locations within the radius of the adhoc search. The circle is covered with spots of radius
+    ADHOC_SPOT_RADIUS (see instanalysis.geo.hex_grid), which are queried in parallel. Locations found by several
+    spots are assigned to the first one, and those out of the circle are discarded. Spots within the area monitored
+    for the cities are not queried, their locations are already stored
+    """
+    lat, lng = adhoc_search.position.y, adhoc_search.position.x
+    search_radius = min(adhoc_search.radius, settings.ADHOC_SPOT_RADIUS)
+    centers = [center for center in hex_grid(lat, lng, adhoc_search.radius, search_radius)
+               if not monitored_area_covers(center[0], center[1], search_radius)]
+    logger.debug("Creating %s spots for this search in %s" % (len(centers), adhoc_search.position))
+    if not centers:
+        return []
+
+    def search(center):
+        try:
+            return api.getLocations(center[0], center[1], radius=search_radius)
+        except APIGramException as e:
+            logger.warning("APIGramException happened with answer: %s" % e)
+            return None
+        finally:
+            # The API client may read settings from the database
+            connection.close()
+
+    pool = ThreadPool(min(len(centers), settings.ADHOC_MAX_CONCURRENCY))
+    try:
+        results = pool.map(search, centers)
+    finally:
+        pool.close()
+    if all(result is None for result in results):
+        raise APIGramException("Locations could not be obtained for any spot")
+
+    locations = []
+    seen = set()
+    for center, location_data in zip(centers, results):
+        if not location_data:
+            continue
+        found = [location for location in location_data['data']
+                 if location['id'] not in seen and
+                 distance_meters(lat, lng, location['latitude'], location['longitude']) <= adhoc_search.radius]
+        logger.debug("Obtained %s new locations here: %s" % (len(found), center))
+        if not found:
+            continue
+        seen.update(location['id'] for location in found)
+        spot = Spot(position=Point(center[1], center[0]), is_adhoc=True)
+        spot.save()
+        locations.extend(spot.update_locations({'data': found}))
+    return locations
 
 
 @task
 def process_adhoc_search(adhoc_search_pk):
-    """ Makes an adhoc search
+    """ Makes an adhoc search. The locations around its position are searched, and the media that is not already
+    stored, for the cities or for previous searches (see instanalysis.planner), is downloaded in parallel, one task
+    per location. The search is finished by finish_adhoc_search once all of them are done.
     """
     adhoc_search = ADHOCSearch.objects.get(id=adhoc_search_pk)
     try:
         Setting.objects.set_value('is_adhoc_running', '1')
-        api = InstagramAPI()
+        progress = JobProgress('adhoc', adhoc_search.id)
+        progress.start(url=adhoc_search.query_url, step='locations')
 
         logger.debug("Celering adhoc search with id `%s`" % adhoc_search.id)
-        logger.debug("Creating spots for this search" % adhoc_search.position)
-        spot = Spot(position=adhoc_search.position, is_adhoc=True)
-        spot.save()
-        spots = [spot]
+        reused = reused_searches(adhoc_search)
+        if subtract_intervals((adhoc_search.start_date, adhoc_search.end_date), reused[1]):
+            locations = dict((location.id, location) for location in
+                             InstagramLocation.objects.monitored().within(adhoc_search.position,
+                                                                          adhoc_search.radius))
+            locations.update((location.id, location) for location in find_adhoc_locations(adhoc_search))
+        else:
+            # Every date was downloaded by previous searches
+            locations = dict()
+        plan = plan_adhoc_search(adhoc_search, locations.values(), reused)
+        plan.save()
+        progress.update(step='media', locations_total=len(plan.fetch), locations_done=0, publications=0)
+        if not plan.fetch:
+            finish_adhoc_search([], adhoc_search.id)
+            return
+        logger.debug("Downloading media of %s locations for adhoc search `%s`" % (len(plan.fetch), adhoc_search.id))
+        header = group(fetch_adhoc_location.s(adhoc_search.id, location_id,
+                                              [(start.isoformat(), end.isoformat()) for start, end in intervals])
+                       for location_id, intervals in plan.fetch.items())
+        callback = finish_adhoc_search.s(adhoc_search.id).on_error(adhoc_search_failed.s(adhoc_search.id))
+        chord(header)(callback)
+    except Exception:
+        adhoc_search_error(adhoc_search, traceback.format_exc())
+
+
+@task(bind=True, max_retries=None)
+def fetch_adhoc_location(self, adhoc_search_pk, location_pk, intervals=None, failures=0):
+    """ Downloads the media of a location for an adhoc search, within the intervals of dates passed by parameter
+    (lists of ISO dates), or all its dates. Only ADHOC_MAX_CONCURRENCY locations are downloaded
+    at the same time, by all the workers, the task waits for a free slot otherwise. API errors are retried
+    ADHOC_LOCATION_MAX_RETRIES times with an exponential backoff. Returns a dictionary with the location and the
+    error, if any, so a failed location does not cancel the whole search.
+    """
+    holder = adhoc_slots.acquire()
+    if holder is None:
+        raise self.retry(countdown=5)
+    try:
+        adhoc_search = ADHOCSearch.objects.get(id=adhoc_search_pk)
+        location = InstagramLocation.objects.get(id=location_pk)
+        logger.debug("Obtaining publications for location %s" % location)
+        if intervals is not None:
+            intervals = [(parse_date(start), parse_date(end)) for start, end in intervals]
+        publications = location.get_media_between_dates(adhoc_search.start_date, adhoc_search.end_date,
+                                                         adhoc_search.id, intervals=intervals)
+    except APIGramException as e:
+        if failures >= settings.ADHOC_LOCATION_MAX_RETRIES:
+            logger.error("Media of location %s could not be downloaded: %s" % (location_pk, e))
+            JobProgress('adhoc', adhoc_search_pk).increment(locations_done=1, locations_failed=1)
+            return {'location': location_pk, 'error': str(e)}
+        logger.warning("APIGramException happened with answer: %s, retrying" % e)
+        raise self.retry(kwargs={'failures': failures + 1},
+                         countdown=settings.ADHOC_LOCATION_RETRY_DELAY * 2 ** failures)
+    except Exception:
+        logger.error("Exception occurred getting media of location %s" % location_pk)
+        JobProgress('adhoc', adhoc_search_pk).increment(locations_done=1, locations_failed=1)
+        return {'location': location_pk, 'error': traceback.format_exc()}
+    finally:
+        adhoc_slots.release(holder)
+    JobProgress('adhoc', adhoc_search_pk).increment(locations_done=1, publications=publications)
+    return {'location': location_pk, 'error': None}
 
-        for spot in spots:
-            logger.debug("Obtaining locations first spot " % adhoc_search.position)
-            try:
-                locations = api.getLocations(spot.position.y, spot.position.x)
-                logger.debug("Obtained %s locations here: %s" % (len(locations['data']), spot.position) )
-                spot.update_locations(locations, is_adhoc=True)
-                for location in spot.locations.all():
-                    logger.debug("Obtaining publications for location %s" % location)
-                    location.get_media_between_dates(adhoc_search.start_date, adhoc_search.end_date, adhoc_search.id)
-            except APIGramException as e:
-                logger.warning("APIGramException happened with answer: %s" % e)
-                continue
-
-        adhoc_search.status = ADHOCSearch._mt_finished
-        adhoc_search.save()
-        Setting.objects.set_value('is_adhoc_running', '0')
-    except Exception as e:
-        raise
-        logger.error("Exception occurred on Adhoc Search with id `%s`: Exception is %s" % (adhoc_search_pk, e))
-        adhoc_search.status = ADHOCSearch._mt_error
-        adhoc_search.traceback = traceback.format_exc()
-        adhoc_search.save()
-        Setting.objects.set_value('is_adhoc_running', '0')
+
+@task
+def finish_adhoc_search(results, adhoc_search_pk):
+    """ Chord callback of the adhoc search, results are the return values of fetch_adhoc_location. The search
+    fails only when no location could be downloaded
+    """
+    adhoc_search = ADHOCSearch.objects.get(id=adhoc_search_pk)
+    errors = [r['error'] for r in results if r['error']]
+    if results and len(errors) == len(results):
+        adhoc_search_error(adhoc_search, "\n".join(errors))
+        return
+    if errors:
+        logger.warning("Adhoc search `%s` finished without %s of %s locations" %
+                       (adhoc_search.id, len(errors), len(results)))
+    adhoc_search.status = ADHOCSearch._mt_finished
+    adhoc_search.save()
+    Setting.objects.set_value('is_adhoc_running', '0')
+    JobProgress('adhoc', adhoc_search.id).finish()
+
+
+@task
+def adhoc_search_failed(task_id, adhoc_search_pk):
+    """ Error callback of finish_adhoc_search
+    """
+    adhoc_search_error(ADHOCSearch.objects.get(id=adhoc_search_pk), "Task %s failed" % task_id)
 
 
 @task
 def export_to_excel(data):
     """ Generates an xls file from the set of publications coming from publications_id
     Attributes:
-        publications_id = [123,1223,4]
-        exportform_id = 12
+        publications = RoaringBitmap of the ids of the publications, serialized and base64 encoded
+        hashtags = [12, 14]
+        id = 12 (id of the ExportForm)
     """
     import shutil
 
     ef = ExportForm.objects.get(id=data['id'])
-    if data['publications']:
-        publications = Publication.objects.filter(id__in=data['publications'])
+    progress = JobProgress('export', ef.id)
+    ids = RoaringBitmap.from_bytes(base64.b64decode(data['publications'])) if data['publications'] else []
+    progress.start(rows_total=len(ids), rows_done=0)
+    if ids:
+        publications = Publication.objects.extra(where=['"instanalysis_publication"."id" = ANY(%s)'],
+                                                 params=[list(ids)])
     else:
         publications = Publication.objects.none()
     if data['hashtags']:
@@ -184,7 +336,8 @@ def export_to_excel(data):
         hashtags = Hashtag.objects.none()
     hashtags = hashtags.values('label').annotate(publications=Count('label')).order_by('-publications')
 
-    output_file = Publication.objects.export_to_excel(publications, hashtags)
+    output_file = Publication.objects.export_to_excel(publications, hashtags,
+                                                      progress=lambda rows: progress.update(rows_done=rows))
     exported_excel_folder = os.path.join(settings.MEDIA_ROOT, "exports")
     file_name_export = "Export_%s.xlsx" % int(time.time())
     file_exported_path = os.path.join(exported_excel_folder, file_name_export)
@@ -195,6 +348,7 @@ def export_to_excel(data):
     ef.status = ExportForm._mt_finished
     ef.url_file = "/media/exports/%s" % file_name_export
     ef.save()
+    progress.finish(rows_done=len(ids), url_file=ef.url_file)
 
 
 @task
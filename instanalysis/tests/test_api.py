@@ -0,0 +1,101 @@
+import threading
+
+from django.test import SimpleTestCase
+
+from instanalysis.apps.instagram.api import APIGramException, InstagramAPI
+from instanalysis.apps.instagram.fakeserver import FakeData, FakeInstagramServer
+
+
+class InstagramAPIRequestTest(SimpleTestCase):
+    """ Retries of InstagramAPI._request against the local stand-in server
+    """
+
+    def setUp(self):
+        self.server = FakeInstagramServer(FakeData.synthetic(locations=2, posts=5, seed=1))
+        self.server.start()
+        self.api = InstagramAPI(base_url=self.server.url, quota=False, max_retries=2)
+        self.delays = []
+        # Backoffs are recorded instead of slept
+        self.api._backoff_delay = lambda attempt: self.delays.append(attempt) or 0
+        self.url = "%s/v1/locations/search?lat=41.3879&lng=2.16992&distance=5000" % self.server.url
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_success(self):
+        response = self.api._request('get', self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.delays, [])
+
+    def test_server_errors_are_retried(self):
+        self.server.error_rate = 1.0
+
+        def backoff(attempt):
+            # The server recovers before the second retry
+            self.delays.append(attempt)
+            if attempt == 1:
+                self.server.error_rate = 0.0
+            return 0
+        self.api._backoff_delay = backoff
+        response = self.api._request('get', self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.delays, [0, 1])
+
+    def test_gives_up_after_max_retries(self):
+        self.server.error_rate = 1.0
+        self.assertRaises(APIGramException, self.api._request, 'get', self.url)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.delays, [0, 1])
+
+    def test_client_errors_are_not_retried(self):
+        response = self.api._request('get', "%s/v1/unknown" % self.server.url)
+        self.assertEqual(response.status_code, 404)
+        self.server.rate_limit = 0
+        response = self.api._request('get', self.url)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.delays, [])
+
+    def test_pooled_session(self):
+        api = InstagramAPI(base_url=self.server.url + '/', quota=False, pool_size=3)
+        self.assertEqual(api.base_url, self.server.url)
+        self.assertEqual(api.session.get_adapter(self.url)._pool_maxsize, 3)
+        self.assertFalse(api.quota)
+
+
+class PrefetchTest(SimpleTestCase):
+    """ Background thread of InstagramAPI._prefetch
+    """
+
+    def setUp(self):
+        self.api = InstagramAPI(base_url='http://localhost', quota=False)
+        self.threads = []
+
+    def pages(self):
+        self.threads.append(threading.current_thread())
+        for i in range(10):
+            yield [i]
+
+    def assertThreadExits(self):
+        thread, = self.threads
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_pages_are_returned_in_order(self):
+        self.assertEqual(list(self.api._prefetch(self.pages())), [[i] for i in range(10)])
+        self.assertThreadExits()
+
+    def test_thread_exits_when_the_caller_fails(self):
+        def consume():
+            for page in self.api._prefetch(self.pages()):
+                raise ValueError(page)
+        self.assertRaises(ValueError, consume)
+        self.assertThreadExits()
+
+    def test_thread_exits_when_the_generator_is_closed(self):
+        prefetched = self.api._prefetch(self.pages())
+        self.assertEqual(next(prefetched), [0])
+        prefetched.close()
+        self.assertThreadExits()
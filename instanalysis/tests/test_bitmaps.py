@@ -0,0 +1,62 @@
+from django.test import SimpleTestCase
+
+from instanalysis.bitmaps import ARRAY_MAX, RoaringBitmap, deserialize_container, serialize_container
+
+
+class RoaringBitmapTest(SimpleTestCase):
+
+    def setUp(self):
+        # Container 0 is a bitset, container 1 an array, container 2 only in dense
+        self.dense = RoaringBitmap(range(0, 3 * ARRAY_MAX, 2) + [65536 + 1, 65536 + 7, 2 * 65536])
+        self.sparse = RoaringBitmap([2, 3, 65536 + 7, 65536 + 8, 5 * 65536])
+
+    def test_containers(self):
+        self.assertIsInstance(self.dense.containers[0], long)
+        self.assertEqual(self.dense.containers[1], [1, 7])
+        self.assertEqual(len(self.dense), 3 * ARRAY_MAX / 2 + 3)
+
+    def test_operations(self):
+        dense, sparse = set(self.dense), set(self.sparse)
+        self.assertEqual(list(self.dense & self.sparse), sorted(dense & sparse))
+        self.assertEqual(list(self.dense | self.sparse), sorted(dense | sparse))
+        self.assertEqual(list(self.dense - self.sparse), sorted(dense - sparse))
+        self.assertEqual(list(self.sparse - self.dense), sorted(sparse - dense))
+
+    def test_bitsets_shrink_to_arrays(self):
+        result = self.dense - RoaringBitmap(range(0, 3 * ARRAY_MAX, 4))
+        self.assertEqual(len(result.containers[0]), 3 * ARRAY_MAX / 4)
+        self.assertIsInstance(result.containers[0], list)
+
+    def test_empty_containers_are_dropped(self):
+        self.assertEqual((self.sparse - self.sparse).containers, {})
+        self.assertFalse(self.sparse & RoaringBitmap([65536 * 9]))
+
+    def test_contains(self):
+        self.assertIn(2, self.dense)
+        self.assertNotIn(3, self.dense)
+        self.assertIn(65536 + 7, self.dense)
+        self.assertNotIn(65536 + 8, self.dense)
+        self.assertNotIn(7 * 65536, self.dense)
+
+    def test_update(self):
+        self.sparse.update([4, 65536 + 7])
+        self.assertEqual(list(self.sparse), [2, 3, 4, 65536 + 7, 65536 + 8, 5 * 65536])
+
+    def test_intersection_and_union(self):
+        third = RoaringBitmap([2, 65536 + 7])
+        self.assertEqual(list(RoaringBitmap.intersection([self.dense, self.sparse, third])), [2, 65536 + 7])
+        self.assertEqual(RoaringBitmap.union([self.dense, self.sparse]), self.dense | self.sparse)
+        self.assertEqual(RoaringBitmap.intersection([]), RoaringBitmap())
+        self.assertEqual(RoaringBitmap.union([]), RoaringBitmap())
+
+    def test_serialization(self):
+        for bitmap in (self.dense, self.sparse, RoaringBitmap()):
+            self.assertEqual(RoaringBitmap.from_bytes(bitmap.to_bytes()), bitmap)
+        for container in self.dense.containers.values():
+            self.assertEqual(deserialize_container(serialize_container(container)), container)
+
+    def test_from_containers(self):
+        containers = dict((key, deserialize_container(serialize_container(container)))
+                          for key, container in self.dense.containers.items())
+        self.assertEqual(RoaringBitmap.from_containers(containers), self.dense)
+        self.assertEqual(RoaringBitmap.from_containers({0: [], 1: 0L}).containers, {})
@@ -0,0 +1,82 @@
+from django.contrib.gis.geos import Point
+from django.test import TestCase
+
+from instanalysis.db import bulk_update, insert_ignore_conflicts, stream, upsert
+from instanalysis.models import Category, InstagramLocation, Spot
+
+
+class InsertIgnoreConflictsTest(TestCase):
+
+    def test_skips_existing_rows(self):
+        existing = Category.objects.create(label='food')
+        rows = insert_ignore_conflicts(Category, [Category(label='food'), Category(label='art')],
+                                       ['created', 'modified', 'label'], returning=['id', 'label'])
+        self.assertEqual([label for pk, label in rows], ['art'])
+        self.assertEqual(sorted(Category.objects.values_list('label', flat=True)), ['art', 'food'])
+        self.assertEqual(Category.objects.get(label='food').id, existing.id)
+
+class UpsertTest(TestCase):
+
+    def setUp(self):
+        self.spot = Spot.objects.create(position=Point(-3.7, 40.4))
+        self.other_spot = Spot.objects.create(position=Point(-3.6, 40.4))
+
+    def upsert(self, locations):
+        """ Same call as Spot.upsert_locations
+        """
+        return upsert(InstagramLocation, locations,
+                      ['created', 'modified', 'name', 'instagramID', 'position', 'spot', 'updated_at',
+                       'next_update_at', 'poll_interval'],
+                      conflict=['instagramID'], conflict_where='"instagramID" <> \'0\'',
+                      update_fields=['name', 'position'], compare={'position': 'ST_OrderingEquals(%s, %s)'})
+
+    def location(self, instagram_id, name, lng=-3.7, spot=None):
+        return InstagramLocation(name=name, instagramID=instagram_id, position=Point(lng, 40.4),
+                                 spot=spot or self.spot)
+
+    def test_inserts(self):
+        rows = self.upsert([self.location('1', 'Sol'), self.location('2', 'Retiro')])
+        self.assertEqual([inserted for pk, inserted in rows], [True, True])
+        self.assertEqual(sorted(pk for pk, inserted in rows),
+                         sorted(InstagramLocation.objects.values_list('id', flat=True)))
+
+    def test_only_changed_rows_are_updated(self):
+        self.upsert([self.location('1', 'Sol'), self.location('2', 'Retiro')])
+        self.assertEqual(self.upsert([self.location('1', 'Sol'), self.location('2', 'Retiro')]), [])
+        sol = InstagramLocation.objects.get(instagramID='1')
+        rows = self.upsert([self.location('1', 'Puerta del Sol', spot=self.other_spot),
+                            self.location('2', 'Retiro', lng=-3.68), self.location('3', 'Prado')])
+        self.assertEqual(len(rows), 3)
+        self.assertIn((sol.id, False), rows)
+        sol.refresh_from_db()
+        self.assertEqual(sol.name, 'Puerta del Sol')
+        self.assertEqual(sol.spot, self.spot)
+        self.assertAlmostEqual(InstagramLocation.objects.get(instagramID='2').position.x, -3.68)
+
+    def test_custom_locations_are_not_merged(self):
+        rows = self.upsert([self.location('0', 'Home')])
+        rows += self.upsert([self.location('0', 'Office')])
+        self.assertEqual([inserted for pk, inserted in rows], [True, True])
+        self.assertEqual(InstagramLocation.objects.filter(instagramID='0').count(), 2)
+
+class BulkUpdateTest(TestCase):
+
+    def test_updates_fields(self):
+        categories = [Category.objects.create(label='category %s' % i) for i in range(3)]
+        for category in categories[:2]:
+            category.label += ' renamed'
+        bulk_update(Category, categories[:2], ['label'])
+        self.assertEqual(sorted(Category.objects.values_list('label', flat=True)),
+                         ['category 0 renamed', 'category 1 renamed', 'category 2'])
+
+    def test_empty(self):
+        bulk_update(Category, [], ['label'])
+
+
+class StreamTest(TestCase):
+
+    def test_rows(self):
+        for label in ('food', 'art', 'beach'):
+            Category.objects.create(label=label)
+        rows = stream("SELECT label FROM instanalysis_category WHERE label <> %s ORDER BY label", ['art'], 'labels')
+        self.assertEqual(list(rows), [('beach',), ('food',)])
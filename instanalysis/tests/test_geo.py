@@ -0,0 +1,55 @@
+import math
+
+from django.test import SimpleTestCase
+
+from instanalysis.geo import distance_meters, geohash_bounds, geohash_center, geohash_encode, geohash_radius, \
+    hex_grid, offset
+
+MADRID = (40.416775, -3.703790)
+
+
+class HexGridTest(SimpleTestCase):
+
+    def test_small_circle(self):
+        self.assertEqual(hex_grid(MADRID[0], MADRID[1], 500, 750), [MADRID])
+
+    def test_covers_circle(self):
+        """ Every point of the circle is within search_radius of a center
+        """
+        radius, search_radius = 3000, 750
+        centers = hex_grid(MADRID[0], MADRID[1], radius, search_radius)
+        self.assertTrue(all(isinstance(center, tuple) and len(center) == 2 for center in centers))
+        for distance in range(0, radius + 1, 250):
+            for angle in range(0, 360, 15):
+                point = offset(MADRID[0], MADRID[1], distance * math.cos(math.radians(angle)),
+                               distance * math.sin(math.radians(angle)))
+                nearest = min(distance_meters(point[0], point[1], lat, lng) for lat, lng in centers)
+                self.assertLessEqual(nearest, search_radius + 1)
+
+    def test_sorted_by_distance(self):
+        centers = hex_grid(MADRID[0], MADRID[1], 3000, 750)
+        distances = [distance_meters(MADRID[0], MADRID[1], lat, lng) for lat, lng in centers]
+        # Centers are sorted by their distance on the plane of the lattice, which differs by centimeters
+        self.assertTrue(all(a <= b + 1 for a, b in zip(distances, distances[1:])))
+        self.assertAlmostEqual(distances[0], 0)
+        self.assertLess(len(centers), 2 * (3000.0 / 750 + 1) ** 2 * math.pi / (1.5 * math.sqrt(3)))
+
+class GeohashTest(SimpleTestCase):
+
+    def test_known_cell(self):
+        self.assertEqual(geohash_encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+
+    def test_bounds(self):
+        cell = geohash_encode(MADRID[0], MADRID[1], 7)
+        (south, north), (west, east) = geohash_bounds(cell)
+        self.assertTrue(south <= MADRID[0] < north and west <= MADRID[1] < east)
+        self.assertEqual(geohash_encode(*geohash_center(cell), precision=7), cell)
+
+    def test_radius_contains_cell(self):
+        cell = geohash_encode(MADRID[0], MADRID[1], 7)
+        (south, north), (west, east) = geohash_bounds(cell)
+        lat, lng = geohash_center(cell)
+        radius = geohash_radius(cell)
+        for corner in ((south, west), (south, east), (north, west), (north, east)):
+            self.assertLessEqual(distance_meters(lat, lng, corner[0], corner[1]), radius + 1e-6)
+        self.assertLess(radius, 150)
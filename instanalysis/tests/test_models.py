@@ -0,0 +1,172 @@
+import time
+from datetime import date, datetime
+
+from django.contrib.gis.geos import Point
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from instanalysis import models
+from instanalysis.bitmaps import RoaringBitmap
+from instanalysis.models import City, DistinctSketch, Hashtag, HashtagPosting, HashtagSketch, InstagramLocation, \
+    PendingPublication, Publication, Spot
+
+
+def created_time(value):
+    """ created_time of the media of the API published at the naive local datetime passed by parameter
+    """
+    return str(int(time.mktime(value.timetuple())))
+
+
+class FakeAPI(object):
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+    def iterLatestPostsPages(self, location_id, **kwargs):
+        self.calls.append(kwargs)
+        return iter(self.pages)
+
+
+class GetMediaBetweenDatesTest(SimpleTestCase):
+
+    def setUp(self):
+        self.api = models.api
+        self.stored = []
+        self.location = InstagramLocation(name='Sol', instagramID='1')
+        self.location.add_media_page = lambda page, adhoc_id=None: self.stored.extend(page) or page
+
+    def tearDown(self):
+        models.api = self.api
+
+    def test_datetimes_are_local_dates(self):
+        media = [{'id': str(day), 'created_time': created_time(datetime(2016, 5, day, 12))} for day in (4, 3, 2, 1)]
+        models.api = FakeAPI([media])
+        with timezone.override('Europe/Madrid'):
+            stored = self.location.get_media_between_dates(datetime(2016, 5, 1, 23, 30, tzinfo=timezone.utc),
+                                                           datetime(2016, 5, 3, 12, tzinfo=timezone.utc), None)
+        self.assertEqual(stored, 2)
+        self.assertEqual([media_post['id'] for media_post in self.stored], ['3', '2'])
+        self.assertEqual(models.api.calls[0]['start_date'], date(2016, 5, 2))
+
+    def test_intervals(self):
+        media = [{'id': str(day), 'created_time': created_time(datetime(2016, 5, day, 12))} for day in range(9, 0, -1)]
+        models.api = FakeAPI([media[:5], media[5:]])
+        stored = self.location.get_media_between_dates(date(2016, 5, 1), date(2016, 5, 9), None,
+                                                       intervals=[(date(2016, 5, 2), date(2016, 5, 3)),
+                                                                  (date(2016, 5, 7), date(2016, 5, 7))])
+        self.assertEqual(stored, 3)
+        self.assertEqual(sorted(media_post['id'] for media_post in self.stored), ['2', '3', '7'])
+
+
+
+class UpsertLocationsTest(TestCase):
+
+    def setUp(self):
+        city = City.objects.create(name='Madrid', center=Point(-3.7, 40.4), zoom=12)
+        self.city_spot = Spot.objects.create(position=Point(-3.7, 40.4), city=city)
+        self.adhoc_spot = Spot.objects.create(position=Point(-3.7, 40.4), is_adhoc=True)
+        self.other_city_spot = Spot.objects.create(position=Point(-3.7, 40.4), city=city)
+        self.location_data = {'data': [{'id': '1', 'name': 'Sol', 'latitude': 40.4, 'longitude': -3.7}]}
+
+    def test_adhoc_locations_are_adopted_by_cities(self):
+        self.assertEqual(self.adhoc_spot.upsert_locations(self.location_data), (1, 0))
+        self.city_spot.upsert_locations(self.location_data)
+        self.assertEqual(InstagramLocation.objects.get(instagramID='1').spot, self.city_spot)
+
+    def test_city_locations_keep_their_spot(self):
+        self.city_spot.upsert_locations(self.location_data)
+        self.other_city_spot.upsert_locations(self.location_data)
+        self.adhoc_spot.upsert_locations(self.location_data)
+        self.assertEqual(InstagramLocation.objects.get(instagramID='1').spot, self.city_spot)
+
+class HashtagIndexTest(TestCase):
+
+    def setUp(self):
+        self.city = City.objects.create(name='Madrid', center=Point(-3.7, 40.4), zoom=12)
+        spot = Spot.objects.create(position=Point(-3.7, 40.4), city=self.city)
+        self.location = InstagramLocation.objects.create(name='Sol', instagramID='1', position=Point(-3.7, 40.4),
+                                                         spot=spot)
+        self.hashtags = dict((label, Hashtag.objects.create(label=label)) for label in ('food', 'art', 'beach'))
+        tags = [('food',), ('food', 'art'), ('art',), ('beach',), ()]
+        self.publications = []
+        for i, labels in enumerate(tags):
+            publication = Publication(instagramID=str(i), mediaType=Publication._mt_photo, likes=0,
+                                      instagram_url='https://instagram.com', location=self.location, city=self.city,
+                                      publication_date=timezone.make_aware(datetime(2016, 5, 1, 12)))
+            publication.set_local_fields()
+            publication.save()
+            for label in labels:
+                self.hashtags[label].publications.add(publication)
+            PendingPublication.objects.create(publication=publication, city=self.city)
+            self.publications.append(publication)
+
+    def labels(self, publications):
+        return sorted(int(publication.instagramID) for publication in publications)
+
+    def filter(self, **kwargs):
+        return self.labels(HashtagPosting.objects.filter_publications(Publication.objects.of_city('Madrid'),
+                                                                      self.city.id, **kwargs))
+
+    def check_filters(self):
+        self.assertEqual(self.filter(all_of=['food']), [0, 1])
+        self.assertEqual(self.filter(all_of=['food', 'art']), [1])
+        self.assertEqual(self.filter(any_of=['art', 'beach']), [1, 2, 3])
+        self.assertEqual(self.filter(any_of=['art', 'unknown']), [1, 2])
+        self.assertEqual(self.filter(none_of=['food', 'unknown']), [2, 3, 4])
+        self.assertEqual(self.filter(any_of=['food', 'art'], none_of=['art']), [0])
+        self.assertEqual(self.filter(all_of=['food', 'unknown']), [])
+        self.assertEqual(self.filter(any_of=['unknown']), [])
+
+    def test_pending_publications_are_found(self):
+        self.check_filters()
+
+    def test_merge(self):
+        self.assertEqual(PendingPublication.objects.merge(), 5)
+        self.assertEqual(PendingPublication.objects.count(), 0)
+        self.assertEqual(HashtagPosting.objects.filter(city=self.city).count(), 3)
+        self.check_filters()
+        self.assertEqual(PendingPublication.objects.merge(), 0)
+
+    def test_hashtag_sketches(self):
+        counters = {self.hashtags['food'].id: [2, 0], self.hashtags['art'].id: [2, 0],
+                    self.hashtags['beach'].id: [1, 0]}
+        PendingPublication.objects.merge(limit=2)
+        PendingPublication.objects.merge()
+        self.assertEqual(HashtagSketch.objects.get(city=self.city).summary().counters, counters)
+        HashtagSketch.objects.rebuild([self.city.id])
+        self.assertEqual(HashtagSketch.objects.get(city=self.city).summary().counters, counters)
+
+    def test_distinct_sketches(self):
+        PendingPublication.objects.merge(limit=2)
+        PendingPublication.objects.merge()
+        self.assertEqual(DistinctSketch.objects.get(city=self.city).summary('hashtags').count(), 3)
+        DistinctSketch.objects.rebuild([self.city.id])
+        self.assertEqual(DistinctSketch.objects.get(city=self.city).summary('hashtags').count(), 3)
+
+    @override_settings(HASHTAG_FILTER_MAX_IDS=0)
+    def test_semi_joins(self):
+        PendingPublication.objects.merge(limit=2)
+        self.check_filters()
+
+    def test_adhoc_searches(self):
+        self.assertEqual(self.labels(HashtagPosting.objects.filter_publications(
+            Publication.objects.filter(location=self.location), None, all_of=['food'], none_of=['art'])), [0])
+
+    def test_rebuild(self):
+        PendingPublication.objects.merge(limit=2)
+        HashtagPosting.objects.rebuild()
+        PendingPublication.objects.merge()
+        self.assertEqual(HashtagPosting.objects.get(hashtag=self.hashtags['food']).bitmap(),
+                         RoaringBitmap([self.publications[0].id, self.publications[1].id]))
+        self.check_filters()
+
+    def test_rebuild_missing(self):
+        PendingPublication.objects.merge()
+        HashtagPosting.objects.all().delete()
+        HashtagPosting.objects.rebuild(missing=True)
+        self.assertEqual(HashtagPosting.objects.filter(city=self.city).count(), 3)
+        self.check_filters()
+        HashtagPosting.objects.filter(hashtag=self.hashtags['beach']).delete()
+        HashtagPosting.objects.rebuild(missing=True)
+        self.assertEqual(HashtagPosting.objects.filter(city=self.city).count(), 2)
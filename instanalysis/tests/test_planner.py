@@ -0,0 +1,90 @@
+from datetime import date, datetime, timedelta
+
+from django.contrib.gis.geos import Point
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from instanalysis.models import ADHOCSearch, City, InstagramLocation, Spot
+from instanalysis.planner import local_interval, plan_adhoc_search, subtract_intervals
+
+
+class SubtractIntervalsTest(SimpleTestCase):
+
+    def test_nothing_covered(self):
+        self.assertEqual(subtract_intervals((date(2016, 5, 1), date(2016, 5, 31)), []),
+                         [(date(2016, 5, 1), date(2016, 5, 31))])
+
+    def test_covered_in_the_middle(self):
+        self.assertEqual(subtract_intervals((date(2016, 5, 1), date(2016, 5, 31)),
+                                            [(date(2016, 5, 10), date(2016, 5, 20))]),
+                         [(date(2016, 5, 1), date(2016, 5, 9)), (date(2016, 5, 21), date(2016, 5, 31))])
+
+    def test_covered_unsorted_and_overlapping(self):
+        covered = [(date(2016, 5, 25), date(2016, 6, 10)), (date(2016, 4, 1), date(2016, 5, 5)),
+                   (date(2016, 5, 3), date(2016, 5, 10))]
+        self.assertEqual(subtract_intervals((date(2016, 5, 1), date(2016, 5, 31)), covered),
+                         [(date(2016, 5, 11), date(2016, 5, 24))])
+
+    def test_all_covered(self):
+        self.assertEqual(subtract_intervals((date(2016, 5, 1), date(2016, 5, 31)),
+                                            [(date(2016, 5, 1), date(2016, 5, 15)),
+                                             (date(2016, 5, 16), date(2016, 5, 31))]), [])
+
+
+class LocalIntervalTest(SimpleTestCase):
+
+    def setUp(self):
+        self.now = timezone.make_aware(datetime(2016, 5, 20, 12))
+        self.location = InstagramLocation(latest_media_id='1', created=timezone.make_aware(datetime(2016, 5, 1, 10)),
+                                          updated_at=self.now - timedelta(minutes=10))
+
+    def test_never_updated(self):
+        self.location.latest_media_id = None
+        self.assertIsNone(local_interval(self.location, date(2016, 5, 1), date(2016, 5, 20), self.now))
+
+    def test_up_to_date(self):
+        self.assertEqual(local_interval(self.location, date(2016, 4, 1), date(2016, 5, 20), self.now),
+                         (date(2016, 5, 2), date(2016, 5, 20)))
+
+    def test_outdated(self):
+        self.location.updated_at = timezone.make_aware(datetime(2016, 5, 18, 12))
+        self.assertEqual(local_interval(self.location, date(2016, 4, 1), date(2016, 5, 20), self.now),
+                         (date(2016, 5, 2), date(2016, 5, 17)))
+        self.assertEqual(local_interval(self.location, date(2016, 4, 1), date(2016, 5, 10), self.now),
+                         (date(2016, 5, 2), date(2016, 5, 10)))
+        self.assertIsNone(local_interval(self.location, date(2016, 5, 18), date(2016, 5, 20), self.now))
+
+
+class PlanAdhocSearchTest(TestCase):
+
+    def setUp(self):
+        self.today = timezone.localtime(timezone.now()).date()
+        city = City.objects.create(name='Madrid', center=Point(-3.7, 40.4), zoom=12)
+        monitored_spot = Spot.objects.create(position=Point(-3.7, 40.4), city=city)
+        adhoc_spot = Spot.objects.create(position=Point(-3.7, 40.4), is_adhoc=True)
+        self.monitored = InstagramLocation.objects.create(name='Sol', instagramID='1', position=Point(-3.7, 40.4),
+                                                          spot=monitored_spot, latest_media_id='1',
+                                                          updated_at=timezone.now())
+        created = timezone.now() - timedelta(days=10)
+        InstagramLocation.objects.filter(id=self.monitored.id).update(created=created)
+        self.monitored.refresh_from_db()
+        self.found = timezone.localtime(created).date()
+        self.adhoc = InstagramLocation.objects.create(name='Retiro', instagramID='2', position=Point(-3.68, 40.41),
+                                                      spot=adhoc_spot)
+        self.search = ADHOCSearch(start_date=self.today - timedelta(days=20), end_date=self.today)
+
+    def test_monitored_locations_are_answered_locally(self):
+        plan = plan_adhoc_search(self.search, [self.monitored, self.adhoc])
+        self.assertEqual(plan.fetch, {self.monitored.id: [(self.search.start_date, self.found)],
+                                      self.adhoc.id: [(self.search.start_date, self.today)]})
+        self.assertEqual([(s.location, s.start_date, s.end_date) for s in plan.sources],
+                         [(self.monitored, self.found + timedelta(days=1), self.today)])
+
+    def test_reused_searches_come_first(self):
+        reused = (['source'], [(self.today - timedelta(days=5), self.today)])
+        plan = plan_adhoc_search(self.search, [self.monitored, self.adhoc], reused)
+        self.assertEqual(plan.fetch, {self.monitored.id: [(self.search.start_date, self.found)],
+                                      self.adhoc.id: [(self.search.start_date, self.today - timedelta(days=6))]})
+        self.assertEqual(plan.sources[0], 'source')
+        self.assertEqual([(s.start_date, s.end_date) for s in plan.sources[1:]],
+                         [(self.found + timedelta(days=1), self.today - timedelta(days=6))])
@@ -0,0 +1,82 @@
+import random
+
+from django.test import SimpleTestCase
+
+from instanalysis.sketches import HyperLogLog, SpaceSaving, top_items
+
+
+class SpaceSavingTest(SimpleTestCase):
+
+    def test_exact_under_capacity(self):
+        sketch = SpaceSaving(3)
+        sketch.update({1: 5, 2: 3})
+        sketch.add(1)
+        self.assertEqual(sketch.counters, {1: [6, 0], 2: [3, 0]})
+        self.assertEqual(sketch.floor(), 0)
+
+    def test_replaces_smallest(self):
+        sketch = SpaceSaving(2)
+        sketch.update({1: 5, 2: 3, 3: 1})
+        self.assertEqual(sketch.counters, {1: [5, 0], 3: [4, 3]})
+        self.assertEqual(sketch.floor(), 4)
+
+    def test_serialization(self):
+        sketch = SpaceSaving(2)
+        sketch.update({1: 5, 2: 3, 3: 1})
+        self.assertEqual(SpaceSaving.from_bytes(sketch.to_bytes(), 2).counters, sketch.counters)
+        self.assertEqual(SpaceSaving.from_bytes('', 2).counters, {})
+
+    def test_merge_bounds(self):
+        """ The real count of every item returned is between the guaranteed and the estimated ones
+        """
+        rng = random.Random(1)
+        streams = [[int(rng.paretovariate(1)) for _ in range(2000)] for _ in range(4)]
+        sketches = []
+        for stream in streams:
+            sketch = SpaceSaving(16)
+            for item in stream:
+                sketch.add(item)
+            sketches.append(sketch)
+        real = dict()
+        for stream in streams:
+            for item in stream:
+                real[item] = real.get(item, 0) + 1
+        top = top_items(sketches, 5)
+        self.assertEqual(len(top), 5)
+        for item, estimated, guaranteed in top:
+            self.assertTrue(guaranteed <= real[item] <= estimated, (item, guaranteed, real[item], estimated))
+        self.assertEqual(top[0][0], max(real, key=real.get))
+
+class HyperLogLogTest(SimpleTestCase):
+
+    def test_empty(self):
+        self.assertEqual(HyperLogLog(11).count(), 0)
+        self.assertEqual(HyperLogLog.from_bytes('', 11).count(), 0)
+
+    def test_small_counts(self):
+        sketch = HyperLogLog(11)
+        sketch.update(range(100) * 3)
+        self.assertTrue(97 <= sketch.count() <= 103, sketch.count())
+
+    def test_large_counts(self):
+        sketch = HyperLogLog(11)
+        sketch.update(range(50000))
+        self.assertTrue(abs(sketch.count() - 50000) < 50000 * 0.07, sketch.count())
+
+    def test_merge(self):
+        """ Merging gives the same registers as adding all the items to a single sketch
+        """
+        first, second, both = HyperLogLog(11), HyperLogLog(11), HyperLogLog(11)
+        first.update(range(0, 3000))
+        second.update(range(2000, 6000))
+        both.update(range(0, 6000))
+        merged = HyperLogLog.merge([first, second])
+        self.assertEqual(merged.registers, both.registers)
+        self.assertEqual(HyperLogLog.merge([second, first]).registers, both.registers)
+        self.assertEqual(HyperLogLog.merge([merged, HyperLogLog(11)]).registers, both.registers)
+        self.assertEqual(HyperLogLog.merge([], 11).count(), 0)
+
+    def test_serialization(self):
+        sketch = HyperLogLog(11)
+        sketch.update(range(1000))
+        self.assertEqual(HyperLogLog.from_bytes(sketch.to_bytes(), 11).registers, sketch.registers)
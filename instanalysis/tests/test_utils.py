@@ -0,0 +1,27 @@
+from datetime import date, datetime
+
+from django.test import SimpleTestCase
+from django.utils import timezone
+
+from instanalysis.utils import as_local_date, day_range
+
+
+class AsLocalDateTest(SimpleTestCase):
+
+    def test_dates(self):
+        self.assertEqual(as_local_date(date(2016, 5, 1)), date(2016, 5, 1))
+        self.assertEqual(as_local_date(datetime(2016, 5, 1, 23, 30)), date(2016, 5, 1))
+
+    def test_aware_datetimes_are_local(self):
+        with timezone.override('Europe/Madrid'):
+            self.assertEqual(as_local_date(datetime(2016, 5, 1, 23, 30, tzinfo=timezone.utc)), date(2016, 5, 2))
+            self.assertEqual(as_local_date(datetime(2016, 5, 1, 21, 30, tzinfo=timezone.utc)), date(2016, 5, 1))
+
+
+class DayRangeTest(SimpleTestCase):
+
+    def test_local_days(self):
+        with timezone.override('Europe/Madrid'):
+            since, until = day_range(date(2016, 5, 1), date(2016, 5, 2))
+        self.assertEqual(since, datetime(2016, 4, 30, 22, tzinfo=timezone.utc))
+        self.assertEqual(until, datetime(2016, 5, 2, 22, tzinfo=timezone.utc))
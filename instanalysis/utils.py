@@ -1,3 +1,4 @@
+import hashlib
 import logging
 import string
 import random
@@ -23,6 +24,41 @@ def _get_init_datetime_location():
     time_last_update = now - timedelta(seconds=60)
     return time_last_update
 
+def day_range(start_date, end_date):
+    """ Returns the aware datetimes of the start of start_date and of the end of end_date (excluded), in the current
+    time zone
+    """
+    since = timezone.make_aware(datetime.combine(start_date, datetime.min.time()))
+    until = timezone.make_aware(datetime.combine(end_date + timedelta(days=1), datetime.min.time()))
+    return since, until
+
+
+def as_local_date(value):
+    """ Returns the date passed by parameter as a date. Datetimes are converted to their local date, aware ones in
+    the current time zone
+    """
+    if isinstance(value, datetime):  # datetime is a subclass of date
+        return (timezone.localtime(value) if is_aware(value) else value).date()
+    return value
+
+
+def adhoc_area_key(position, radius):
+    """ Normalized area of an adhoc search, the position is rounded to about 10 meters
+    """
+    return "%.4f,%.4f,%d" % (position.y, position.x, int(radius))
+
+
+def adhoc_query_key(position, radius, start_date, end_date, month, weekday, slotrange, hashtags, categories):
+    """ Hash of the normalized parameters of an adhoc search, searches with the same key have the same results
+    whatever the order of the parameters in the URL
+    """
+    parts = [adhoc_area_key(position, radius), start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"),
+             "" if month is None else str(month), "" if weekday is None else str(weekday),
+             "" if slotrange is None else str(slotrange),
+             ",".join(sorted(set(hashtags))), ",".join(sorted(set(categories)))]
+    return hashlib.sha1(u"|".join(parts).encode('utf-8')).hexdigest()
+
+
 def created_from_timestamp_instagram(created_time):
     """ converts to timestamp
     """
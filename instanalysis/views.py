@@ -1,3 +1,4 @@
+import base64
 import logging
 import csv
 import json
@@ -18,7 +19,9 @@ from instanalysis.tasks import process_csv_file, process_adhoc_search, export_to
 
 from django.db.models import F
 from .models import Category, Hashtag, City, Publication, Spot, ADHOCSearch, ExportForm
+from .bitmaps import RoaringBitmap
 from .forms import PivotEditForm
+from .progress import JobProgress, RUNNING, FINISHED
 from .apps.map.views import MapView
 
 
@@ -47,7 +50,7 @@ class Home(MapView):
                 # And retrieve the file via ajax
                 # Each record weights 70 bytes. We only let exporting files smaller than 15 Mb
                 # 15Mb = 220000 publications
-                if publications.count() > 220000:
+                if mapInfo['num_publications'] > 220000:
                     msg = _("You cannot export more than 220k publications.")
                     ok = False
                 else:
@@ -55,10 +58,11 @@ class Home(MapView):
                     msg = ""
                 ef = ExportForm()
                 ef.save()
-                publications = [p['id'] for p in publications.values('id')]
-                hashtags = [h['id'] for h in hashtags.values('id')]
+                # The ids are sent compressed, see instanalysis.bitmaps
+                publications = RoaringBitmap(publications.values_list('id', flat=True))
+                hashtags = [h['id'] for h in hashtags]
                 data = {
-                    "publications": None if not publications else publications,
+                    "publications": None if not publications else base64.b64encode(publications.to_bytes()),
                     "hashtags": None if not hashtags else hashtags,
                     "id": ef.id
                 }
@@ -116,13 +120,12 @@ class Home(MapView):
                                        weekday=day,
                                        slotrange=slot,
                                        query_url=request.build_absolute_uri())
-            url = request.build_absolute_uri()
-            url = url.replace("&radius=&", "&radius=750&")
-            siblings = ADHOCSearch.objects.filter(query_url=url,
-                                                  status=ADHOCSearch._mt_finished)
-            if siblings.count() > 0 and end_date.date() == datetime.today().date():
-                # When a query already exists, we use its data!!!
-                sibling = siblings.first()
+            adhoc_search.set_keys([h.label for h in hashtags], [c.label for c in categories])
+            sibling = ADHOCSearch.objects.filter(query_key=adhoc_search.query_key,
+                                                 status=ADHOCSearch._mt_finished).order_by('-created').first()
+            if sibling is not None and sibling.covered_interval()[1] >= end_date.date():
+                # When the same query was already completed, we use its data!!!
+                # Otherwise, the new search only downloads the dates that previous searches did not
                 url = sibling.query_url
                 if "showresults=" in url:
                     url = url.replace("showresults=", "showresults=1")
@@ -231,20 +234,40 @@ class Pivot(View):
 
 
 class checkProgressADHOC(View):
-    """ Ajax, checking progress on adhoc queries
+    """ Ajax, checking progress on adhoc queries. When the version of the progress known by the client is passed,
+    the request waits until the progress changes (long polling), see instanalysis.progress
     """
     def get(self, request, pk, *agrs, **kwargs):
-        adhoc_search = get_object_or_404(ADHOCSearch, id=pk)
-        return JsonResponse({"ok": True,
-                             "finished": int(adhoc_search.status) == ADHOCSearch._mt_finished,
-                             "error": int(adhoc_search.status) == ADHOCSearch._mt_error,
-                             "url": adhoc_search.query_url})
+        progress = JobProgress('adhoc', pk).wait(version=parse_version(request))
+        if progress is None or progress['status'] != RUNNING:
+            # Searches without progress in redis are answered from the database
+            adhoc_search = get_object_or_404(ADHOCSearch, id=pk)
+            return JsonResponse({"ok": True,
+                                 "finished": int(adhoc_search.status) == ADHOCSearch._mt_finished,
+                                 "error": int(adhoc_search.status) == ADHOCSearch._mt_error,
+                                 "url": adhoc_search.query_url,
+                                 "progress": progress})
+        return JsonResponse({"ok": True, "finished": False, "error": False, "url": progress.get('url'),
+                             "progress": progress})
 
 
 class checkProgressExportExcel(View):
-    """ Ajax, checking progress on exporting queries to excel file
+    """ Ajax, checking progress on exporting queries to excel file. Long polling as checkProgressADHOC
     """
     def get(self, request, pk, *agrs, **kwargs):
-        export_form = get_object_or_404(ExportForm, id=pk)
-        return JsonResponse({"ok": True, "finished": int(export_form.status) == ExportForm._mt_finished,
-                             "url_file": export_form.url_file})
\ No newline at end of file
+        progress = JobProgress('export', pk).wait(version=parse_version(request))
+        if progress is None:
+            export_form = get_object_or_404(ExportForm, id=pk)
+            return JsonResponse({"ok": True, "finished": int(export_form.status) == ExportForm._mt_finished,
+                                 "url_file": export_form.url_file, "progress": None})
+        return JsonResponse({"ok": True, "finished": progress['status'] == FINISHED,
+                             "url_file": progress.get('url_file'), "progress": progress})
+
+
+def parse_version(request):
+    """ Version of the progress known by the client, None when it has not any
+    """
+    try:
+        return int(request.GET['version'])
+    except (KeyError, ValueError):
+        return None
@@ -253,6 +253,10 @@ CACHES = {
 }
 SESSION_ENGINE = "django.contrib.sessions.backends.cache"
 
+# Seconds that settings (see instanalysis.models.Setting) are kept in the memory of each process and in the cache
+SETTINGS_LOCAL_CACHE_TTL = 10
+SETTINGS_SHARED_CACHE_TTL = 3600
+
 STATIC_ROOT = "/home/%s/staticfiles/" % FABRIC['SSH_USER']
 
 TIME_ZONE = 'Europe/Madrid'
@@ -269,6 +273,77 @@ EMAIL_BACKEND = 'django_ses.SESBackend'
 INSTAGRAM_CLIENT_ID = "0f726187bdb949cba308ca2864785eb2"
 INSTAGRAM_SECRET_ID = "a4342089c479427eb213adfb4c7b5c43"
 
+# Instagram API client. Point INSTAGRAM_API_URL to a local server to run the client without the real API
+INSTAGRAM_API_URL = "https://api.instagram.com"
+INSTAGRAM_API_POOL_SIZE = 10  # Keep-alive connections per process
+INSTAGRAM_API_TIMEOUT = (5, 30)  # Seconds to connect and to read the response
+INSTAGRAM_API_MAX_RETRIES = 4  # Retries on connection errors and 5xx responses
+INSTAGRAM_API_BACKOFF_BASE = 1  # Seconds, doubled on every retry
+INSTAGRAM_API_BACKOFF_MAX = 60  # Seconds
+
+# Quota of the Instagram API, shared by all processes through redis
+INSTAGRAM_QUOTA_REDIS_URL = 'redis://localhost:6379'
+INSTAGRAM_HOURLY_LIMIT = 5000  # Requests allowed in any window of one hour
+INSTAGRAM_QUOTA_BURST = 50  # Requests that can be done at once
+INSTAGRAM_QUOTA_TIMEOUT = 600  # Seconds a request waits for quota before failing
+
+#############################
+# CITIES AND ADHOC SEARCHES #
+#############################
+
+# Spots of the cities, see the command plan_spots. Their locations are refreshed by the task update_locations
+CITY_SPOT_RADIUS = 750  # Meters, radius of the location searches of the spots of the cities
+LOCATION_REFRESH_CONCURRENCY = 8  # Spots queried at the same time when updating the locations of the cities
+
+# Results of location searches are cached by geohash cell and radius, see InstagramAPI.getLocations
+LOCATION_CACHE_GEOHASH_PRECISION = 7  # Cells of about 150 x 150 meters
+LOCATION_CACHE_TTL = 3 * 24 * 60 * 60  # Seconds
+
+# Adhoc searches download every location in its own task, see instanalysis.planner
+ADHOC_SPOT_RADIUS = 750  # Meters, radius of every location search done to cover the area of an adhoc search
+ADHOC_LOCAL_MAX_DELAY = 3600  # Seconds, locations of the cities updated within them are used as up to date
+ADHOC_MAX_CONCURRENCY = 8  # Locations of adhoc searches downloaded at the same time, by all the workers
+ADHOC_LOCATION_MAX_RETRIES = 5  # Retries of the download of a location
+ADHOC_LOCATION_RETRY_DELAY = 30  # Seconds, doubled on every retry
+
+#############
+# INGESTION #
+#############
+
+# Maximum number of hashtags and users whose ids are kept in memory by each process while ingesting
+HASHTAG_ID_CACHE_SIZE = 50000
+INSTAGRAM_USER_ID_CACHE_SIZE = 50000
+
+# Publications of the cities are merged into the hashtag index and the sketches every minute by the task
+# merge_pending_publications
+PENDING_MERGE_BATCH_SIZE = 5000  # Publications merged per transaction
+
+################
+# JOB PROGRESS #
+################
+
+# Progress of adhoc searches and exports, see instanalysis.progress
+PROGRESS_REDIS_URL = 'redis://localhost:6379'
+PROGRESS_TTL = 24 * 60 * 60  # Seconds the progress of a job is kept
+PROGRESS_WAIT_TIMEOUT = 20  # Maximum seconds a progress request waits for a change
+PROGRESS_ERROR_DELAY = 2  # Seconds a progress request waits when redis fails
+EXPORT_PROGRESS_ROWS = 1000  # The progress of exports is updated every this number of publications
+
+##############
+# STATISTICS #
+##############
+
+# Hashtag filters of the map, see HashtagPostingManager
+HASHTAG_FILTER_MAX_IDS = 10000  # Larger matches of the hashtag filters are filtered with joins instead of by id
+
+# Top hashtags of the map are estimated with Space-Saving sketches per city, date and hour
+HASHTAG_SKETCH_CAPACITY = 256  # Hashtags counted per sketch
+
+# Distinct authors and hashtags of the map are estimated with HyperLogLog sketches of 2 ** HLL_PRECISION registers per
+# city, date and hour. Standard error 1.04 / sqrt(2 ** HLL_PRECISION), 2.3% with 11. Changing it requires
+# `manage.py rebuild_rollups`
+HLL_PRECISION = 11
+
 ################
 # CELERY STUFF #
 ################
@@ -280,18 +355,22 @@ CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 
 CELERYBEAT_SCHEDULE = {
-    'update_api_quotas': {
-        'task': 'instanalysis.tasks.calculate_api_quotas',
-        'schedule': crontab(minute='*')
-    },
     'generate_file_categories': {
         'task': 'instanalysis.tasks.generate_categories_file',
         'schedule': crontab(hour=0, minute=0)
     },
+    'update_locations': {
+        'task': 'instanalysis.tasks.update_locations',
+        'schedule': crontab(day_of_week=1, hour=4, minute=0)
+    },
     'reset_adhoc': {
         'task': 'instanalysis.tasks.reset_adhoc',
         'schedule': crontab(minute='0,30')
     },
+    'merge_pending_publications': {
+        'task': 'instanalysis.tasks.merge_pending_publications',
+        'schedule': crontab(minute='*')
+    },
 
 }
 